@@ -0,0 +1,140 @@
+"""
+Benchmark the Spotify ingestion path against the offline FakeSpotifyAdapter.
+Reports wall time, call count and bytes for SpotifyAnalyzer.get_playlist_details
+and SpotifyAnalyzer.get_user_playlists at several sizes.
+
+Usage:
+    python -m benchmarks.bench_ingestion
+    python -m benchmarks.bench_ingestion --sizes 10 100 --latency 0.05 --rate-limit 20
+"""
+
+import argparse
+import time
+
+from cachelib import SimpleCache
+
+from playlistify import http_client
+from playlistify.fetch_engine import FetchEngine
+from playlistify.SpotifyAnalyzer import SpotifyAnalyzer, USER_PLAYLISTS_PAGE_SIZE
+from benchmarks.fake_spotify import FakeSpotifyAdapter
+
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+USER_ID = 'bench_user'
+
+
+def mount(adapter):
+    """Route every Spotify call made through http_client to the fake."""
+    http_client.session.mount('https://api.spotify.com', adapter)
+    http_client.session.mount('https://accounts.spotify.com', adapter)
+
+
+def measure(fn):
+    """
+    Run fn, counting the Spotify calls it makes.
+    @return:
+        - (result, dictionary of wall time, calls, errors and bytes)
+    """
+    http_client.reset_stats()
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+
+    endpoints = http_client.stats()['endpoints'].values()
+    return result, {
+        'wall_s': round(wall, 3),
+        'calls': sum(endpoint['calls'] for endpoint in endpoints),
+        'errors': sum(endpoint['errors'] for endpoint in endpoints),
+        'bytes': sum(endpoint['bytes'] for endpoint in endpoints)
+    }
+
+
+def make_analyzer():
+    # A fresh engine per run so one run's rate limit backoff doesn't leak into the next,
+    # and no metadata cache so every run actually fetches
+    return SpotifyAnalyzer(username=USER_ID, token='fake-token', engine=FetchEngine(), use_cache=False)
+
+
+def bench_playlist_details(sizes, adapter_options):
+    """Time get_playlist_details on playlists of each size."""
+    results = []
+    for size in sizes:
+        adapter = FakeSpotifyAdapter(**adapter_options)
+        playlist_id = f'bench{size}'.ljust(22, '0')
+        adapter.add_playlist(playlist_id, size, owner_id=USER_ID)
+        mount(adapter)
+
+        analyzer = make_analyzer()
+        details, stats = measure(lambda: analyzer.get_playlist_details(playlist_id))
+        if details is None:
+            print(f"get_playlist_details failed for {size} tracks")
+            continue
+        _, song_panda, _ = details
+        stats.update(tracks=size, rows=len(song_panda), rate_limited=adapter.counts['rate_limited'])
+        results.append(stats)
+    return results
+
+
+def bench_user_playlists(sizes, adapter_options):
+    """Time get_user_playlists cold, then again revalidating the cached pages with ETags."""
+    results = []
+    for size in sizes:
+        adapter = FakeSpotifyAdapter(**adapter_options)
+        adapter.add_user_playlists(USER_ID, size)
+        mount(adapter)
+
+        analyzer = make_analyzer()
+        page_cache = SimpleCache(threshold=size // USER_PLAYLISTS_PAGE_SIZE + 10, default_timeout=0)
+        playlists, cold = measure(lambda: analyzer.get_user_playlists(page_cache=page_cache))
+        _, warm = measure(lambda: analyzer.get_user_playlists(page_cache=page_cache))
+        results.append({
+            'playlists': size,
+            'rows': len(playlists),
+            'cold_wall_s': cold['wall_s'],
+            'cold_calls': cold['calls'],
+            'cold_bytes': cold['bytes'],
+            'warm_wall_s': warm['wall_s'],
+            'warm_calls': warm['calls'],
+            'warm_bytes': warm['bytes']
+        })
+    return results
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    if not rows:
+        print("  (no results)")
+        return
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  ' + '  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  ' + '  '.join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='playlist sizes (tracks) and playlist counts to benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency per fake response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds of latency jitter per fake response')
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests/second before the fake answers 429')
+    parser.add_argument('--burst', type=int, default=None, help='requests allowed over the rate limit at once')
+    parser.add_argument('--null-features', type=float, default=0.0,
+                        help='fraction of songs the fake has no audio features for')
+    args = parser.parse_args()
+
+    adapter_options = {
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'rate_limit': args.rate_limit,
+        'burst': args.burst,
+        'null_feature_rate': args.null_features
+    }
+    print(f"Fake Spotify: {adapter_options}")
+    print_table("get_playlist_details", bench_playlist_details(args.sizes, adapter_options))
+    print_table("get_user_playlists", bench_user_playlists(args.sizes, adapter_options))
+
+
+if __name__ == '__main__':
+    main()
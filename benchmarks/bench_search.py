@@ -0,0 +1,185 @@
+"""
+Benchmark /search_results: the old unindexed ILIKE '%term%' queries against
+playlistify.search's trigram-indexed, ranked and paginated ones.
+Builds a synthetic catalog in its own schema (bench_search, dropped afterwards
+unless --keep), with tables and indexes copied from the migrated public schema,
+then reports p50/p99 latency for each search type over exact, partial and misspelled terms.
+
+Needs a database migrated through 005_search_trigram_indexes.sql (so pg_trgm is installed).
+
+Usage:
+    python -m benchmarks.bench_search
+    python -m benchmarks.bench_search --songs 100000 --runs 20 --keep
+    python -m benchmarks.bench_search --keep --explain  # also print each search type's plan
+"""
+
+import argparse
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from playlistify.db_config import my_engine, NO_STATEMENT_TIMEOUT
+from playlistify.search import SEARCH_QUERIES, SET_WORD_SIMILARITY_THRESHOLD, WORD_SIMILARITY_THRESHOLD, MAX_MATCHES, \
+    search_playlists, like_pattern
+from benchmarks.bench_ingestion import print_table
+
+
+SCHEMA = 'bench_search'
+TABLES = ['Users', 'Playlist', 'Artist', 'Song', 'HasPlaylist', 'PlaylistSong', 'PlaylistArtists']
+WORDS = [
+    'love', 'night', 'summer', 'blue', 'fire', 'dream', 'heart', 'city', 'gold', 'rain',
+    'midnight', 'dance', 'river', 'shadow', 'electric', 'paradise', 'lonely', 'forever', 'wild', 'sugar',
+    'thunder', 'velvet', 'echo', 'highway', 'neon', 'ocean', 'silver', 'ghost', 'honey', 'stranger',
+    'kendrick', 'beatles', 'madvillain', 'brockhampton', 'clinton', 'sampha', 'doom', 'starr', 'mountain', 'garden'
+]
+# Exact words, the start of a word, misspellings and two-word phrases
+TERMS = ['love', 'midnight', 'para', 'electr', 'beatls', 'kendrik', 'brockhamton', 'summer night', 'neon highway']
+
+# The queries /search_results ran before playlistify.search
+BASELINE_QUERIES = {
+    'playlist': text("""
+        SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
+        FROM HasPlaylist
+        INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+        INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
+        WHERE Playlist.title iLIKE :query
+    """),
+    'artist': text("""
+        SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
+        FROM HasPlaylist
+        INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+        INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
+        INNER JOIN PlaylistArtists ON Playlist.playlist_id = PlaylistArtists.playlist_id
+        INNER JOIN Artist ON PlaylistArtists.artist_id = Artist.artist_id
+        WHERE Artist.name iLIKE :query
+    """),
+    'song': text("""
+        SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
+        FROM HasPlaylist
+        INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+        INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
+        INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
+        INNER JOIN Song ON PlaylistSong.song_id = Song.song_id
+        WHERE Song.title iLIKE :query
+    """)
+}
+
+# A title of one to four random words; n * 0 ties the subquery to the row so it's run for each one
+RANDOM_TITLE = """
+    (SELECT string_agg(initcap((CAST(:words AS TEXT[]))[1 + floor(random() * :word_count)::int]), ' ')
+     FROM generate_series(0, floor(random() * 4)::int + n * 0))
+"""
+
+
+def build_catalog(conn, songs, artists, playlists, users, songs_per_playlist):
+    """Create the bench schema and fill it with a random catalog."""
+    conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+    conn.exec_driver_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    conn.exec_driver_sql(f'CREATE SCHEMA {SCHEMA}')
+    for table in TABLES:
+        conn.exec_driver_sql(f'CREATE TABLE {SCHEMA}.{table} (LIKE public.{table} INCLUDING ALL)')
+    conn.exec_driver_sql(f'SET LOCAL search_path TO {SCHEMA}, public')
+
+    params = {'words': WORDS, 'word_count': len(WORDS)}
+    conn.execute(text("SELECT setseed(0.42)"))
+    conn.execute(text("INSERT INTO Users (user_id, name) SELECT 'u' || n, 'User ' || n FROM generate_series(1, :users) AS n"),
+                 {'users': users})
+    conn.execute(text(f"INSERT INTO Playlist (playlist_id, title) SELECT 'p' || n, {RANDOM_TITLE} FROM generate_series(1, :playlists) AS n"),
+                 dict(params, playlists=playlists))
+    conn.execute(text(f"INSERT INTO Artist (artist_id, name) SELECT 'a' || n, {RANDOM_TITLE} FROM generate_series(1, :artists) AS n"),
+                 dict(params, artists=artists))
+    conn.execute(text(f"INSERT INTO Song (song_id, title) SELECT 's' || n, {RANDOM_TITLE} FROM generate_series(1, :songs) AS n"),
+                 dict(params, songs=songs))
+    conn.execute(text("""
+        INSERT INTO HasPlaylist (user_id, playlist_id)
+        SELECT 'u' || (1 + n % :users), 'p' || n FROM generate_series(1, :playlists) AS n
+    """), {'users': users, 'playlists': playlists})
+    conn.execute(text("""
+        INSERT INTO PlaylistSong (playlist_id, song_id)
+        SELECT DISTINCT 'p' || (1 + floor(random() * :playlists)::int), 's' || (1 + floor(random() * :songs)::int)
+        FROM generate_series(1, :links)
+        ON CONFLICT DO NOTHING
+    """), {'playlists': playlists, 'songs': songs, 'links': playlists * songs_per_playlist})
+    conn.execute(text("""
+        INSERT INTO PlaylistArtists (playlist_id, artist_id)
+        SELECT DISTINCT 'p' || (1 + floor(random() * :playlists)::int), 'a' || (1 + floor(random() * :artists)::int)
+        FROM generate_series(1, :links)
+        ON CONFLICT DO NOTHING
+    """), {'playlists': playlists, 'artists': artists, 'links': playlists * songs_per_playlist // 2})
+    for table in TABLES:
+        conn.exec_driver_sql(f'ANALYZE {SCHEMA}.{table}')
+    conn.commit()
+
+
+def time_queries(run_query, runs):
+    """
+    Time run_query(term) runs times for every term.
+    @return:
+        - (p50 ms, p99 ms, mean rows returned)
+    """
+    timings = []
+    rows = []
+    for _ in range(runs):
+        for term in TERMS:
+            start = time.perf_counter()
+            rows.append(len(run_query(term)))
+            timings.append((time.perf_counter() - start) * 1000)
+    return round(np.percentile(timings, 50), 2), round(np.percentile(timings, 99), 2), round(np.mean(rows), 1)
+
+
+def bench_search(conn, runs):
+    conn.exec_driver_sql(f'SET search_path TO {SCHEMA}, public')
+    results = []
+    for search_type in SEARCH_QUERIES:
+        baseline = time_queries(lambda term: conn.execute(BASELINE_QUERIES[search_type], {'query': f'%{term}%'}).fetchall(), runs)
+        ranked = time_queries(lambda term: search_playlists(conn, search_type, term)[0], runs)
+        for name, (p50, p99, rows) in [('ilike', baseline), ('trigram', ranked)]:
+            results.append({'search_type': search_type, 'query': name, 'p50_ms': p50, 'p99_ms': p99, 'rows': rows})
+    return results
+
+
+def explain(conn, term):
+    """Print the plan of each search type's query for a term, as search_playlists runs it."""
+    conn.exec_driver_sql(f'SET search_path TO {SCHEMA}, public')
+    conn.execute(SET_WORD_SIMILARITY_THRESHOLD, {'threshold': str(WORD_SIMILARITY_THRESHOLD)})
+    print(f"pg_trgm.word_similarity_threshold = {conn.exec_driver_sql('SHOW pg_trgm.word_similarity_threshold').scalar()}")
+    params = {'term': term, 'pattern': like_pattern(term), 'max_matches': MAX_MATCHES, 'limit': 26, 'offset': 0}
+    for search_type, query in SEARCH_QUERIES.items():
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, COSTS OFF) {query.text}"), params).scalars()
+        print(f"\n{search_type} search for {term!r}:")
+        print('\n'.join(plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=1000000, help='songs in the catalog')
+    parser.add_argument('--artists', type=int, default=100000, help='artists in the catalog')
+    parser.add_argument('--playlists', type=int, default=20000, help='playlists in the catalog')
+    parser.add_argument('--users', type=int, default=2000, help='uploaders in the catalog')
+    parser.add_argument('--songs-per-playlist', type=int, default=50, help='songs added to each playlist')
+    parser.add_argument('--runs', type=int, default=10, help='times to run each search term')
+    parser.add_argument('--keep', action='store_true', help=f'keep the {SCHEMA} schema for another run (skips building it)')
+    parser.add_argument('--explain', action='store_true', help='print the plan of each search type first')
+    args = parser.parse_args()
+
+    with my_engine.connect() as conn:
+        exists = conn.execute(text("SELECT 1 FROM pg_namespace WHERE nspname = :schema"), {'schema': SCHEMA}).first()
+        if not (args.keep and exists):
+            start = time.monotonic()
+            build_catalog(conn, args.songs, args.artists, args.playlists, args.users, args.songs_per_playlist)
+            print(f"Built {args.songs} songs, {args.artists} artists, {args.playlists} playlists "
+                  f"in {time.monotonic() - start:.1f}s")
+        try:
+            if args.explain:
+                explain(conn, TERMS[0])
+            print_table(f"search_results over {len(TERMS)} terms x {args.runs} runs", bench_search(conn, args.runs))
+        finally:
+            conn.rollback()
+            if not args.keep:
+                conn.exec_driver_sql(f'DROP SCHEMA {SCHEMA} CASCADE')
+                conn.commit()
+
+
+if __name__ == '__main__':
+    main()
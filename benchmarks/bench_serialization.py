@@ -0,0 +1,117 @@
+"""
+Benchmark how analysis results are serialized for the result store:
+the old pickle + zlib blobs against the msgspec columnar layout in result_store.
+Reports encode time, decode time and size for playlists of several sizes, analyzed
+through the offline FakeSpotifyAdapter so the frames have their real dtypes.
+
+Decode times are for the whole result and for what /playlist reads
+(song_panda only, from a memory-mapped file for msgspec).
+
+Usage:
+    python -m benchmarks.bench_serialization
+    python -m benchmarks.bench_serialization --sizes 100 1000 --repeat 20
+"""
+
+import argparse
+import mmap
+import os
+import pickle
+import statistics
+import tempfile
+import time
+import zlib
+
+from playlistify.result_store import encode_result, decode_result
+from benchmarks.bench_ingestion import mount, make_analyzer, print_table, USER_ID
+from benchmarks.fake_spotify import FakeSpotifyAdapter
+
+
+DEFAULT_SIZES = [100, 1000, 10000]
+DEFAULT_REPEAT = 10
+
+
+def pickle_encode(playlist_data, song_panda, art_panda):
+    """How analyze_playlist stored results before the result store: each frame pickled and compressed."""
+    return playlist_data, zlib.compress(pickle.dumps(song_panda)), zlib.compress(pickle.dumps(art_panda))
+
+
+def pickle_decode(blob, artists=True):
+    playlist_data, song_blob, art_blob = blob
+    art_panda = pickle.loads(zlib.decompress(art_blob)) if artists else None
+    return playlist_data, pickle.loads(zlib.decompress(song_blob)), art_panda
+
+
+def pickle_size(blob):
+    return len(pickle.dumps(blob[0])) + len(blob[1]) + len(blob[2])
+
+
+def best_ms(fn, repeat):
+    """Median wall time of fn over repeat runs, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return round(statistics.median(times) * 1000, 3)
+
+
+def analyze(size, null_feature_rate):
+    adapter = FakeSpotifyAdapter(null_feature_rate=null_feature_rate)
+    playlist_id = f'bench{size}'.ljust(22, '0')
+    adapter.add_playlist(playlist_id, size, owner_id=USER_ID)
+    mount(adapter)
+    return make_analyzer().get_playlist_details(playlist_id)
+
+
+def bench_size(size, repeat, null_feature_rate):
+    playlist_data, song_panda, art_panda = analyze(size, null_feature_rate)
+    rows = []
+
+    blob = pickle_encode(playlist_data, song_panda, art_panda)
+    rows.append({
+        'tracks': size,
+        'format': 'pickle+zlib',
+        'bytes': pickle_size(blob),
+        'encode_ms': best_ms(lambda: pickle_encode(playlist_data, song_panda, art_panda), repeat),
+        'decode_ms': best_ms(lambda: pickle_decode(blob), repeat),
+        'songs_only_ms': best_ms(lambda: pickle_decode(blob, artists=False), repeat)
+    })
+
+    blob = encode_result(playlist_data, song_panda, art_panda)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(blob)
+        f.flush()
+
+        def decode_mapped():
+            # The way DiskResultStore.view hands results to /playlist
+            with open(f.name, 'rb') as mapped_file:
+                buffer = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return decode_result(buffer, artists=False)
+
+        rows.append({
+            'tracks': size,
+            'format': 'msgspec',
+            'bytes': len(blob),
+            'encode_ms': best_ms(lambda: encode_result(playlist_data, song_panda, art_panda), repeat),
+            'decode_ms': best_ms(lambda: decode_result(blob), repeat),
+            'songs_only_ms': best_ms(decode_mapped, repeat)
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='playlist sizes (tracks)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs to take the median of')
+    parser.add_argument('--null-features', type=float, default=0.0,
+                        help='fraction of songs the fake has no audio features for')
+    args = parser.parse_args()
+
+    rows = []
+    for size in args.sizes:
+        rows.extend(bench_size(size, args.repeat, args.null_features))
+    print_table("analysis result serialization", rows)
+
+
+if __name__ == '__main__':
+    main()
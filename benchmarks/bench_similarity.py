@@ -0,0 +1,156 @@
+"""
+Benchmark playlistify.similarity's nearest neighbour index against brute force
+(the distance from the query to every song, fully sorted).
+Builds a synthetic catalog of song feature vectors in memory, clustered like genres are,
+with playlists drawn from the clusters, then reports p50/p99 latency and recall (the share
+of brute force's k nearest the index also returns) for similar songs and similar playlists,
+and how long adding a playlist's songs takes.
+With --from-db, also times loading the index from the database and querying it.
+
+Usage:
+    python -m benchmarks.bench_similarity
+    python -m benchmarks.bench_similarity --songs 100000 --queries 50 --from-db
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from playlistify.playlist_features import FEATURE_FIELDS
+from playlistify.similarity import NearestNeighbourIndex, SIMILAR_SONGS, SIMILAR_PLAYLISTS, load_similarity_index
+from benchmarks.bench_ingestion import print_table
+
+
+CLUSTERS = 50
+
+
+def make_catalog(songs, playlists, songs_per_playlist, seed=42):
+    """
+    Random normalized song vectors around CLUSTERS centers, and playlists of songs mostly from one cluster.
+    @return:
+        - (song vectors, list of each playlist's song positions, playlist centroids)
+    """
+    rng = np.random.default_rng(seed)
+    dims = len(FEATURE_FIELDS)
+    centers = rng.standard_normal((CLUSTERS, dims)).astype(np.float32)
+    labels = rng.integers(CLUSTERS, size=songs)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((songs, dims)).astype(np.float32)
+    by_cluster = [np.flatnonzero(labels == cluster) for cluster in range(CLUSTERS)]
+
+    members = []
+    for _ in range(playlists):
+        cluster = by_cluster[rng.integers(CLUSTERS)]
+        picks = np.concatenate([rng.choice(cluster, songs_per_playlist * 3 // 4),
+                                rng.integers(songs, size=songs_per_playlist // 4)])
+        members.append(np.unique(picks))
+    centroids = np.array([vectors[picks].mean(axis=0) for picks in members], dtype=np.float32)
+    return vectors, members, centroids
+
+
+def brute_force(vectors, query, k, exclude=()):
+    """The k nearest rows by computing and sorting every distance."""
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    distances[list(exclude)] = np.inf
+    return np.argsort(distances, kind='stable')[:k]
+
+
+def time_queries(run_query, queries):
+    """
+    Time run_query(i) for each query number.
+    @return:
+        - (p50 ms, p99 ms, list of the results)
+    """
+    timings = []
+    results = []
+    for i in range(queries):
+        start = time.perf_counter()
+        results.append(run_query(i))
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(np.percentile(timings, 50), 2), round(np.percentile(timings, 99), 2), results
+
+
+def recall(expected, found):
+    """The share of the expected neighbours that were found, across all queries."""
+    return round(sum(len(set(e) & set(f)) for e, f in zip(expected, found)) / sum(len(e) for e in expected), 4)
+
+
+def bench_synthetic(songs, playlists, songs_per_playlist, queries):
+    start = time.perf_counter()
+    vectors, members, centroids = make_catalog(songs, playlists, songs_per_playlist)
+    song_ids = [f's{i}' for i in range(songs)]
+    playlist_ids = [f'p{i}' for i in range(playlists)]
+    print(f"Built {songs} songs, {playlists} playlists in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    song_index = NearestNeighbourIndex(song_ids, vectors)
+    playlist_index = NearestNeighbourIndex(playlist_ids, centroids)
+    print(f"Indexed in {time.perf_counter() - start:.2f}s")
+
+    results = []
+    cases = {
+        # Songs like a playlist that aren't in it (view_playlist's similar songs)
+        'similar songs': (vectors, song_index, SIMILAR_SONGS, lambda i: members[i]),
+        # Other playlists like a playlist (view_playlist's similar playlists)
+        'similar playlists': (centroids, playlist_index, SIMILAR_PLAYLISTS + 1, lambda i: [i])
+    }
+    for case, (matrix, index, k, excluded) in cases.items():
+        brute = time_queries(lambda i: brute_force(matrix, centroids[i], k, excluded(i)), queries)
+        indexed = time_queries(lambda i: index.nearest(centroids[i], k, exclude=[index._ids[j] for j in excluded(i)]), queries)
+        expected = [[index._ids[j] for j in found] for found in brute[2]]
+        found = [[id_ for id_, _ in neighbours] for neighbours in indexed[2]]
+        for name, (p50, p99, _) in [('brute force', brute), ('index', indexed)]:
+            results.append({'query': case, 'method': name, 'rows': matrix.shape[0], 'p50_ms': p50, 'p99_ms': p99,
+                            'recall': 1.0 if name == 'brute force' else recall(expected, found)})
+
+    # A new playlist's songs, as persist_playlist records them
+    rng = np.random.default_rng(7)
+    timings = []
+    for i in range(queries):
+        new_vectors = rng.standard_normal((songs_per_playlist, len(FEATURE_FIELDS))).astype(np.float32)
+        start = time.perf_counter()
+        song_index.update([f'new{i}_{j}' for j in range(songs_per_playlist)], new_vectors)
+        playlist_index.update([f'new{i}'], new_vectors.mean(axis=0, keepdims=True))
+        timings.append((time.perf_counter() - start) * 1000)
+    results.append({'query': f'add {songs_per_playlist} songs', 'method': 'index', 'rows': len(song_index),
+                    'p50_ms': round(np.percentile(timings, 50), 2), 'p99_ms': round(np.percentile(timings, 99), 2),
+                    'recall': ''})
+    return results
+
+
+def bench_database(queries):
+    start = time.perf_counter()
+    index = load_similarity_index()
+    print(f"Loaded {len(index.songs)} songs, {len(index.playlists)} playlists from the database "
+          f"in {time.perf_counter() - start:.1f}s")
+    playlist_ids = list(index.playlists._positions)
+    if not playlist_ids:
+        return []
+    rng = np.random.default_rng(0)
+    picks = [playlist_ids[i] for i in rng.integers(len(playlist_ids), size=queries)]
+    results = []
+    for case, run_query in [('similar songs', lambda i: index.similar_songs(picks[i])),
+                            ('similar playlists', lambda i: index.similar_playlists(picks[i]))]:
+        p50, p99, _ = time_queries(run_query, queries)
+        results.append({'query': case, 'method': 'index (database)', 'rows': len(index.songs if case == 'similar songs' else index.playlists),
+                        'p50_ms': p50, 'p99_ms': p99, 'recall': ''})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=1000000, help='songs in the synthetic catalog')
+    parser.add_argument('--playlists', type=int, default=20000, help='playlists in the synthetic catalog')
+    parser.add_argument('--songs-per-playlist', type=int, default=50, help='songs in each playlist')
+    parser.add_argument('--queries', type=int, default=100, help='playlists to find similar songs and playlists for')
+    parser.add_argument('--from-db', action='store_true', help='also load the index from the database and query it')
+    args = parser.parse_args()
+
+    results = bench_synthetic(args.songs, args.playlists, args.songs_per_playlist, args.queries)
+    if args.from_db:
+        results += bench_database(args.queries)
+    print_table(f"similarity search over {args.queries} queries", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+An offline stand-in for the Spotify Web API.
+FakeSpotifyAdapter is a requests transport adapter: mount it on the shared
+http_client.session and every SpotifyAnalyzer call is answered locally from
+fixtures, with configurable latency, rate limiting (429s) and playlist sizes.
+
+Fixtures are seeded from the songs and artists recorded in playlistify/static/,
+cycled with fresh ids to build playlists of any size.
+"""
+
+import ast
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'playlistify', 'static')
+
+FEATURE_KEYS = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+                'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+
+INT_FEATURE_KEYS = {'key', 'mode', 'duration_ms', 'time_signature'}
+
+BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def make_id(prefix, n):
+    """Make a deterministic 22 character Spotify-style id."""
+    digits = ''
+    while True:
+        n, remainder = divmod(n, 62)
+        digits = BASE62[remainder] + digits
+        if n == 0:
+            break
+    return (prefix + digits.rjust(22, '0'))[-22:]
+
+
+def _features(row):
+    """Spotify-shaped audio features from a CSV row (iterrows upcasts the int columns to float)."""
+    return {key: int(row[key]) if key in INT_FEATURE_KEYS else float(row[key]) for key in FEATURE_KEYS}
+
+
+def load_seed_catalog(static_dir=STATIC_DIR):
+    """Load recorded songs (with features and artist ids) and artists from the static CSVs."""
+    songs = []
+
+    smule = pd.read_csv(os.path.join(static_dir, 'smule_panda.csv'))
+    for _, row in smule.iterrows():
+        songs.append({
+            'name': row['song_title'],
+            'popularity': int(row['popularity']),
+            'artists': list(zip(row['artists'].split(', '), [uri.split(':')[-1] for uri in row['artist_uris'].split(', ')])),
+            'genres': ast.literal_eval(row['genres']),
+            'features': _features(row)
+        })
+
+    # tiger_talk.csv has the artist ids, tiger_talk_songs.csv has the features
+    tiger_talk = pd.read_csv(os.path.join(static_dir, 'tiger_talk.csv'))
+    tiger_talk_songs = pd.read_csv(os.path.join(static_dir, 'tiger_talk_songs.csv'))
+    for (_, track), (_, row) in zip(tiger_talk.iterrows(), tiger_talk_songs.iterrows()):
+        songs.append({
+            'name': row['song_title'],
+            'popularity': int(row['popularity']),
+            'artists': list(zip(track['artists'].split(', '), [uri.split(':')[-1] for uri in track['artist_uris'].split(', ')])),
+            'genres': ast.literal_eval(row['genres']),
+            'features': _features(row)
+        })
+
+    artists = {}
+    recorded_artists = pd.read_csv(os.path.join(static_dir, 'artists_SQL.csv'))
+    for _, row in recorded_artists.iterrows():
+        artists[row['artist_id']] = {
+            'id': row['artist_id'],
+            'name': row['name'],
+            'images': [{'url': row['image_url'], 'height': 640, 'width': 640}] if isinstance(row['image_url'], str) else [],
+            'genres': ast.literal_eval(row['genres']),
+            'popularity': int(row['popularity']),
+            'type': 'artist',
+            'uri': f"spotify:artist:{row['artist_id']}"
+        }
+
+    # Artists that weren't recorded get the genres of the songs they're on
+    for song in songs:
+        for name, artist_id in song['artists']:
+            if artist_id not in artists:
+                artists[artist_id] = {
+                    'id': artist_id,
+                    'name': name,
+                    'images': [],
+                    'genres': song['genres'],
+                    'popularity': song['popularity'],
+                    'type': 'artist',
+                    'uri': f'spotify:artist:{artist_id}'
+                }
+    return songs, artists
+
+
+class FakeSpotifyAdapter(BaseAdapter):
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=None, burst=None, retry_after=1,
+                 null_feature_rate=0.0, static_dir=STATIC_DIR, seed=0):
+        """
+        Create an offline Spotify API.
+        @param:
+            - latency, jitter: seconds each response takes (uniformly latency +/- jitter)
+            - rate_limit: sustained requests/second allowed before answering 429 (None = unlimited)
+            - burst: how many requests can go over rate_limit at once (defaults to rate_limit)
+            - retry_after: Retry-After seconds sent with each 429
+            - null_feature_rate: fraction of songs Spotify has no audio features for
+        """
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.burst = burst or rate_limit
+        self.retry_after = retry_after
+        self.null_feature_rate = null_feature_rate
+        self.random = random.Random(seed)
+
+        self.seed_songs, self.artists = load_seed_catalog(static_dir)
+        self.tracks = {}         # song_id -> track object
+        self.audio_features = {} # song_id -> audio features (None if missing)
+        self.playlists = {}      # playlist_id -> {'playlist': ..., 'track_ids': [...]}
+        self.users = {}          # user_id -> {'user': ..., 'playlist_ids': [...]}
+
+        self.counts = {'requests': 0, 'rate_limited': 0}
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._next_song = 0
+        self._next_snapshot = 0
+
+    # Fixtures
+
+    def add_playlist(self, playlist_id, n_tracks, owner_id='fake_user', name=None):
+        """Add a playlist of n_tracks songs, cycling through the seed songs with fresh ids."""
+        track_ids = [self._make_track() for _ in range(n_tracks)]
+        self.playlists[playlist_id] = {
+            'playlist': {
+                'id': playlist_id,
+                'name': name or f'Fake playlist {playlist_id}',
+                'description': f'{n_tracks} tracks',
+                'images': [{'url': f'https://i.scdn.co/image/{playlist_id}', 'height': 640, 'width': 640}],
+                'owner': {'id': owner_id, 'display_name': owner_id},
+                'snapshot_id': self._make_snapshot_id(),
+                'uri': f'spotify:playlist:{playlist_id}',
+                'type': 'playlist'
+            },
+            'track_ids': track_ids
+        }
+        self.users.setdefault(owner_id, self._make_user(owner_id))['playlist_ids'].append(playlist_id)
+        return self.playlists[playlist_id]['playlist']
+
+    def edit_playlist(self, playlist_id, add=0, remove=0):
+        """Remove a playlist's first remove tracks and append add new ones, giving it a new snapshot_id."""
+        playlist = self.playlists[playlist_id]
+        playlist['track_ids'] = playlist['track_ids'][remove:] + [self._make_track() for _ in range(add)]
+        playlist['playlist']['snapshot_id'] = self._make_snapshot_id()
+        return playlist['playlist']
+
+    def _make_track(self):
+        """Add a song, cycling through the seed songs with a fresh id. Returns its id."""
+        seed_song = self.seed_songs[self._next_song % len(self.seed_songs)]
+        song_id = make_id('t', self._next_song)
+        self._next_song += 1
+
+        self.tracks[song_id] = {
+            'id': song_id,
+            'name': seed_song['name'],
+            'uri': f'spotify:track:{song_id}',
+            'popularity': seed_song['popularity'],
+            'artists': [{'id': artist_id, 'name': name, 'uri': f'spotify:artist:{artist_id}', 'type': 'artist'}
+                        for name, artist_id in seed_song['artists']],
+            'album': {'images': [{'url': f'https://i.scdn.co/image/{song_id}', 'height': 640, 'width': 640}]},
+            'type': 'track'
+        }
+        has_features = self.random.random() >= self.null_feature_rate
+        self.audio_features[song_id] = dict(seed_song['features'], id=song_id, uri=f'spotify:track:{song_id}',
+                                             type='audio_features') if has_features else None
+        return song_id
+
+    def _make_snapshot_id(self):
+        self._next_snapshot += 1
+        return make_id('s', self._next_snapshot)
+
+    def add_user_playlists(self, user_id, n_playlists, tracks_per_playlist=0):
+        """Give a user n_playlists playlists."""
+        for i in range(n_playlists):
+            self.add_playlist(make_id(f'p{user_id}', i), tracks_per_playlist, owner_id=user_id, name=f'{user_id} #{i}')
+
+    def _make_user(self, user_id):
+        return {
+            'user': {
+                'id': user_id,
+                'display_name': user_id,
+                'images': [],
+                'uri': f'spotify:user:{user_id}',
+                'type': 'user'
+            },
+            'playlist_ids': []
+        }
+
+    # Transport
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.counts['requests'] += 1
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        if not self._take_token():
+            with self._lock:
+                self.counts['rate_limited'] += 1
+            return self._response(request, 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                  {'Retry-After': str(self.retry_after)})
+
+        parts = urlsplit(request.url)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        try:
+            status, body, headers = self._route(request, parts.path, query)
+        except KeyError:
+            status, body, headers = 404, {'error': {'status': 404, 'message': 'Not found'}}, {}
+        return self._response(request, status, body, headers)
+
+    def close(self):
+        pass
+
+    def _take_token(self):
+        """Token bucket rate limiter."""
+        if self.rate_limit is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate_limit)
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _route(self, request, path, query):
+        if path == '/api/token':
+            return 200, {'access_token': 'fake-token', 'token_type': 'Bearer', 'expires_in': 3600,
+                         'refresh_token': 'fake-refresh-token'}, {}
+
+        match = re.fullmatch(r'/v1/playlists/(\w+)', path)
+        if match:
+            playlist = self.playlists[match.group(1)]
+            if 'fields' in query:
+                # Only the top-level fields asked for, e.g. fields=snapshot_id
+                fields = query['fields'].split(',')
+                return 200, {field: playlist['playlist'].get(field) for field in fields}, {}
+            body = dict(playlist['playlist'], tracks=self._tracks_page(match.group(1), 0, 100, query))
+            return 200, body, {}
+
+        match = re.fullmatch(r'/v1/playlists/(\w+)/tracks', path)
+        if match:
+            offset = int(query.get('offset', 0))
+            limit = min(int(query.get('limit', 100)), 100)
+            return 200, self._tracks_page(match.group(1), offset, limit, query), {}
+
+        if path == '/v1/audio-features':
+            ids = query['ids'].split(',')[:100]
+            return 200, {'audio_features': [self.audio_features.get(song_id) for song_id in ids]}, {}
+
+        if path == '/v1/artists':
+            ids = query['ids'].split(',')[:50]
+            return 200, {'artists': [self.artists.get(artist_id) for artist_id in ids]}, {}
+
+        if path == '/v1/me':
+            return 200, self.users[self._current_user()]['user'], {}
+
+        if path == '/v1/me/playlists':
+            return self._user_playlists_page(request, query)
+
+        raise KeyError(path)
+
+    def _current_user(self):
+        """The fake token belongs to the first user with playlists."""
+        return next(iter(self.users)) if self.users else 'fake_user'
+
+    def _tracks_page(self, playlist_id, offset, limit, query):
+        track_ids = self.playlists[playlist_id]['track_ids']
+        items = [{'added_at': '2024-04-21T00:00:00Z', 'track': self.tracks[song_id]}
+                 for song_id in track_ids[offset:offset + limit]]
+        next_offset = offset + limit
+        return {
+            'href': f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks?offset={offset}&limit={limit}',
+            'items': items,
+            'limit': limit,
+            'offset': offset,
+            'total': len(track_ids),
+            'next': (f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks?offset={next_offset}&limit={limit}'
+                     if next_offset < len(track_ids) else None)
+        }
+
+    def _user_playlists_page(self, request, query):
+        user = self.users.get(self._current_user(), self._make_user('fake_user'))
+        offset = int(query.get('offset', 0))
+        limit = min(int(query.get('limit', 20)), 50)
+        playlist_ids = user['playlist_ids']
+
+        items = []
+        for playlist_id in playlist_ids[offset:offset + limit]:
+            playlist = self.playlists[playlist_id]
+            items.append(dict(playlist['playlist'], tracks={'total': len(playlist['track_ids'])}))
+        next_offset = offset + limit
+        body = {
+            'items': items,
+            'limit': limit,
+            'offset': offset,
+            'total': len(playlist_ids),
+            'next': (f'https://api.spotify.com/v1/me/playlists?offset={next_offset}&limit={limit}'
+                     if next_offset < len(playlist_ids) else None)
+        }
+
+        # The page's ETag is derived from its contents, so unchanged pages can be revalidated
+        etag = f'"{hash(json.dumps(body, sort_keys=True)) & 0xffffffff:08x}"'
+        if request.headers.get('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+        return 200, body, {'ETag': etag}
+
+    def _response(self, request, status, body, headers):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        response = Response()
+        response.status_code = status
+        response._content = content
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response.headers['Content-Length'] = str(len(content))
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = {200: 'OK', 304: 'Not Modified', 404: 'Not Found', 429: 'Too Many Requests'}.get(status, '')
+
+        # Let http_client count the body as wire bytes
+        response.raw = io.BytesIO(content)
+        response.raw.seek(0, io.SEEK_END)
+        return response
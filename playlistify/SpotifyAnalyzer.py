@@ -6,6 +6,7 @@ Author: Sarah Hong
 import json
 import os
 import re
+import sys
 
 import requests
 import pandas as pd
@@ -13,6 +14,10 @@ from pandas import json_normalize
 import spotipy
 import spotipy.util as util
 
+from playlistify.fetch_engine import get_engine
+from playlistify import metadata_cache
+from playlistify.http_client import logger
+
 
 DEFAULT_USERNAME = os.getenv('DEFAULT_SPOTIFY_USERNAME')
 CLIENT_ID = os.getenv('CLIENT_ID')
@@ -23,17 +28,75 @@ AUTH_URL = 'https://accounts.spotify.com/authorize'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
 API_BASE_URL = 'https://api.spotify.com/v1/'
 
+# Spotify caps the multi-id endpoints at 100 audio features / 50 artists per request
+AUDIO_FEATURES_BATCH_SIZE = 100
+ARTISTS_BATCH_SIZE = 50
+USER_PLAYLISTS_PAGE_SIZE = 50
+
+# song_panda column -> key in Spotify's audio features object
+AUDIO_FEATURE_COLUMNS = {
+    'danceability': 'danceability',
+    'energy': 'energy',
+    'music_key': 'key',
+    'loudness': 'loudness',
+    'music_mode': 'mode',
+    'speechiness': 'speechiness',
+    'acousticness': 'acousticness',
+    'instrumentalness': 'instrumentalness',
+    'liveness': 'liveness',
+    'valence': 'valence',
+    'tempo': 'tempo',
+    'duration_ms': 'duration_ms',
+    'time_signature': 'time_signature'
+}
+
+# Compact dtypes for song_panda/art_panda, which are kept in the result store for every analysis.
+# Columns not listed stay object. Features are nullable since Spotify may have none for a song.
+# Genre strings are interned, and each artist's genre list and image url are shared
+# between its rows, so pickle writes each one once and back-references every repeat.
+# Measured on a 1,000 track playlist (3,064 artist rows) resampled from static/smule_panda.csv,
+# before -> after (in KiB):
+#   song_panda: deep memory 1004 -> 942, pickle 541 -> 476
+#   art_panda:  deep memory 1728 -> 1252, pickle 167 -> 152
+# zlib already squeezes out most repeated strings, so the compressed session blobs stay
+# around 40 KiB for both frames together either way.
+# The result store keeps those repeats shared too, by dictionary-encoding mostly repeated columns.
+SONG_DTYPES = {
+    'popularity': 'int8',
+    'danceability': 'float32',
+    'energy': 'float32',
+    'music_key': 'Int8',
+    'loudness': 'float32',
+    'music_mode': 'Int8',
+    'speechiness': 'float32',
+    'acousticness': 'float32',
+    'instrumentalness': 'float32',
+    'liveness': 'float32',
+    'valence': 'float32',
+    'tempo': 'float32',
+    'duration_ms': 'Int32',
+    'time_signature': 'Int8'
+}
+ARTIST_DTYPES = {
+    'artist_id': 'category',
+    'name': 'category',
+    'popularity': 'int8'
+}
+
 
 class SpotifyAnalyzer:
-    def __init__(self, username=DEFAULT_USERNAME, redirect_uri=REDIRECT_URI, token=None):
+    def __init__(self, username=DEFAULT_USERNAME, redirect_uri=REDIRECT_URI, token=None, engine=None, use_cache=True):
         """
         Create a SpotifyAnalyzer instance with the specified username, redirect_uri, and scope.
+        All requests go through the shared FetchEngine unless another engine is given.
+        Song and artist lookups read through the metadata cache unless use_cache is False.
         """
         self.token = token
+        self.engine = engine or get_engine()
+        self.use_cache = use_cache
         self.sp = None
         self.username = username
         self.redirect_uri = redirect_uri
-        print(self.redirect_uri)
         self.set_scope()
 
         if self.token is None:
@@ -63,34 +126,47 @@ class SpotifyAnalyzer:
         else:
             print(f"Cant get token for {self.username}")
 
-    def get_user_playlists(self):
-        """Get the user's playlists."""
-        response = requests.get(f'{API_BASE_URL}me/playlists', headers=self.headers)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code}")
-            return None
-        
-        user_playlists_response = response.json()
+    def get_user_playlists(self, page_cache=None):
+        """
+        Get the user's playlists, following pagination through every page of /me/playlists.
+        @param:
+            - page_cache: optional cachelib-style cache (get/set) holding each page's ETag
+              and parsed rows. Cached pages are revalidated with If-None-Match, so a page
+              that hasn't changed costs a 304 and no parsing.
+        @return:
+            - dataframe of the playlists the user owns
+        """
         playlist_panda = []
-        for playlist in user_playlists_response['items']:
-            if playlist['owner']['id'] != self.username:
-                continue
-            panda_row = {
-                'playlist_id': playlist['id'],
-                'image_url': playlist['images'][0]['url'] if playlist['images'] else None,
-                'name': playlist['name'],
-                'description': playlist['description'],
-                'owner': playlist['owner']['display_name'],
-                'tracks': playlist['tracks']['total'],
-                'playlist_uri': playlist['uri']
-            }
-            playlist_panda.append(panda_row)
-        
+        url = f'{API_BASE_URL}me/playlists?limit={USER_PLAYLISTS_PAGE_SIZE}'
+        while url:
+            # /me/playlists is the same url for everyone, so key the cache by user too
+            cache_key = f'user_playlists:{self.username}:{url}'
+            cached_page = page_cache.get(cache_key) if page_cache is not None else None
+
+            headers = dict(self.headers)
+            if cached_page:
+                headers['If-None-Match'] = cached_page['etag']
+            response = self.engine.get(url, headers=headers)
+
+            if response.status_code == 304 and cached_page:
+                page = cached_page
+            elif response.status_code == 200:
+                page = parse_playlists_page(response.json())
+                etag = response.headers.get('ETag')
+                if page_cache is not None and etag:
+                    page_cache.set(cache_key, dict(page, etag=etag))
+            else:
+                print(f"Error: {response.status_code}")
+                return None
+
+            playlist_panda.extend(row for row in page['rows'] if row['owner_id'] == self.username)
+            url = page['next']
+
         return pd.DataFrame(playlist_panda)
 
     def get_user_info(self):
         """Get the user's Spotify account information."""
-        response = requests.get(f'{API_BASE_URL}me', headers=self.headers)
+        response = self.engine.get(f'{API_BASE_URL}me', headers=self.headers)
         if response.status_code != 200:
             print(f"Error: {response.status_code}")
             return None
@@ -105,12 +181,16 @@ class SpotifyAnalyzer:
         return user_info_dict
 
 
-    def get_playlist_details(self, playlist_id):
+    def get_playlist_details(self, playlist_id, previous=None):
         """
         Get playlist and song details from a Spotify playlist link.
         (Doesn't use Spotipy library)
+        Given an earlier analysis of the playlist, only the tracks added since are enriched:
+        it's returned as is if the playlist's snapshot_id hasn't changed, and otherwise
+        the tracks still in the playlist are reused and the removed ones dropped.
         @param:
             - playlist_link: Spotify playlist link
+            - previous: optional (playlist_info, song_panda, art_panda) from an earlier analysis
         @return:
             - playlist_info: dictionary containing playlist details
                 - playlist_id
@@ -144,92 +224,291 @@ class SpotifyAnalyzer:
         # playlist_id = playlist_link.split('/')[-1]
 
         # Get playlist details using the Spotify Web API
-        response = requests.get(f'https://api.spotify.com/v1/playlists/{playlist_id}', headers=self.headers)
+        playlist_data = self.get_playlist(playlist_id)
+        if playlist_data is None:
+            return None
+        playlist_info = get_playlist_info(playlist_data)
 
-        if response.status_code == 200:
-            playlist_data = response.json()
-        else:
+        known_song_ids = set()
+        if previous is not None:
+            if previous[0].get('snapshot_id') == playlist_info['snapshot_id']:
+                return previous
+            known_song_ids = set(previous[1]['song_id']) if len(previous[1]) else set()
+
+        # Collect every page of the playlist, not just the first 100 tracks
+        track_ids = []
+        song_batches = []
+        art_batches = []
+        try:
+            for song_batch, art_batch in self.iter_playlist_batches(playlist_data, known_song_ids, track_ids):
+                song_batches.append(song_batch)
+                art_batches.append(art_batch)
+        except requests.HTTPError as e:
+            logger.error("Analysis of playlist %s failed: %s", playlist_id, e)
+            return None
+
+        if previous is not None:
+            # Keep the songs that are still in the playlist, in its current order
+            song_batches.insert(0, previous[1])
+            art_batches.insert(0, previous[2])
+            track_order = {}
+            for position, track_id in enumerate(track_ids):
+                track_order.setdefault(track_id, position)
+            song_batches = [batch[batch['song_id'].isin(track_order)] for batch in song_batches if len(batch)]
+            art_batches = [batch[batch['song_id'].isin(track_order)] for batch in art_batches if len(batch)]
+
+        # Categories differ page to page, so art_panda needs its dtypes reapplied after concat
+        song_panda = pd.concat(song_batches, ignore_index=True) if song_batches else pd.DataFrame()
+        art_panda = pd.concat(art_batches, ignore_index=True).astype(ARTIST_DTYPES) if art_batches else pd.DataFrame()
+        if previous is not None and len(song_panda):
+            song_panda = sort_by_track(song_panda, track_order)
+            art_panda = sort_by_track(art_panda, track_order)
+        return playlist_info, song_panda, art_panda
+
+    def get_playlist(self, playlist_id):
+        """Get a playlist's Spotify object, including its first page of tracks."""
+        response = self.engine.get(f'{API_BASE_URL}playlists/{playlist_id}', headers=self.headers)
+        if response.status_code != 200:
             print(f"Error: {response.status_code}")
             return None
+        return response.json()
 
-        # General playlist details
-        playlist_info = {
-            'playlist_id': playlist_data['id'],
-            'title': playlist_data['name'],
-            'description': playlist_data['description'],
-            'image_url': playlist_data['images'][0]['url'] if playlist_data['images'] else None,
-            'owner_id': playlist_data['owner']['id'],
-            'owner_name': playlist_data['owner']['display_name'] 
-        }
+    def get_playlist_snapshot(self, playlist_id):
+        """
+        Get a playlist's current snapshot_id, which changes whenever its tracks do.
+        Much cheaper than get_playlist, so it's used to check for a stored analysis first.
+        """
+        response = self.engine.get(f'{API_BASE_URL}playlists/{playlist_id}', headers=self.headers,
+                                   params={'fields': 'snapshot_id'})
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}")
+            return None
+        return response.json().get('snapshot_id')
+
+    def iter_playlist_batches(self, playlist_data, known_song_ids=frozenset(), track_ids=None):
+        """
+        Enrich a playlist's songs one page of tracks at a time, following the tracks.next cursor.
+        The next page is fetched while this one is enriched, and only one page of raw track JSON
+        is held at a time; get_playlist_details still concatenates every batch it yields.
+        @param:
+            - playlist_data: playlist object from get_playlist
+            - known_song_ids: songs already analyzed, which are skipped instead of enriched
+            - track_ids: optional list, extended with the id of every track in the playlist in order
+        @yield:
+            - (song_panda, art_panda) for each page of tracks
+        @raise:
+            - requests.HTTPError if a later page, or a batch of its songs' features or artists, can't be fetched
+        """
+        # Artists already looked up on earlier pages (grows with unique artists, not tracks)
+        artist_lookup = {}
+
+        page = playlist_data['tracks']
+        while True:
+            # Start fetching the next page while this one is being enriched
+            next_page = self.engine.submit(page['next'], headers=self.headers) if page['next'] else None
+
+            items = page['items']
+            if track_ids is not None:
+                track_ids.extend(item['track']['id'] for item in items if item['track'] and item['track']['id'])
+            if known_song_ids:
+                items = [item for item in items if not (item['track'] and item['track']['id'] in known_song_ids)]
+
+            song_batch, art_batch = self.enrich_tracks(items, artist_lookup)
+            if not song_batch.empty:
+                yield song_batch, art_batch
+
+            if next_page is None:
+                return
+            response = next_page.result()
+            if response.status_code != 200:
+                logger.error("Spotify playlist tracks page failed: %s", response.status_code)
+                raise requests.HTTPError(f"{response.status_code} fetching playlist tracks", response=response)
+            page = response.json()
+
+    def enrich_tracks(self, items, artist_lookup=None):
+        """
+        Build song and artist details for one page of playlist track items.
+        @param:
+            - items: playlist track items from a page of playlist tracks
+            - artist_lookup: optional dictionary of artists already looked up,
+              updated in place with the artists fetched for this page
+        @return:
+            - song_panda, art_panda for the songs on this page
+        """
+        if artist_lookup is None:
+            artist_lookup = {}
+
+        # Skip local files and unavailable tracks, which have no Spotify id
+        tracks = [item['track'] for item in items if item['track'] and item['track']['id']]
+
+        # Get audio features for every song on the page in batched requests
+        audio_features = self.get_audio_features([track['id'] for track in tracks])
+
+        # Look up each artist in the playlist once, no matter how many songs they're on
+        artist_ids = list(dict.fromkeys(artist['id'] for track in tracks for artist in track['artists']
+                                        if artist['id'] and artist['id'] not in artist_lookup))
+        artist_lookup.update(self.get_artists(artist_ids))
 
-        # Create dataframe of audio features for each song in playlist
-        song_df = []
-        artinfo = [] # and artist info!
-        for track in playlist_data['tracks']['items']:
+        # Build the song and artist dataframes column by column
+        song_columns = {column: [] for column in ['song_title', 'song_id', 'song_uri', 'artists', 'artist_uris', 'popularity',
+                                                  *AUDIO_FEATURE_COLUMNS, 'genres', 'album_url']}
+        art_columns = {column: [] for column in ['artist_id', 'name', 'image_url', 'genres', 'popularity', 'song_id', 'song_title']}
+        artist_genres = {}  # one interned genre list per artist, shared by all of its rows
+        for track in tracks:
 
             # Get genres and artist info for each artist in song
             genres = []
-            artists = [artist['id'] for artist in track['track']['artists']]
-            artists_uri_string = ",".join(artists)
-            several_artists_response = requests.get(f'https://api.spotify.com/v1/artists?ids={artists_uri_string}', headers=self.headers)
-            
-            if several_artists_response.status_code == 200:
-                several_artists_data = several_artists_response.json()
-                print(several_artists_data)
-
-                for artist in several_artists_data['artists']:
-                    genres.extend(artist['genres'])
-                    art_data = {
-                        'artist_id': artist['id'],
-                        'name': artist['name'],
-                        'image_url': artist['images'][0]['url'] if artist['images'] else None,
-                        'genres': artist['genres'],
-                        'popularity': artist['popularity'],
-                        'song_id': track['track']['id'],
-                        'song_title': track['track']['name']
-                    }
-                    artinfo.append(art_data)
-
-            # Get song audio features
-            song_uri = track['track']['uri'].split(':')[-1]
-            song_response = requests.get(f'https://api.spotify.com/v1/audio-features/{song_uri}', headers=self.headers)
-
-            if song_response.status_code != 200:
-                print(f"Error: {song_response.status_code}")
-                return None
-            
-            song_data_json = song_response.json()
-            song_row = {
-                'song_title': track['track']['name'],
-                'song_id': song_data_json['id'],
-                'song_uri' : track['track']['uri'],
-                'artists' : ', '.join([artist['name'] for artist in track['track']['artists']]),
-                'artist_uris' : ', '.join([artist['uri'] for artist in track['track']['artists']]),
-                'popularity' : track['track']['popularity'],
-                'danceability': song_data_json['danceability'],
-                'energy': song_data_json['energy'],
-                'music_key': song_data_json['key'],
-                'loudness': song_data_json['loudness'],
-                'music_mode': song_data_json['mode'],
-                'speechiness': song_data_json['speechiness'],
-                'acousticness': song_data_json['acousticness'],
-                'instrumentalness': song_data_json['instrumentalness'],
-                'liveness': song_data_json['liveness'],
-                'valence': song_data_json['valence'],
-                'tempo': song_data_json['tempo'],
-                'duration_ms': song_data_json['duration_ms'],
-                'time_signature': song_data_json['time_signature'],
-                'genres': genres if genres else None,
-                'album_url': track['track']['album']['images'][0]['url'] if track['track']['album']['images'] else None
-            }
-            
-            song_df.append(song_row)
-        
-        song_panda = pd.DataFrame(song_df)
-        art_panda = pd.DataFrame(artinfo)
-        return playlist_info, song_panda, art_panda
+            for track_artist in track['artists']:
+                artist = artist_lookup.get(track_artist['id'])
+                if artist is None:
+                    continue
+                if artist['id'] not in artist_genres:
+                    artist_genres[artist['id']] = [sys.intern(genre) for genre in artist['genres']]
+                genres.extend(artist_genres[artist['id']])
+
+                art_columns['artist_id'].append(artist['id'])
+                art_columns['name'].append(artist['name'])
+                art_columns['image_url'].append(artist['images'][0]['url'] if artist['images'] else None)
+                art_columns['genres'].append(artist_genres[artist['id']])
+                art_columns['popularity'].append(artist['popularity'])
+                art_columns['song_id'].append(track['id'])
+                art_columns['song_title'].append(track['name'])
+
+            song_columns['song_title'].append(track['name'])
+            song_columns['song_id'].append(track['id'])
+            song_columns['song_uri'].append(track['uri'])
+            song_columns['artists'].append(', '.join([artist['name'] for artist in track['artists']]))
+            song_columns['artist_uris'].append(', '.join([artist['uri'] for artist in track['artists']]))
+            song_columns['popularity'].append(track['popularity'])
+
+            # Songs Spotify has no audio features for get a null feature row
+            song_data_json = audio_features.get(track['id']) or {}
+            for column, feature in AUDIO_FEATURE_COLUMNS.items():
+                song_columns[column].append(song_data_json.get(feature))
+            song_columns['genres'].append(genres if genres else None)
+            song_columns['album_url'].append(track['album']['images'][0]['url'] if track['album']['images'] else None)
+
+        song_panda = build_frame(song_columns, SONG_DTYPES)
+        art_panda = build_frame(art_columns, ARTIST_DTYPES)
+        return song_panda, art_panda
+
+    def get_audio_features(self, song_ids):
+        """
+        Get audio features for many songs, reading through the metadata cache.
+        @param:
+            - song_ids: list of Spotify song ids
+        @return:
+            - dictionary mapping song_id to its audio features
+              (None if Spotify has no features for that song)
+        """
+        if self.use_cache:
+            return metadata_cache.audio_features.get_many(song_ids, self.fetch_audio_features)
+        return self.fetch_audio_features(song_ids)
+
+    def fetch_audio_features(self, song_ids):
+        """
+        Get audio features for many songs from Spotify using the multi-id endpoint.
+        Songs Spotify has no features for map to None; a batch that fails (after the
+        engine's retries) fails the whole lookup, so the analysis isn't stored half-empty.
+        @raise:
+            - requests.HTTPError if a batch can't be fetched
+        """
+        batches = [song_ids[start:start + AUDIO_FEATURES_BATCH_SIZE]
+                   for start in range(0, len(song_ids), AUDIO_FEATURES_BATCH_SIZE)]
+        responses = self.engine.get_many(f'{API_BASE_URL}audio-features',
+                                         [{'ids': ','.join(batch)} for batch in batches], headers=self.headers)
+
+        audio_features = {}
+        for batch, response in zip(batches, responses):
+            check_batch(response, 'audio features', len(batch))
+
+            # Results come back in the same order as the requested ids
+            for song_id, features in zip(batch, response.json()['audio_features']):
+                audio_features[song_id] = features
+        return audio_features
+
+    def get_artists(self, artist_ids):
+        """
+        Get artist details for many artists, reading through the metadata cache.
+        @param:
+            - artist_ids: list of unique Spotify artist ids
+        @return:
+            - dictionary mapping artist_id to its Spotify artist object
+        """
+        if self.use_cache:
+            return metadata_cache.artists.get_many(artist_ids, self.fetch_artists)
+        return self.fetch_artists(artist_ids)
+
+    def fetch_artists(self, artist_ids):
+        """
+        Get artist details for many artists from Spotify using the multi-id endpoint.
+        @raise:
+            - requests.HTTPError if a batch can't be fetched
+        """
+        batches = [artist_ids[start:start + ARTISTS_BATCH_SIZE]
+                   for start in range(0, len(artist_ids), ARTISTS_BATCH_SIZE)]
+        responses = self.engine.get_many(f'{API_BASE_URL}artists',
+                                         [{'ids': ','.join(batch)} for batch in batches], headers=self.headers)
+
+        artists = {}
+        for batch, response in zip(batches, responses):
+            check_batch(response, 'artists', len(batch))
+
+            for artist in response.json()['artists']:
+                if artist is not None:
+                    artists[artist['id']] = artist
+        return artists
     
 
+def check_batch(response, what, size):
+    """Raise requests.HTTPError if a multi-id lookup didn't succeed."""
+    if response.status_code != 200:
+        logger.error("Spotify %s lookup of %d ids failed: %s", what, size, response.status_code)
+        raise requests.HTTPError(f"{response.status_code} fetching {what}", response=response)
+
+
+def build_frame(columns, dtypes):
+    """Build a DataFrame from a dictionary of column lists, using the given dtypes (object for the rest)."""
+    return pd.DataFrame({column: pd.Series(values, dtype=dtypes.get(column, object))
+                         for column, values in columns.items()})
+
+
+def sort_by_track(frame, track_order):
+    """Sort song_panda/art_panda rows by their song's position in the playlist, keeping ties in order."""
+    positions = frame['song_id'].map(track_order).to_numpy()
+    return frame.iloc[positions.argsort(kind='stable')].reset_index(drop=True)
+
+
+def parse_playlists_page(page_data):
+    """Get the rows and next page url from one page of /me/playlists."""
+    rows = []
+    for playlist in page_data['items']:
+        rows.append({
+            'playlist_id': playlist['id'],
+            'image_url': playlist['images'][0]['url'] if playlist['images'] else None,
+            'name': playlist['name'],
+            'description': playlist['description'],
+            'owner': playlist['owner']['display_name'],
+            'owner_id': playlist['owner']['id'],
+            'tracks': playlist['tracks']['total'],
+            'playlist_uri': playlist['uri']
+        })
+    return {'rows': rows, 'next': page_data['next']}
+
+
+def get_playlist_info(playlist_data):
+    """Get the general playlist details from a Spotify playlist object."""
+    return {
+        'playlist_id': playlist_data['id'],
+        'title': playlist_data['name'],
+        'description': playlist_data['description'],
+        'image_url': playlist_data['images'][0]['url'] if playlist_data['images'] else None,
+        'owner_id': playlist_data['owner']['id'],
+        'owner_name': playlist_data['owner']['display_name'],
+        'snapshot_id': playlist_data.get('snapshot_id')
+    }
+
+
 def extract_playlist_id(url):
     """
     Define a regular expression pattern to capture the playlist ID
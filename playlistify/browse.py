@@ -0,0 +1,187 @@
+"""
+Pages of the playlists and songs /filter_genres shows, fetched with keyset cursors.
+
+Every page is ordered by a key that's unique to each row, and the cursor of its last
+row is handed back with it. The next page is the rows after that key, which the
+database seeks to in an index instead of counting past the earlier pages, so
+"load more" costs the same however far down the list it is.
+Pages are a default size, and never more than MAX_PAGE_ROWS rows whatever is asked for.
+
+    - playlists: newest upload first, keyed by (date_uploaded, playlist_id, user_id)
+    - songs of some genres: one row per upload of a playlist with the song,
+      newest upload first, keyed by (date_uploaded, playlist_id, user_id, song_id)
+    - top songs (no genres): one row per song, in the most playlists first,
+      keyed by (playlist count, song_id)
+"""
+
+import base64
+import binascii
+import json
+
+from sqlalchemy import text
+
+
+PLAYLIST_PAGE_SIZE = 24
+SONG_PAGE_SIZE = 20
+MAX_PAGE_ROWS = 100
+
+# Uploads with no date sort last; the cursor carries the value as text so '-infinity' round-trips
+UPLOADED = "COALESCE(HasPlaylist.date_uploaded, '-infinity')"
+
+PLAYLISTS_QUERY = f"""
+    SELECT Users.name, Users.image_url, Playlist.playlist_id, Playlist.image_url, Playlist.title, Playlist.description,
+    {{genres}} AS genres,
+    CAST({UPLOADED} AS TEXT) AS uploaded, HasPlaylist.playlist_id, HasPlaylist.user_id
+    FROM HasPlaylist
+    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+    INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
+    WHERE {{where}}
+    {{after}}
+    ORDER BY {UPLOADED} DESC, HasPlaylist.playlist_id DESC, HasPlaylist.user_id DESC
+    LIMIT :limit
+"""
+PLAYLISTS_AFTER = f"""
+    AND ({UPLOADED}, HasPlaylist.playlist_id, HasPlaylist.user_id)
+    < (CAST(:uploaded AS TIMESTAMP), :playlist_id, :user_id)
+"""
+
+# Playlists with any of the genres, each with those genres and its top genres,
+# looked up in PlaylistGenreSummary (see genre_summary.py)
+GENRE_PLAYLISTS = {
+    'genres': """
+        ARRAY(
+            SELECT DISTINCT genre FROM UNNEST(
+                ARRAY(
+                    SELECT genre FROM PlaylistGenreSummary
+                    WHERE PlaylistGenreSummary.playlist_id = Playlist.playlist_id AND genre = ANY(:genres)
+                ) || COALESCE(Playlist.top_genres, '{}')
+            ) AS genre
+        )
+    """,
+    'where': """
+        EXISTS (
+            SELECT 1 FROM PlaylistGenreSummary
+            WHERE PlaylistGenreSummary.playlist_id = HasPlaylist.playlist_id AND genre = ANY(:genres)
+        )
+    """
+}
+ALL_PLAYLISTS = {'genres': "COALESCE(Playlist.top_genres, '{}')", 'where': 'TRUE'}
+
+# Songs with any of the genres, found through the genre index (see genre_index.py)
+GENRE_SONGS_QUERY = f"""
+    SELECT Song.title, Song.album_url, ARRAY(
+        SELECT Artist.name FROM SongArtist
+        INNER JOIN Artist ON SongArtist.artist_id = Artist.artist_id
+        WHERE SongArtist.song_id = Song.song_id
+    ) AS artists, Song.genres, PlaylistSong.playlist_id, Users.name,
+    CAST({UPLOADED} AS TEXT) AS uploaded, HasPlaylist.playlist_id, HasPlaylist.user_id, Song.song_id
+    FROM HasPlaylist
+    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+    INNER JOIN PlaylistSong ON PlaylistSong.playlist_id = HasPlaylist.playlist_id
+    INNER JOIN Song ON Song.song_id = PlaylistSong.song_id
+    WHERE EXISTS (
+        SELECT 1 FROM SongGenre
+        INNER JOIN Genre ON Genre.genre_id = SongGenre.genre_id
+        WHERE SongGenre.song_id = Song.song_id AND Genre.name = ANY(:genres)
+    )
+    {{after}}
+    ORDER BY {UPLOADED} DESC, HasPlaylist.playlist_id DESC, HasPlaylist.user_id DESC, Song.song_id DESC
+    LIMIT :limit
+"""
+GENRE_SONGS_AFTER = f"""
+    AND ({UPLOADED}, HasPlaylist.playlist_id, HasPlaylist.user_id, Song.song_id)
+    < (CAST(:uploaded AS TIMESTAMP), :playlist_id, :user_id, :song_id)
+"""
+
+# Songs in the most playlists; a song's playlists may have different uploaders, so there's no one playlist or user
+# (counted in SongPlaylistCount; see song_playlist_counts.py)
+TOP_SONGS_QUERY = """
+    SELECT Song.title, Song.album_url, ARRAY(
+        SELECT Artist.name FROM SongArtist
+        INNER JOIN Artist ON SongArtist.artist_id = Artist.artist_id
+        WHERE SongArtist.song_id = Song.song_id
+    ) AS artists, Song.genres, NULL AS playlist_id, NULL AS user_name,
+    SongPlaylistCount.playlist_count, Song.song_id
+    FROM SongPlaylistCount
+    INNER JOIN Song ON Song.song_id = SongPlaylistCount.song_id
+    {after}
+    ORDER BY SongPlaylistCount.playlist_count DESC, SongPlaylistCount.song_id DESC
+    LIMIT :limit
+"""
+TOP_SONGS_AFTER = "WHERE (SongPlaylistCount.playlist_count, SongPlaylistCount.song_id) < (:playlist_count, :song_id)"
+
+
+def _keyset_queries(query, after, **parts):
+    """The first page and next page versions of a query."""
+    return text(query.format(after='', **parts)), text(query.format(after=after, **parts))
+
+
+PAGE_QUERIES = {
+    ('playlists', True): _keyset_queries(PLAYLISTS_QUERY, PLAYLISTS_AFTER, **GENRE_PLAYLISTS),
+    ('playlists', False): _keyset_queries(PLAYLISTS_QUERY, PLAYLISTS_AFTER, **ALL_PLAYLISTS),
+    ('songs', True): _keyset_queries(GENRE_SONGS_QUERY, GENRE_SONGS_AFTER),
+    ('songs', False): _keyset_queries(TOP_SONGS_QUERY, TOP_SONGS_AFTER)
+}
+# The names of the key columns at the end of each query's rows, in cursor order
+CURSOR_KEYS = {
+    ('playlists', True): ['uploaded', 'playlist_id', 'user_id'],
+    ('playlists', False): ['uploaded', 'playlist_id', 'user_id'],
+    ('songs', True): ['uploaded', 'playlist_id', 'user_id', 'song_id'],
+    ('songs', False): ['playlist_count', 'song_id']
+}
+PAGE_SIZES = {'playlists': PLAYLIST_PAGE_SIZE, 'songs': SONG_PAGE_SIZE}
+
+
+def encode_cursor(values):
+    """An opaque, URL-safe cursor for a row's key."""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor, length):
+    """
+    The key a cursor was made from.
+    @return:
+        - list of length key values, or None if the cursor isn't one of ours
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    if not all(isinstance(value, (str, int)) and not isinstance(value, bool) for value in values):
+        return None
+    return values
+
+
+def fetch_page(conn, kind, genres=None, after=None, page_size=None):
+    """
+    Get a page of playlists or songs, optionally only those with any of some genres.
+    @param:
+        - kind: 'playlists' or 'songs'
+        - after: cursor of the last row of the previous page (None for the first page)
+        - page_size: rows to return, capped at MAX_PAGE_ROWS (defaults to the kind's page size)
+    @return:
+        - (list of rows without their key columns, cursor of the next page or None if this is the last)
+        - or None if after isn't a valid cursor
+    """
+    key = (kind, bool(genres))
+    keys = CURSOR_KEYS[key]
+    page_size = max(1, min(page_size or PAGE_SIZES[kind], MAX_PAGE_ROWS))
+    params = {'genres': genres or [], 'limit': page_size + 1}  # one extra row tells us if there's another page
+    first_page, next_page = PAGE_QUERIES[key]
+    if after is None:
+        query = first_page
+    else:
+        values = decode_cursor(after, len(keys))
+        if values is None:
+            return None
+        params.update(zip(keys, values))
+        query = next_page
+
+    rows = conn.execute(query, params).fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(list(rows[-1][-len(keys):]))
+    return [row[:-len(keys)] for row in rows], next_cursor
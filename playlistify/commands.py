@@ -0,0 +1,107 @@
+"""
+Command line tools for maintaining the Playlistify database.
+Run with: flask --app playlistify <command>
+"""
+
+import glob
+import os
+
+import click
+from sqlalchemy import text
+
+from playlistify.db_config import my_engine, NO_STATEMENT_TIMEOUT
+from playlistify.ingest import ingest_file, INGEST_WORKERS
+from playlistify.copy_loader import load_dumps, SEED_WORKERS, CHUNK_ROWS
+from playlistify import jobs, genre_summary, ratings, playlist_features, song_playlist_counts
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+
+@click.command('migrate')
+def migrate():
+    """Apply any SQL files in playlistify/migrations that haven't been applied yet."""
+    with my_engine.connect() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                filename TEXT PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """))
+        conn.commit()
+        applied = {row[0] for row in conn.execute(text("SELECT filename FROM schema_migrations"))}
+
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql'))):
+            filename = os.path.basename(path)
+            if filename in applied:
+                continue
+            conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+            with open(path) as f:
+                # Straight to the DBAPI cursor: with no parameters, psycopg2 leaves % in the SQL alone
+                conn.connection.cursor().execute(f.read())
+            conn.execute(text("INSERT INTO schema_migrations (filename) VALUES (:filename)"), {'filename': filename})
+            conn.commit()
+            click.echo(f'applied migration: {filename}')
+
+
+@click.command('ingest')
+@click.argument('playlist_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=INGEST_WORKERS, show_default=True, help='Playlists to ingest at once.')
+@click.option('--journal', 'journal_path', default=None,
+              help='Progress journal to resume from (defaults to PLAYLIST_FILE.journal).')
+@click.option('--token', default=None, help='Spotify access token (defaults to a client-credentials token).')
+@click.option('--report-every', default=25, show_default=True, help='Print throughput every N playlists.')
+def ingest_command(playlist_file, workers, journal_path, token, report_every):
+    """Analyze every playlist link or id in PLAYLIST_FILE and write them to the database."""
+    ingest_file(playlist_file, workers=workers, journal_path=journal_path, token=token, report_every=report_every)
+
+
+@click.command('seed')
+@click.argument('dump_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=SEED_WORKERS, show_default=True, help='Processes parsing chunks at once.')
+@click.option('--chunk-rows', default=CHUNK_ROWS, show_default=True, help='Rows per parsed chunk.')
+@click.option('--on-conflict', type=click.Choice(['skip', 'update']), default='skip', show_default=True,
+              help='Keep rows already in the database, or overwrite them with the dump.')
+def seed(dump_files, workers, chunk_rows, on_conflict):
+    """COPY *_SQL.csv catalog dumps (optionally .gz) into the database (defaults to the ones in static/)."""
+    load_dumps(list(dump_files), workers=workers, chunk_rows=chunk_rows, on_conflict=on_conflict)
+
+
+@click.command('worker')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty instead of waiting for more jobs.')
+def worker(burst):
+    """Run queued playlist uploads (JOBS_URL, defaulting to SQLite in the instance folder)."""
+    jobs_run = jobs.work(jobs.get_queue(inline_worker=False), burst=burst)
+    click.echo(f'ran {jobs_run} jobs')
+
+
+@click.command('rebuild-genre-summary')
+def rebuild_genre_summary():
+    """Recount every playlist's genres and top genres from its songs (to backfill or repair the summary)."""
+    with my_engine.connect() as conn:
+        rows = genre_summary.rebuild(conn)
+    click.echo(f'rebuilt genre summary: {rows} playlist genres')
+
+
+@click.command('rebuild-ratings')
+def rebuild_ratings():
+    """Recount every playlist's rating aggregates from Rate (to backfill or repair them)."""
+    with my_engine.connect() as conn:
+        rows = ratings.rebuild(conn)
+    click.echo(f'rebuilt rating aggregates: {rows} rated playlists')
+
+
+@click.command('rebuild-playlist-features')
+def rebuild_playlist_features():
+    """Recompute every playlist's feature means and deviations from its songs (to backfill or repair them)."""
+    with my_engine.connect() as conn:
+        rows = playlist_features.rebuild(conn)
+    click.echo(f'rebuilt playlist features: {rows} playlists')
+
+
+@click.command('rebuild-song-playlist-counts')
+def rebuild_song_playlist_counts():
+    """Recount how many playlists every song is in from PlaylistSong (to backfill or repair the counts)."""
+    with my_engine.connect() as conn:
+        rows = song_playlist_counts.rebuild(conn)
+    click.echo(f'rebuilt song playlist counts: {rows} songs')
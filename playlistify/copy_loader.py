@@ -0,0 +1,248 @@
+"""
+Bulk loader for catalog dumps in the *_SQL.csv format (see playlists_SQL.csv,
+artists_SQL.csv and "tiger talk_songs_SQL.csv" in playlistify/static/).
+Dumps are in the shape of our tables, with features as a 13-tuple string
+and genres as a Python list string.
+
+Each file is streamed in chunks of rows. A pool of processes converts the chunks
+to COPY text in parallel while the main process COPYs the converted chunks into
+a temporary staging table. The staging table is then merged into the real table
+with ON CONFLICT and the genre index updated, all in one transaction per file.
+
+Run with: flask --app playlistify seed [FILES]...
+"""
+
+import ast
+import csv
+import gzip
+import io
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from playlistify.db_config import my_engine, NO_STATEMENT_TIMEOUT
+from playlistify.genre_index import relink_statements, intern_genres_statement
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+DEFAULT_DUMPS = [
+    os.path.join(STATIC_DIR, 'playlists_SQL.csv'),
+    os.path.join(STATIC_DIR, 'artists_SQL.csv'),
+    os.path.join(STATIC_DIR, 'tiger talk_songs_SQL.csv')
+]
+
+CHUNK_ROWS = int(os.getenv('SEED_CHUNK_ROWS', 20000))
+SEED_WORKERS = int(os.getenv('SEED_WORKERS', os.cpu_count() or 2))
+FEATURE_COUNT = 13
+MAX_REPORTED_REJECTS = 10
+
+# Descriptions can be long
+csv.field_size_limit(sys.maxsize)
+
+
+def text_value(value):
+    return value
+
+
+def integer_value(value):
+    return str(int(float(value))) if value != '' else None
+
+
+def genres_array(value):
+    """
+    "['hip hop', 'rap']" -> '{{"hip hop","rap"}}'
+    Genres are stored the way ARRAY[:genres] stores them, as a 2D array
+    (an empty list is ARRAY[NULL]), so the genre routes read them the same.
+    """
+    if value == '':
+        return None
+    genres = ast.literal_eval(value)
+    if not isinstance(genres, (list, tuple)):
+        raise ValueError(f'genres is not a list: {value!r}')
+    if not genres:
+        return '{NULL}'
+    elements = ('"' + str(genre).replace('\\', '\\\\').replace('"', '\\"') + '"' for genre in genres)
+    return '{{' + ','.join(elements) + '}}'
+
+
+def features_composite(value):
+    """"(0.15, 0.499, 188997, ...)" -> '(0.15,0.499,188997,...)', checking it has every feature."""
+    if value == '':
+        return None
+    features = [feature.strip() for feature in value.strip().strip('()').split(',')]
+    if len(features) != FEATURE_COUNT:
+        raise ValueError(f'expected {FEATURE_COUNT} features, got {len(features)}')
+    for feature in features:
+        float(feature)
+    return '(' + ','.join(features) + ')'
+
+
+# Dump formats, recognized by their key column.
+# Columns are loaded in this order; columns missing from a dump are left NULL and extra ones are ignored.
+DUMP_FORMATS = {
+    'playlist': {
+        'table': 'Playlist',
+        'key': 'playlist_id',
+        'columns': {'playlist_id': text_value, 'title': text_value, 'image_url': text_value, 'description': text_value}
+    },
+    'artist': {
+        'table': 'Artist',
+        'key': 'artist_id',
+        'columns': {'artist_id': text_value, 'name': text_value, 'image_url': text_value,
+                    'popularity': integer_value, 'genres': genres_array}
+    },
+    'song': {
+        'table': 'Song',
+        'key': 'song_id',
+        'columns': {'song_id': text_value, 'title': text_value, 'features': features_composite,
+                    'popularity': integer_value, 'genres': genres_array, 'album_url': text_value}
+    }
+}
+
+
+def detect_format(header):
+    """Get the name of the dump format a CSV header belongs to."""
+    for name, dump_format in DUMP_FORMATS.items():
+        if dump_format['key'] in header:
+            return name
+    raise ValueError(f'unrecognized dump columns: {header}')
+
+
+def copy_escape(value):
+    """Escape a value for COPY's text format (None is \\N)."""
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def convert_chunk(format_name, header, rows):
+    """
+    Convert a chunk of CSV rows to COPY text. Runs in a worker process.
+    @return:
+        - (COPY text, number of rows converted, list of (row, error) for rows that were rejected)
+    """
+    columns = DUMP_FORMATS[format_name]['columns']
+    indexes = [(header.index(column), convert) for column, convert in columns.items() if column in header]
+    lines = []
+    rejects = []
+    for row in rows:
+        try:
+            values = [convert(row[index]) for index, convert in indexes]
+        except (ValueError, SyntaxError, IndexError) as e:
+            rejects.append((row, str(e)))
+            continue
+        lines.append('\t'.join(copy_escape(value) for value in values))
+    return ('\n'.join(lines) + '\n' if lines else ''), len(lines), rejects
+
+
+def read_chunks(f, chunk_rows):
+    """Yield lists of chunk_rows parsed CSV rows (quoted newlines and all)."""
+    chunk = []
+    for row in csv.reader(f):
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def open_dump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='', encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
+
+
+def load_dump(path, executor, workers, chunk_rows=CHUNK_ROWS, on_conflict='skip'):
+    """
+    COPY one dump file into its table.
+    @param:
+        - executor: process pool that converts chunks
+        - workers: how many chunks to have converting at once
+        - on_conflict: 'skip' keeps rows already in the table, 'update' overwrites them with the dump
+    @return:
+        - (rows read, rows merged into the table, rows rejected)
+    """
+    with open_dump(path) as f:
+        header = next(csv.reader(f))
+        format_name = detect_format(header)
+        dump_format = DUMP_FORMATS[format_name]
+        columns = [column for column in dump_format['columns'] if column in header]
+        table, key = dump_format['table'], dump_format['key']
+        staging = f'staging_{table.lower()}'
+
+        column_list = ', '.join(columns)
+        if on_conflict == 'update':
+            updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column != key)
+            conflict = f'ON CONFLICT ({key}) DO UPDATE SET {updates}'
+        else:
+            conflict = f'ON CONFLICT ({key}) DO NOTHING'
+
+        conn = my_engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(NO_STATEMENT_TIMEOUT)
+            cursor.execute(f'CREATE TEMP TABLE {staging} (LIKE {table}) ON COMMIT DROP')
+            copy_sql = f'COPY {staging} ({column_list}) FROM STDIN'
+
+            rows_read = 0
+            rejected = 0
+            pending = deque()
+
+            def copy_next():
+                nonlocal rows_read, rejected
+                copy_text, converted, rejects = pending.popleft().result()
+                if copy_text:
+                    cursor.copy_expert(copy_sql, io.StringIO(copy_text))
+                rows_read += converted + len(rejects)
+                for row, error in rejects[:max(0, MAX_REPORTED_REJECTS - rejected)]:
+                    print(f"Rejected row in {os.path.basename(path)} ({error}): {row}")
+                rejected += len(rejects)
+
+            # Keep a bounded number of chunks converting while earlier ones are COPYed
+            for chunk in read_chunks(f, chunk_rows):
+                pending.append(executor.submit(convert_chunk, format_name, header, chunk))
+                if len(pending) >= workers * 2:
+                    copy_next()
+            while pending:
+                copy_next()
+
+            # A dump can repeat a key; keep the last copy of each
+            cursor.execute(f"""
+                INSERT INTO {table} ({column_list})
+                SELECT DISTINCT ON ({key}) {column_list} FROM {staging}
+                ORDER BY {key}, ctid DESC
+                {conflict}
+            """)
+            merged = cursor.rowcount
+
+            # Keep the genre index in line with the dump's songs, and intern its artists' genres
+            if table == 'Song' and 'genres' in columns:
+                for statement in relink_statements(f'SELECT song_id FROM {staging}'):
+                    cursor.execute(statement)
+            elif 'genres' in columns:
+                cursor.execute(intern_genres_statement(f'SELECT genres FROM {staging}'))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    return rows_read, merged, rejected
+
+
+def load_dumps(paths=None, workers=SEED_WORKERS, chunk_rows=CHUNK_ROWS, on_conflict='skip'):
+    """
+    Load dump files in order, each in its own transaction.
+    Defaults to the dumps in playlistify/static/.
+    """
+    paths = paths or DEFAULT_DUMPS
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path in paths:
+            start = time.monotonic()
+            rows_read, merged, rejected = load_dump(path, executor, workers, chunk_rows, on_conflict)
+            elapsed = time.monotonic() - start
+            print(f"{os.path.basename(path)}: {rows_read} rows read, {merged} merged, {rejected} rejected "
+                  f"in {elapsed:.1f}s ({rows_read / max(elapsed, 1e-9):.0f} rows/s)")
@@ -1,13 +1,96 @@
+"""
+The one database engine for the app, its blueprints, jobs and command line tools.
+Pool sizing, pre-ping and the per-statement timeout are configured from the environment:
+    DB_POOL_SIZE             connections kept open (default 5)
+    DB_MAX_OVERFLOW          extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a connection before giving up (default 30)
+    DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_STATEMENT_TIMEOUT_MS  server-side limit on any one statement (default 30000, 0 = none)
+    DB_QUERY_CACHE_SIZE      compiled statements SQLAlchemy keeps cached (default 500)
+pool_stats() reports checked out connections, overflow and how long checkouts waited,
+to size the pool for the number of web/job/ingest workers.
+"""
+
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import NullPool
-import psycopg2
+import threading
+import time
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import QueuePool
 
 DB_USERNAME = os.getenv('DATABASE_USERNAME')
 DB_PASSWORD = os.getenv('DATABASE_PASSWORD')
 DB_HOST = os.getenv('DATABASE_HOST')
 DATABASE_URI = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/proj1part2"
 
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+POOL_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000))
+QUERY_CACHE_SIZE = int(os.getenv('DB_QUERY_CACHE_SIZE', 500))
+
+# Bulk loads and migrations run for longer than a web request should;
+# run this at the start of their transaction to lift the statement timeout
+NO_STATEMENT_TIMEOUT = "SET LOCAL statement_timeout = 0"
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that also records how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self._waits = {'checkouts': 0, 'timeouts': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0}
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait_ms = (time.perf_counter() - start) * 1000
+            with self._wait_lock:
+                self._waits['checkouts'] += 1
+                self._waits['timeouts'] += timed_out
+                self._waits['total_wait_ms'] += wait_ms
+                self._waits['max_wait_ms'] = max(self._waits['max_wait_ms'], wait_ms)
+
+    def wait_stats(self):
+        with self._wait_lock:
+            waits = dict(self._waits)
+        waits['avg_wait_ms'] = round(waits['total_wait_ms'] / waits['checkouts'], 3) if waits['checkouts'] else None
+        waits['total_wait_ms'] = round(waits['total_wait_ms'], 3)
+        waits['max_wait_ms'] = round(waits['max_wait_ms'], 3)
+        return waits
+
+
 # Create a database engine that knows how to connect to the URI above.
-my_engine = create_engine(DATABASE_URI)
+my_engine = create_engine(
+    DATABASE_URI,
+    poolclass=MeteredQueuePool,
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=True,  # replace connections the server has dropped instead of failing the request
+    query_cache_size=QUERY_CACHE_SIZE,
+    connect_args={'options': f'-c statement_timeout={STATEMENT_TIMEOUT_MS}'}
+)
+
 
+def pool_stats():
+    """Connection pool usage: checked out/in connections, overflow in use, and checkout wait times."""
+    pool = my_engine.pool
+    stats = {
+        'size': pool.size(),
+        'max_overflow': POOL_MAX_OVERFLOW,
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0)
+    }
+    stats.update(pool.wait_stats())
+    return stats
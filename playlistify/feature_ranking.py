@@ -0,0 +1,173 @@
+"""
+In-process index of every playlist's feature means and standard deviations (PlaylistFeatures),
+held as NumPy matrices so /filter_features ranks playlists without going to Song.
+
+A ranking is one or more features with weights. Each feature's column is turned into
+z-scores across the playlists, so features on different scales (tempo, loudness, energy)
+weigh what their weights say, and the weighted sum is the playlist's score.
+The top k are picked with argpartition, which doesn't sort the rest.
+
+The index is loaded from PlaylistFeatures when the app starts (or on first use, if that failed),
+updated with a playlist's new row whenever this process writes its songs (persist_playlist),
+and reloaded in the background once it's FEATURE_INDEX_REFRESH seconds old, to pick up
+playlists written by other processes such as the upload worker.
+"""
+
+import os
+import threading
+
+import numpy as np
+from sqlalchemy import text
+
+from playlistify.db_config import my_engine
+from playlistify.playlist_features import FEATURE_FIELDS
+from playlistify.reloading_index import ReloadingIndex
+
+
+FEATURE_INDEX_REFRESH = int(os.getenv('FEATURE_INDEX_REFRESH', 60))
+RANKED_PLAYLISTS = 10
+MAX_RANKED_PLAYLISTS = 100
+STATS = ('mean', 'std')
+
+FEATURE_COLUMNS = {field: i for i, field in enumerate(FEATURE_FIELDS)}
+
+PLAYLIST_FEATURES_QUERY = text("SELECT playlist_id, song_count, means, stds FROM PlaylistFeatures")
+
+
+class PlaylistFeatureIndex:
+    def __init__(self, rows=()):
+        """
+        Create an index over playlists' features.
+        @param:
+            - rows: iterable of (playlist_id, song count, list of feature means, list of feature deviations)
+        """
+        self._lock = threading.Lock()
+        rows = list(rows)
+        self._playlist_ids = [row[0] for row in rows]
+        self._positions = {playlist_id: i for i, playlist_id in enumerate(self._playlist_ids)}
+        self._song_counts = np.array([row[1] for row in rows], dtype=np.int32)
+        shape = (len(rows), len(FEATURE_FIELDS))
+        self._matrices = {
+            'mean': np.array([row[2] for row in rows], dtype=np.float32).reshape(shape),
+            'std': np.array([row[3] for row in rows], dtype=np.float32).reshape(shape)
+        }
+        self._size = len(rows)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _grow(self):
+        """Double the matrices' capacity (rows past _size are unused)."""
+        capacity = max(2 * len(self._song_counts), 16)
+        self._song_counts = np.resize(self._song_counts, capacity)
+        for stat, matrix in self._matrices.items():
+            grown = np.full((capacity, len(FEATURE_FIELDS)), np.nan, dtype=np.float32)
+            grown[:self._size] = matrix[:self._size]
+            self._matrices[stat] = grown
+
+    def update(self, rows):
+        """Set the features of some playlists, adding any the index doesn't have yet."""
+        with self._lock:
+            for playlist_id, song_count, means, stds in rows:
+                i = self._positions.get(playlist_id)
+                if i is None:
+                    if self._size == len(self._song_counts):
+                        self._grow()
+                    i = self._size
+                    self._size += 1
+                    self._playlist_ids.append(playlist_id)
+                    self._positions[playlist_id] = i
+                self._song_counts[i] = song_count
+                self._matrices['mean'][i] = means
+                self._matrices['std'][i] = stds
+            self._columns = {}
+
+    def remove(self, playlist_id):
+        """Drop a playlist from the rankings (its row is left as NaNs, which are never ranked)."""
+        with self._lock:
+            i = self._positions.pop(playlist_id, None)
+            if i is not None:
+                self._song_counts[i] = 0
+                for matrix in self._matrices.values():
+                    matrix[i] = np.nan
+                self._columns = {}
+
+    def _standardized(self, stat, column):
+        """A feature's column as z-scores, and which playlists have it (cached until the next update)."""
+        key = (stat, column)
+        if key not in self._columns:
+            values = self._matrices[stat][:self._size, column]
+            valid = ~np.isnan(values)
+            z = np.zeros(self._size, dtype=np.float32)
+            if valid.any():
+                spread = values[valid].std()
+                z[valid] = (values[valid] - values[valid].mean()) / (spread if spread > 0 else 1)
+            self._columns[key] = (z, valid)
+        return self._columns[key]
+
+    def rank(self, weights, descending=True, k=RANKED_PLAYLISTS, stat='mean'):
+        """
+        The top k playlists by a weighted score of their features.
+        @param:
+            - weights: dictionary of feature name -> weight (negative weights favour low values)
+            - descending: highest scores first, or lowest first
+            - stat: rank by the features' means across each playlist's songs, or their deviations
+        @return:
+            - list of dictionaries of playlist_id, score, song_count and values
+              (dictionary of each weighted feature's mean or deviation), best first
+        """
+        columns = [FEATURE_COLUMNS[feature] for feature in weights]
+        with self._lock:
+            scores = np.zeros(self._size, dtype=np.float32)
+            valid = np.ones(self._size, dtype=bool)
+            for column, weight in zip(columns, weights.values()):
+                z, has_column = self._standardized(stat, column)
+                scores += np.float32(weight) * z
+                valid &= has_column
+
+            keys = np.where(valid, -scores if descending else scores, np.inf)
+            k = min(k, int(valid.sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(keys, k - 1)[:k] if k < self._size else np.arange(self._size)
+            top = top[np.argsort(keys[top], kind='stable')]
+
+            matrix = self._matrices[stat]
+            return [{
+                'playlist_id': self._playlist_ids[i],
+                'score': float(scores[i]),
+                'song_count': int(self._song_counts[i]),
+                'values': {feature: float(matrix[i, column]) for feature, column in zip(weights, columns)}
+            } for i in top]
+
+
+def load_feature_index():
+    """Read every playlist's feature means and deviations into a new PlaylistFeatureIndex."""
+    with my_engine.connect() as conn:
+        return PlaylistFeatureIndex(conn.execute(PLAYLIST_FEATURES_QUERY).fetchall())
+
+
+_feature_index = ReloadingIndex('playlist feature index', load_feature_index, FEATURE_INDEX_REFRESH)
+
+
+def get_feature_index():
+    """Get the process's playlist feature index, loading it on first use (see ReloadingIndex)."""
+    return _feature_index.get()
+
+
+def preload_feature_index():
+    """Load the playlist feature index on a background thread, so the first ranking doesn't wait on it."""
+    _feature_index.preload()
+
+
+def record_playlist_features(playlist_id, row):
+    """
+    Apply a playlist's features this process just committed to PlaylistFeatures, if the index is loaded or loading.
+    @param:
+        - row: the playlist's (playlist_id, song_count, means, stds) row, or None if it has none
+    """
+    if row is None:
+        _feature_index.apply(lambda index: index.remove(playlist_id))
+    else:
+        _feature_index.apply(lambda index: index.update([row]))
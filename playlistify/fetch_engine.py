@@ -0,0 +1,121 @@
+"""
+A concurrent fetch engine for the Spotify Web API.
+Every SpotifyAnalyzer request goes through one shared FetchEngine, which:
+    - caps how many requests are in flight at once across the whole process
+    - retries transient errors (connection errors, 429s and 5xxs) with tenacity
+    - honors Retry-After with a shared backoff, so after a 429 every worker
+      waits out the same window instead of stampeding the API again
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from tenacity import (Retrying, retry_if_exception_type, retry_if_result,
+                      stop_after_attempt, wait_exponential_jitter)
+
+from playlistify import http_client
+
+
+MAX_CONCURRENCY = int(os.getenv('SPOTIFY_MAX_CONCURRENCY', 8))
+MAX_ATTEMPTS = int(os.getenv('SPOTIFY_MAX_ATTEMPTS', 5))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_RETRY_AFTER = 1  # seconds to back off when a 429 has no Retry-After header
+
+
+class FetchEngine:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_attempts=MAX_ATTEMPTS):
+        """
+        Create a FetchEngine that sends at most max_concurrency requests at once
+        and tries each request up to max_attempts times.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='spotify-fetch')
+
+        # Shared rate limit backoff: no request is sent before this time
+        self._backoff_lock = threading.Lock()
+        self._backoff_until = 0.0
+
+    def get(self, url, **kwargs):
+        """
+        GET a url, retrying transient errors.
+        Returns the final response, which may still be an error response once
+        the retries run out. Connection errors are re-raised after the last attempt.
+        """
+        retrying = Retrying(
+            retry=(retry_if_exception_type((requests.ConnectionError, requests.Timeout))
+                   | retry_if_result(lambda response: response.status_code in RETRY_STATUS_CODES)),
+            stop=stop_after_attempt(self.max_attempts),
+            wait=self._wait,
+            retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+        )
+        return retrying(self._send, 'GET', url, **kwargs)
+
+    def submit(self, url, **kwargs):
+        """GET a url in the background. Returns a Future for the response."""
+        return self._executor.submit(self.get, url, **kwargs)
+
+    def get_many(self, url, params_list, **kwargs):
+        """
+        GET the same endpoint once per params dictionary, concurrently.
+        Returns the responses in the same order as params_list.
+        """
+        futures = [self.submit(url, params=params, **kwargs) for params in params_list]
+        return [future.result() for future in futures]
+
+    def _send(self, method, url, **kwargs):
+        """Send one request once the shared backoff has passed and a slot is free."""
+        self._wait_for_backoff()
+        with self._slots:
+            response = http_client.request(method, url, **kwargs)
+
+        if response.status_code == 429:
+            self._back_off(response.headers.get('Retry-After'))
+        return response
+
+    def _wait_for_backoff(self):
+        """Sleep until the shared rate limit backoff (if any) is over."""
+        while True:
+            with self._backoff_lock:
+                delay = self._backoff_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def _back_off(self, retry_after):
+        """Push back the shared backoff after Spotify rate limits us."""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = DEFAULT_RETRY_AFTER
+
+        with self._backoff_lock:
+            self._backoff_until = max(self._backoff_until, time.monotonic() + delay)
+        http_client.logger.warning("Rate limited by Spotify, backing off for %ss", delay)
+
+    def _wait(self, retry_state):
+        """Tenacity wait strategy: 429s wait out the shared backoff, anything else backs off exponentially."""
+        outcome = retry_state.outcome
+        if not outcome.failed and outcome.result().status_code == 429:
+            return 0  # _send waits for the shared backoff before the next attempt
+        return _exponential_wait(retry_state)
+
+
+_exponential_wait = wait_exponential_jitter(initial=0.5, max=30)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Get the process-wide FetchEngine, creating it on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = FetchEngine()
+        return _engine
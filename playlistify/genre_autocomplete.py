@@ -0,0 +1,98 @@
+"""
+In-process prefix index over genre names for /autocomplete_genres, so completing
+a keystroke doesn't go to the database.
+Names are kept sorted by their lowercase form, so the genres starting with a prefix
+are one bisect away, and completions are ranked by Genre.song_count, most songs first.
+
+The index is loaded from Genre when the app starts (or on first use, if that failed),
+updated with the new counts whenever this process writes songs (persist_playlist),
+and reloaded in the background once it's GENRE_INDEX_REFRESH seconds old, to pick up
+songs written by other processes such as the upload worker and seed.
+"""
+
+import heapq
+import os
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import text
+
+from playlistify.db_config import my_engine
+from playlistify.reloading_index import ReloadingIndex
+
+
+GENRE_INDEX_REFRESH = int(os.getenv('GENRE_INDEX_REFRESH', 60))
+COMPLETIONS = 10
+
+GENRE_COUNTS_QUERY = text("SELECT name, song_count FROM Genre")
+
+
+def _rank(entry):
+    """Sort key for completions: most songs first, then by name."""
+    return -entry[1], entry[0]
+
+
+class GenrePrefixIndex:
+    def __init__(self, counts=()):
+        """
+        Create an index over genres.
+        @param:
+            - counts: iterable of (genre name, song count)
+        """
+        self._lock = threading.Lock()
+        self._counts = dict(counts)
+        self._keys = sorted((name.lower(), name) for name in self._counts)
+        self._top = None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def update(self, counts):
+        """Set the song counts of some genres, adding any the index doesn't have yet."""
+        with self._lock:
+            for name, song_count in counts.items():
+                if name not in self._counts:
+                    insort(self._keys, (name.lower(), name))
+                self._counts[name] = song_count
+            self._top = None
+
+    def complete(self, prefix, limit=COMPLETIONS):
+        """Up to limit genres some song has that start with prefix (case-insensitively), most common first."""
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + '\U0010ffff',), start)
+            matches = [(name, self._counts[name]) for _, name in self._keys[start:end] if self._counts[name] > 0]
+            return [name for name, _ in heapq.nsmallest(limit, matches, key=_rank)]
+
+    def top(self, limit=COMPLETIONS):
+        """The limit genres the most songs have."""
+        with self._lock:
+            if self._top is None or len(self._top) < limit:
+                self._top = [name for name, _ in heapq.nsmallest(limit, self._counts.items(), key=_rank)]
+            return self._top[:limit]
+
+
+def load_genre_index():
+    """Read every genre's song count into a new GenrePrefixIndex."""
+    with my_engine.connect() as conn:
+        return GenrePrefixIndex(conn.execute(GENRE_COUNTS_QUERY).fetchall())
+
+
+_genre_index = ReloadingIndex('genre index', load_genre_index, GENRE_INDEX_REFRESH)
+
+
+def get_genre_index():
+    """Get the process's genre index, loading it on first use (see ReloadingIndex)."""
+    return _genre_index.get()
+
+
+def preload_genre_index():
+    """Load the genre index on a background thread, so the first keystroke doesn't wait on it."""
+    _genre_index.preload()
+
+
+def record_genre_counts(counts):
+    """Apply song counts this process just committed to Genre, if the index is loaded or loading."""
+    if counts:
+        _genre_index.apply(lambda index: index.update(counts))
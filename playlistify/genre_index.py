@@ -0,0 +1,114 @@
+"""
+Maintains the genre index: Genre, each genre interned once with the number of
+songs that have it, and SongGenre, which songs have which genre.
+Song.genres stays the source of truth; link_song_genres brings the index in line
+with it for the songs just written, in the writer's transaction.
+
+The genre routes look songs up through SongGenre's (genre_id, song_id) index,
+so their cost grows with the number of matching songs rather than the catalog.
+"""
+
+from sqlalchemy import text
+
+
+# Songs whose links are being brought up to date, given as a :song_ids list
+SONG_IDS_PARAM = "SELECT UNNEST(CAST(:song_ids AS TEXT[]))"
+
+
+def relink_statements(song_ids_query):
+    """
+    SQL that relinks the songs song_ids_query selects to the genres in their Song.genres,
+    adjusting Genre.song_count by however many songs each genre gained or lost.
+    The last statement returns the name and new song_count of each genre it adjusted.
+    @return:
+        - list of statements to run in order, in one transaction
+    """
+    return [
+        # Intern any new genres
+        f"""
+        INSERT INTO Genre (name)
+        SELECT DISTINCT song_genre
+        FROM Song
+        CROSS JOIN UNNEST(Song.genres) AS song_genre
+        WHERE Song.song_id IN ({song_ids_query})
+        AND song_genre IS NOT NULL
+        ORDER BY song_genre
+        ON CONFLICT (name) DO NOTHING
+        """,
+        # Lock the genres whose counts change in a fixed order, so concurrent writers can't deadlock
+        f"""
+        SELECT genre_id FROM Genre
+        WHERE genre_id IN (SELECT genre_id FROM SongGenre WHERE song_id IN ({song_ids_query}))
+        OR name IN (SELECT UNNEST(genres) FROM Song WHERE song_id IN ({song_ids_query}))
+        ORDER BY genre_id
+        FOR UPDATE
+        """,
+        # Only links that changed are deleted or inserted, so the two never touch the same row
+        f"""
+        WITH current AS (
+            SELECT DISTINCT Song.song_id, Genre.genre_id
+            FROM Song
+            CROSS JOIN UNNEST(Song.genres) AS song_genre
+            INNER JOIN Genre ON Genre.name = song_genre
+            WHERE Song.song_id IN ({song_ids_query})
+        ),
+        removed AS (
+            DELETE FROM SongGenre
+            WHERE song_id IN ({song_ids_query})
+            AND NOT EXISTS (
+                SELECT 1 FROM current
+                WHERE current.song_id = SongGenre.song_id AND current.genre_id = SongGenre.genre_id
+            )
+            RETURNING genre_id
+        ),
+        added AS (
+            INSERT INTO SongGenre (song_id, genre_id)
+            SELECT song_id, genre_id FROM current
+            ORDER BY genre_id, song_id
+            ON CONFLICT DO NOTHING
+            RETURNING genre_id
+        ),
+        changes AS (
+            SELECT genre_id, SUM(change) AS change
+            FROM (
+                SELECT genre_id, -1 AS change FROM removed
+                UNION ALL
+                SELECT genre_id, 1 AS change FROM added
+            ) AS changed_links
+            GROUP BY genre_id
+        )
+        UPDATE Genre SET song_count = Genre.song_count + changes.change
+        FROM changes
+        WHERE Genre.genre_id = changes.genre_id AND changes.change <> 0
+        RETURNING Genre.name, Genre.song_count
+        """
+    ]
+
+
+RELINK_SONGS = [text(statement) for statement in relink_statements(SONG_IDS_PARAM)]
+
+
+def link_song_genres(conn, song_ids):
+    """
+    Bring the genre index up to date with some songs' Song.genres. Runs in the caller's transaction.
+    @return:
+        - dictionary of genre name -> new Genre.song_count, for the genres whose count changed
+    """
+    if not song_ids:
+        return {}
+    for statement in RELINK_SONGS:
+        result = conn.execute(statement, {'song_ids': list(song_ids)})
+    return dict(result.fetchall())
+
+
+def intern_genres_statement(table_query):
+    """SQL that interns the genres in the genres column of the rows table_query selects (e.g. new Artist rows)."""
+    return f"""
+        INSERT INTO Genre (name)
+        SELECT DISTINCT genre_name
+        FROM ({table_query}) AS genre_rows
+        CROSS JOIN UNNEST(genre_rows.genres) AS genre_name
+        WHERE genre_name IS NOT NULL
+        ORDER BY genre_name
+        ON CONFLICT (name) DO NOTHING
+    """
@@ -0,0 +1,100 @@
+"""
+Maintains PlaylistGenreSummary, the count of each genre across a playlist's songs,
+and Playlist.top_genres, its TOP_GENRES most common genres.
+persist_playlist adds and subtracts the genres of the songs it adds to and removes
+from a playlist, in the same transaction, so the genre pages can look them up
+instead of unnesting Song.genres across every PlaylistSong row.
+
+Run rebuild() (flask --app playlistify rebuild-genre-summary) to backfill
+or repair the summary from PlaylistSong.
+"""
+
+from sqlalchemy import text
+
+from playlistify.db_config import NO_STATEMENT_TIMEOUT
+
+
+TOP_GENRES = 3
+
+# Genre counts of some songs; Song.genres is a 2D array, which UNNEST flattens
+SONG_GENRE_COUNTS = """
+    SELECT genre, COUNT(*) AS genre_count
+    FROM Song
+    CROSS JOIN UNNEST(Song.genres) AS genre
+    WHERE Song.song_id = ANY(:song_ids)
+    AND genre IS NOT NULL
+    GROUP BY genre
+"""
+ADD_GENRE_COUNTS = text(f"""
+    INSERT INTO PlaylistGenreSummary (playlist_id, genre, genre_count)
+    SELECT :playlist_id, genre, genre_count FROM ({SONG_GENRE_COUNTS}) AS counts
+    ORDER BY genre
+    ON CONFLICT (playlist_id, genre) DO UPDATE SET genre_count = PlaylistGenreSummary.genre_count + EXCLUDED.genre_count
+""")
+SUBTRACT_GENRE_COUNTS = text(f"""
+    UPDATE PlaylistGenreSummary SET genre_count = PlaylistGenreSummary.genre_count - counts.genre_count
+    FROM ({SONG_GENRE_COUNTS}) AS counts
+    WHERE PlaylistGenreSummary.playlist_id = :playlist_id AND PlaylistGenreSummary.genre = counts.genre
+""")
+DELETE_EMPTY_GENRES = text("DELETE FROM PlaylistGenreSummary WHERE playlist_id = :playlist_id AND genre_count <= 0")
+
+# Ties are broken alphabetically so the top genres don't change from one rebuild to the next
+TOP_GENRES_ARRAY = """
+    ARRAY(
+        SELECT genre FROM PlaylistGenreSummary
+        WHERE PlaylistGenreSummary.playlist_id = Playlist.playlist_id
+        ORDER BY genre_count DESC, genre
+        LIMIT :top_genres
+    )
+"""
+UPDATE_TOP_GENRES = text(f"UPDATE Playlist SET top_genres = {TOP_GENRES_ARRAY} WHERE playlist_id = :playlist_id")
+
+REBUILD_GENRE_COUNTS = text("""
+    INSERT INTO PlaylistGenreSummary (playlist_id, genre, genre_count)
+    SELECT PlaylistSong.playlist_id, genre, COUNT(*)
+    FROM PlaylistSong
+    INNER JOIN Song ON Song.song_id = PlaylistSong.song_id
+    CROSS JOIN UNNEST(Song.genres) AS genre
+    WHERE genre IS NOT NULL
+    GROUP BY PlaylistSong.playlist_id, genre
+""")
+REBUILD_TOP_GENRES = text(f"UPDATE Playlist SET top_genres = {TOP_GENRES_ARRAY}")
+
+
+def update_genre_summary(conn, playlist_id, added_song_ids, removed_song_ids):
+    """
+    Count the genres of songs added to a playlist and uncount those of songs removed from it,
+    then recompute its top genres. Runs in the caller's transaction.
+    @param:
+        - added_song_ids, removed_song_ids: the song ids the transaction's PlaylistSong insert and
+          delete returned (each song counted once), so rows another upload of the playlist wrote
+          or deleted meanwhile aren't counted
+    """
+    params = {'playlist_id': playlist_id}
+    if added_song_ids:
+        conn.execute(ADD_GENRE_COUNTS, dict(params, song_ids=added_song_ids))
+    if removed_song_ids:
+        conn.execute(SUBTRACT_GENRE_COUNTS, dict(params, song_ids=removed_song_ids))
+        conn.execute(DELETE_EMPTY_GENRES, params)
+    conn.execute(UPDATE_TOP_GENRES, dict(params, top_genres=TOP_GENRES))
+
+
+def rebuild(conn):
+    """
+    Recount every playlist's genres from scratch, in one transaction.
+    @return:
+        - number of (playlist, genre) rows in the rebuilt summary
+    """
+    try:
+        conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+        conn.execute(text("DELETE FROM PlaylistGenreSummary"))
+        rows = conn.execute(REBUILD_GENRE_COUNTS).rowcount
+        # The table may have been near empty when last analyzed; without fresh statistics
+        # the top genres update scans the whole summary once per playlist
+        conn.execute(text("ANALYZE PlaylistGenreSummary"))
+        conn.execute(REBUILD_TOP_GENRES, {'top_genres': TOP_GENRES})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
@@ -0,0 +1,129 @@
+"""
+The process-wide HTTP client for Spotify calls.
+One pooled requests.Session is shared by SpotifyAnalyzer (through the FetchEngine)
+and the login/auth routes, so connections to the Spotify API are kept alive
+and reused instead of paying a fresh TCP+TLS handshake on every call.
+Also keeps per-endpoint counters: calls, errors, bytes and a latency histogram.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+# Size the pool for the number of threads that can call Spotify at once
+POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', os.getenv('SPOTIFY_MAX_CONCURRENCY', 8)))
+CONNECT_TIMEOUT = float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('SPOTIFY_READ_TIMEOUT', 15))
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket catches everything slower
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Spotify ids are 22 base62 characters
+SPOTIFY_ID_PATTERN = re.compile(r'/[0-9A-Za-z]{22}(?=/|$)')
+
+
+def _create_session():
+    """Create a Session with a connection pool sized for our worker count."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    return session
+
+
+session = _create_session()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def request(method, url, **kwargs):
+    """Send a request through the shared session, recording it in the endpoint stats."""
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        _record(method, url, None, 0, 0, time.perf_counter() - start)
+        logger.warning("%s failed: %s", endpoint_name(method, url), e)
+        raise
+
+    # Bytes on the wire (compressed) vs. the decoded body
+    decoded_bytes = len(response.content)
+    try:
+        wire_bytes = response.raw.tell()
+    except (AttributeError, OSError):
+        wire_bytes = decoded_bytes
+    _record(method, url, response.status_code, wire_bytes, decoded_bytes, time.perf_counter() - start)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def endpoint_name(method, url):
+    """Group urls by endpoint, e.g. 'GET api.spotify.com/v1/playlists/{id}/tracks'."""
+    parts = urlsplit(url)
+    return f"{method} {parts.netloc}{SPOTIFY_ID_PATTERN.sub('/{id}', parts.path)}"
+
+
+def _record(method, url, status_code, wire_bytes, decoded_bytes, elapsed):
+    """Add one call to its endpoint's counters."""
+    elapsed_ms = elapsed * 1000
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound), len(LATENCY_BUCKETS_MS))
+
+    name = endpoint_name(method, url)
+    with _stats_lock:
+        endpoint = _stats.get(name)
+        if endpoint is None:
+            endpoint = _stats[name] = {
+                'calls': 0,
+                'errors': 0,
+                'bytes': 0,
+                'decoded_bytes': 0,
+                'total_ms': 0.0,
+                'latency_histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            }
+        endpoint['calls'] += 1
+        if status_code is None or status_code >= 400:
+            endpoint['errors'] += 1
+        endpoint['bytes'] += wire_bytes
+        endpoint['decoded_bytes'] += decoded_bytes
+        endpoint['total_ms'] += elapsed_ms
+        endpoint['latency_histogram'][bucket] += 1
+
+
+def stats():
+    """Get a snapshot of the per-endpoint counters."""
+    with _stats_lock:
+        snapshot = {}
+        for name, endpoint in _stats.items():
+            snapshot[name] = dict(endpoint, latency_histogram=list(endpoint['latency_histogram']))
+            snapshot[name]['avg_ms'] = round(endpoint['total_ms'] / endpoint['calls'], 2)
+    return {
+        'latency_buckets_ms': LATENCY_BUCKETS_MS + ['inf'],
+        'endpoints': snapshot
+    }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
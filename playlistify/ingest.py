@@ -0,0 +1,252 @@
+"""
+Bulk ingestion of Spotify playlists straight into the database.
+Takes a file of playlist links or ids (one per line) and analyzes and persists them
+with a bounded pool of workers. Every finished playlist is appended to a journal file,
+so a run that crashes or is interrupted picks up where it stopped when restarted.
+
+Run with: flask --app playlistify ingest <playlist_file>
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+from playlistify import http_client
+from playlistify.db_config import my_engine
+from playlistify.persistence import persist_playlist
+from playlistify.SpotifyAnalyzer import SpotifyAnalyzer, extract_playlist_id, CLIENT_ID, CLIENT_SECRET, TOKEN_URL
+
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+DB_ATTEMPTS = 3  # concurrent workers writing the same songs can deadlock; retry the loser
+TOKEN_REFRESH_MARGIN = 60  # seconds before expiry to fetch a new client-credentials token
+
+PLAYLIST_ID_PATTERN = re.compile(r'(?:playlist[/:])?([0-9A-Za-z]{22})(?:[?/]|$)')
+
+
+def parse_playlist_ref(line):
+    """Get the playlist id from a playlist link, spotify:playlist: uri or bare id (None if there isn't one)."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    playlist_id = extract_playlist_id(line)
+    if playlist_id:
+        return playlist_id
+    match = PLAYLIST_ID_PATTERN.search(line)
+    return match.group(1) if match else None
+
+
+def read_playlist_ids(path):
+    """Read the unique playlist ids in a file, in order, skipping blank lines and # comments."""
+    playlist_ids = []
+    seen = set()
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            playlist_id = parse_playlist_ref(line)
+            if playlist_id is None:
+                if line.strip() and not line.strip().startswith('#'):
+                    print(f"Skipping line {line_number}: no playlist id in {line.strip()!r}")
+                continue
+            if playlist_id not in seen:
+                seen.add(playlist_id)
+                playlist_ids.append(playlist_id)
+    return playlist_ids
+
+
+class Journal:
+    def __init__(self, path):
+        """
+        Open (or create) an append-only journal of ingested playlists.
+        Each line is a JSON record: {"playlist_id", "status": "done"|"failed", "tracks", "error", "at"}.
+        Playlists whose last record is "done" are skipped on resume; failed ones are retried.
+        """
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by a crash mid-write
+                    if record.get('status') == 'done':
+                        self.done.add(record['playlist_id'])
+                    else:
+                        self.done.discard(record['playlist_id'])
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, playlist_id, status, tracks=0, error=None):
+        line = json.dumps({
+            'playlist_id': playlist_id,
+            'status': status,
+            'tracks': tracks,
+            'error': error,
+            'at': datetime.now().isoformat(timespec='seconds')
+        })
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if status == 'done':
+                self.done.add(playlist_id)
+
+    def close(self):
+        self._file.close()
+
+
+class ClientCredentials:
+    def __init__(self, token=None):
+        """
+        Hand out a Spotify app token for workers to share.
+        Uses the client-credentials flow (no user login) unless a fixed token is given,
+        and fetches a new token shortly before the current one expires.
+        """
+        self.token = token
+        self.fixed = token is not None
+        self.expires_at = float('inf') if self.fixed else 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if time.monotonic() > self.expires_at - TOKEN_REFRESH_MARGIN:
+                self._refresh()
+            return self.token
+
+    def _refresh(self):
+        response = http_client.post(TOKEN_URL, data={'grant_type': 'client_credentials'},
+                                    auth=(CLIENT_ID, CLIENT_SECRET))
+        response.raise_for_status()
+        token_info = response.json()
+        self.token = token_info['access_token']
+        self.expires_at = time.monotonic() + token_info['expires_in']
+
+
+class IngestError(Exception):
+    pass
+
+
+def ingest_playlist(analyzer, credentials, playlist_id):
+    """
+    Analyze one playlist and write it to the database, crediting it to the playlist's owner.
+    @return:
+        - number of tracks ingested
+    @raise:
+        - IngestError if Spotify wouldn't give us the playlist
+        - SQLAlchemyError if it couldn't be written
+        - anything else analyzing it raises (e.g. requests.ConnectionError, KeyError on a malformed payload)
+    """
+    analyzer.headers = {'Authorization': 'Bearer ' + credentials.get()}
+    details = analyzer.get_playlist_details(playlist_id)
+    if details is None:
+        raise IngestError(f"couldn't fetch playlist {playlist_id} from Spotify")
+    playlist_info, song_panda, art_panda = details
+
+    owner = {
+        'user_id': playlist_info['owner_id'],
+        'name': playlist_info['owner_name'],
+        'image_url': None
+    }
+    for attempt in range(1, DB_ATTEMPTS + 1):
+        try:
+            with my_engine.connect() as conn:
+                persist_playlist(conn, playlist_info, song_panda, art_panda, owner)
+            break
+        except OperationalError as e:
+            if attempt == DB_ATTEMPTS:
+                raise
+            print(f"Retrying database write for {playlist_id}: {e.orig}")
+    return len(song_panda)
+
+
+class Progress:
+    def __init__(self, total, report_every):
+        """Count finished playlists and tracks and report throughput every report_every playlists."""
+        self.total = total
+        self.report_every = report_every
+        self.playlists = 0
+        self.tracks = 0
+        self.failed = 0
+        self.start = time.monotonic()
+
+    def add(self, tracks=0, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.playlists += 1
+            self.tracks += tracks
+        if (self.playlists + self.failed) % self.report_every == 0:
+            self.report()
+
+    def rates(self):
+        minutes = max(time.monotonic() - self.start, 1e-9) / 60
+        return self.playlists / minutes, self.tracks / minutes
+
+    def report(self, final=False):
+        playlists_per_min, tracks_per_min = self.rates()
+        label = 'Finished' if final else 'Progress'
+        print(f"{label}: {self.playlists + self.failed}/{self.total} playlists "
+              f"({self.failed} failed, {self.tracks} tracks) | "
+              f"{playlists_per_min:.1f} playlists/min, {tracks_per_min:.0f} tracks/min")
+
+
+def ingest_file(path, workers=INGEST_WORKERS, journal_path=None, token=None, report_every=25):
+    """
+    Ingest every playlist listed in a file that the journal doesn't already have.
+    @param:
+        - path: file of playlist links or ids, one per line
+        - workers: how many playlists to ingest at once
+        - journal_path: progress journal (defaults to <path>.journal)
+        - token: Spotify access token to use instead of the client-credentials flow
+    @return:
+        - Progress with the run's counts and throughput
+    """
+    journal = Journal(journal_path or f'{path}.journal')
+    playlist_ids = read_playlist_ids(path)
+    pending = [playlist_id for playlist_id in playlist_ids if playlist_id not in journal.done]
+    print(f"{len(playlist_ids)} playlists in {path}, {len(playlist_ids) - len(pending)} already ingested, "
+          f"{len(pending)} to go with {workers} workers")
+
+    credentials = ClientCredentials(token)
+    progress = Progress(len(pending), report_every)
+
+    # Each worker thread gets its own analyzer, since ingest_playlist sets its token header
+    workers_local = threading.local()
+
+    def ingest(playlist_id):
+        if not hasattr(workers_local, 'analyzer'):
+            workers_local.analyzer = SpotifyAnalyzer(username=None, token=credentials.get())
+        return ingest_playlist(workers_local.analyzer, credentials, playlist_id)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+    futures = {executor.submit(ingest, playlist_id): playlist_id for playlist_id in pending}
+    try:
+        for future in as_completed(futures):
+            playlist_id = futures[future]
+            try:
+                tracks = future.result()
+            except Exception as e:
+                # Any one playlist failing (Spotify, a malformed payload, the database)
+                # is journaled and the run goes on, so a resume only retries the failures
+                error = str(e) if isinstance(e, (IngestError, SQLAlchemyError)) else f'{type(e).__name__}: {e}'
+                print(f"Error ingesting {playlist_id}: {error}")
+                journal.record(playlist_id, 'failed', error=error)
+                progress.add(failed=True)
+            else:
+                journal.record(playlist_id, 'done', tracks=tracks)
+                progress.add(tracks)
+    except KeyboardInterrupt:
+        print("Interrupted, waiting for in-flight playlists to finish. Rerun to resume.")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        journal.close()
+        progress.report(final=True)
+    return progress
@@ -0,0 +1,324 @@
+"""
+Background jobs for writing uploaded playlists to the database.
+/post_playlist enqueues the upload and returns a job id right away;
+a separate worker process (flask --app playlistify worker) does the writes,
+and /jobs/<job_id> reports whether the job is queued, running, done or failed.
+
+Two queue backends share one interface:
+    - RedisJobQueue, for JOBS_URL=redis://...
+    - SQLiteJobQueue, a local stand-in for development and tests (the default),
+      kept in the instance folder so the web and worker processes can share it
+Without a JOBS_URL the worker runs on a thread inside the web process, so uploads go through
+with nothing else started; set JOBS_INLINE_WORKER=0 and run flask --app playlistify worker to
+run it separately (JOBS_URL=redis://... turns the inline worker off unless JOBS_INLINE_WORKER=1).
+
+A worker holds a lease on the job it's running and renews it every LEASE_SECONDS / 3;
+if the worker dies, the lease runs out and the next dequeue puts the job back in the queue,
+failing it instead once it has been claimed MAX_ATTEMPTS times.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+import msgspec
+from flask import current_app
+
+from playlistify.db_config import my_engine
+from playlistify.persistence import persist_playlist
+from playlistify.result_store import decode_result
+
+
+JOB_TTL = 24 * 60 * 60  # seconds a finished job's status is kept
+POLL_INTERVAL = 0.5  # seconds between checks of an empty SQLite queue
+LEASE_SECONDS = 60  # a running job whose worker hasn't renewed its lease for this long is requeued
+MAX_ATTEMPTS = 3  # times a job is claimed before it's failed rather than requeued
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class SQLiteJobQueue:
+    def __init__(self, path):
+        """Create a job queue in a SQLite file."""
+        self.path = path
+        conn = self._connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    owner TEXT,
+                    payload BLOB,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    lease_expires_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Queues created before leases were added
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'lease_expires_at' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, created_at)")
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def enqueue(self, payload, owner=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT INTO jobs (job_id, status, owner, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, QUEUED, owner, payload, now, now))
+        conn.close()
+        return job_id
+
+    def dequeue(self, timeout=None):
+        """
+        Claim the oldest queued job (or running job whose lease has run out),
+        waiting up to timeout seconds (None = forever) for one.
+        @return:
+            - (job id, payload, times the job has been claimed), or None if the wait ran out
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("""
+                    UPDATE jobs SET status = ?, updated_at = ?, lease_expires_at = ?, attempts = attempts + 1
+                    WHERE job_id = (SELECT job_id FROM jobs
+                                    WHERE status = ? OR (status = ? AND lease_expires_at < ?)
+                                    ORDER BY created_at LIMIT 1)
+                    RETURNING job_id, payload, attempts
+                """, (RUNNING, now, now + LEASE_SECONDS, QUEUED, RUNNING, now)).fetchone()
+                conn.execute("COMMIT")
+                if row is not None:
+                    return row[0], row[1], row[2]
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(POLL_INTERVAL)
+        finally:
+            conn.close()
+
+    def renew(self, job_id):
+        """Extend the lease on a running job by LEASE_SECONDS."""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                         (now + LEASE_SECONDS, now, job_id, RUNNING))
+        conn.close()
+
+    def finish(self, job_id, status, error=None):
+        """Mark a job done or failed, dropping its payload and any jobs that finished over JOB_TTL ago."""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, payload = NULL, lease_expires_at = NULL, updated_at = ? "
+                         "WHERE job_id = ?", (status, error, now, job_id))
+            conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, now - JOB_TTL))
+        conn.close()
+
+    def status(self, job_id):
+        conn = self._connect()
+        row = conn.execute("SELECT status, owner, error, created_at, updated_at FROM jobs WHERE job_id = ?",
+                           (job_id,)).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {'job_id': job_id, 'status': row[0], 'owner': row[1], 'error': row[2],
+                'created_at': row[3], 'updated_at': row[4]}
+
+
+class RedisJobQueue:
+    def __init__(self, url, name='playlistify:jobs'):
+        """
+        Create a job queue in Redis: a list of queued job ids, a hash per job,
+        and a sorted set of running job ids scored by when their lease runs out.
+        """
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.name = name
+        self.running = f'{name}:running'
+
+    def _key(self, job_id):
+        return f'{self.name}:{job_id}'
+
+    def enqueue(self, payload, owner=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(job_id), mapping={'status': QUEUED, 'owner': owner or '', 'payload': payload,
+                                              'created_at': now, 'updated_at': now})
+        pipe.lpush(self.name, job_id)
+        pipe.execute()
+        return job_id
+
+    def _requeue_expired(self):
+        """Put running jobs whose lease has run out back at the front of the queue."""
+        for job_id in self.redis.zrangebyscore(self.running, 0, time.time()):
+            # Only the worker that removes it from the running set requeues it
+            if self.redis.zrem(self.running, job_id):
+                self.redis.rpush(self.name, job_id)
+
+    def dequeue(self, timeout=None):
+        """
+        Claim the oldest queued job (or running job whose lease has run out),
+        waiting up to timeout seconds (None = forever) for one.
+        @return:
+            - (job id, payload, times the job has been claimed), or None if the wait ran out
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._requeue_expired()
+            # Wake up at least once a lease to requeue jobs from workers that died meanwhile
+            wait = LEASE_SECONDS if deadline is None else min(LEASE_SECONDS, deadline - time.monotonic())
+            popped = self.redis.brpop([self.name], timeout=max(1, int(wait)))
+            if popped is not None:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+        job_id = popped[1].decode()
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.running, {job_id: now + LEASE_SECONDS})
+        pipe.hset(self._key(job_id), mapping={'status': RUNNING, 'updated_at': now})
+        pipe.hincrby(self._key(job_id), 'attempts', 1)
+        pipe.hget(self._key(job_id), 'payload')
+        _, _, attempts, payload = pipe.execute()
+        return job_id, payload, attempts
+
+    def renew(self, job_id):
+        """Extend the lease on a running job by LEASE_SECONDS."""
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.running, {job_id: now + LEASE_SECONDS}, xx=True)
+        pipe.hset(self._key(job_id), 'updated_at', now)
+        pipe.execute()
+
+    def finish(self, job_id, status, error=None):
+        """Mark a job done or failed, dropping its payload and expiring it after JOB_TTL."""
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.running, job_id)
+        pipe.hset(self._key(job_id), mapping={'status': status, 'error': error or '', 'updated_at': time.time()})
+        pipe.hdel(self._key(job_id), 'payload')
+        pipe.expire(self._key(job_id), JOB_TTL)
+        pipe.execute()
+
+    def status(self, job_id):
+        fields = self.redis.hmget(self._key(job_id), ['status', 'owner', 'error', 'created_at', 'updated_at'])
+        if fields[0] is None:
+            return None
+        status, owner, error, created_at, updated_at = [field.decode() if field else None for field in fields]
+        return {'job_id': job_id, 'status': status, 'owner': owner, 'error': error,
+                'created_at': float(created_at), 'updated_at': float(updated_at)}
+
+
+def create_queue(url):
+    """Create the job queue a JOBS_URL points at (redis://... or sqlite:///path)."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisJobQueue(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteJobQueue(url[len('sqlite:///'):])
+    raise ValueError(f'unsupported JOBS_URL: {url}')
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue(inline_worker=True):
+    """
+    Get the app's job queue (JOBS_URL, defaulting to SQLite in the instance folder), creating it on first use.
+    @param:
+        - inline_worker: start the inline worker if JOBS_INLINE_WORKER is on (the worker command doesn't)
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            url = current_app.config.get('JOBS_URL') or 'sqlite:///' + os.path.join(current_app.instance_path, 'jobs.sqlite3')
+            _queue = create_queue(url)
+            if inline_worker and current_app.config.get('JOBS_INLINE_WORKER'):
+                threading.Thread(target=work, args=(_queue,), name='jobs-inline-worker', daemon=True).start()
+        return _queue
+
+
+def enqueue_upload(queue, result_blob, user):
+    """
+    Queue a playlist upload.
+    The analysis is copied into the job, so it doesn't matter if the result store evicts it meanwhile.
+    @param:
+        - result_blob: the playlist's analysis, as stored in the result store
+        - user: dictionary with the uploader's user_id, name and image_url
+    @return:
+        - job id
+    """
+    payload = msgspec.msgpack.encode({'result': result_blob, 'user': user})
+    return queue.enqueue(payload, owner=user['user_id'])
+
+
+def run_upload(payload):
+    """Write one queued upload to the database."""
+    upload = msgspec.msgpack.decode(payload)
+    playlist_data, song_data, art_data = decode_result(upload['result'])
+    with my_engine.connect() as conn:
+        persist_playlist(conn, playlist_data, song_data, art_data, upload['user'])
+
+
+def keep_leased(queue, job_id, stop):
+    """Renew the lease on a running job every LEASE_SECONDS / 3 until stop is set."""
+    while not stop.wait(LEASE_SECONDS / 3):
+        try:
+            queue.renew(job_id)
+        except Exception as e:
+            print(f"Error renewing the lease on job {job_id}: {e}")
+
+
+def work(queue, burst=False):
+    """
+    Run queued uploads one at a time until stopped.
+    @param:
+        - burst: stop once the queue is empty instead of waiting for more jobs
+    @return:
+        - number of jobs run
+    """
+    jobs_run = 0
+    while True:
+        job = queue.dequeue(timeout=POLL_INTERVAL if burst else None)
+        if job is None:
+            if burst:
+                return jobs_run
+            continue
+        job_id, payload, attempts = job
+        if attempts > MAX_ATTEMPTS:
+            # Every worker that claimed it died running it; don't take down another
+            queue.finish(job_id, FAILED, error=f'gave up after {MAX_ATTEMPTS} attempts')
+            print(f"Job {job_id} failed: gave up after {MAX_ATTEMPTS} attempts")
+            continue
+        print(f"Running job {job_id}")
+        stop = threading.Event()
+        threading.Thread(target=keep_leased, args=(queue, job_id, stop), name=f'job-{job_id}-lease', daemon=True).start()
+        try:
+            run_upload(payload)
+        except Exception as e:
+            traceback.print_exc()
+            queue.finish(job_id, FAILED, error=str(e).splitlines()[0] if str(e) else type(e).__name__)
+            print(f"Job {job_id} failed")
+        else:
+            queue.finish(job_id, DONE)
+            print(f"Job {job_id} done")
+        finally:
+            stop.set()
+        jobs_run += 1
@@ -1,13 +1,15 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify, flash, current_app
 import urllib.parse
 from datetime import datetime
-import requests
 import pandas as pd
 import os
 from sqlalchemy import text
+from cachelib import FileSystemCache
 import ast
 
 from playlistify.SpotifyAnalyzer import SpotifyAnalyzer
+from playlistify import http_client, ratings
+from playlistify.similarity import similar_to_playlist
 from .db_config import my_engine
 
 # Login blueprint
@@ -21,6 +23,22 @@ AUTH_URL = 'https://accounts.spotify.com/authorize'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
 API_BASE_URL = 'https://api.spotify.com/v1/'
 
+# Pages of /me/playlists and their ETags, kept for a week across logins
+PLAYLIST_PAGE_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+_playlist_page_cache = None
+
+
+def get_playlist_page_cache():
+    """Get the on-disk cache of /me/playlists pages, creating it on first use."""
+    global _playlist_page_cache
+    if _playlist_page_cache is None:
+        _playlist_page_cache = FileSystemCache(
+            os.path.join(current_app.instance_path, 'playlist_pages'),
+            threshold=5000,
+            default_timeout=PLAYLIST_PAGE_CACHE_TIMEOUT
+        )
+    return _playlist_page_cache
+
 
 @login.route('/login')
 def user_login():
@@ -52,7 +70,7 @@ def callback():
         'client_secret': CLIENT_SECRET
     }
 
-    response = requests.post(TOKEN_URL, data=data)
+    response = http_client.post(TOKEN_URL, data=data)
     response_data = response.json()
 
     session['user_access_token'] = response_data['access_token']
@@ -83,7 +101,7 @@ def refresh_token(redirect_route):
             'client_secret': CLIENT_SECRET
         }
 
-        response = requests.post(TOKEN_URL, data=data)
+        response = http_client.post(TOKEN_URL, data=data)
         new_response_data = response.json()
 
         session['user_access_token'] = new_response_data['access_token']
@@ -98,10 +116,14 @@ def user_playlists():
     if not access_token or datetime.now().timestamp() > session.get('expires_at'):
         return redirect(url_for('login.refresh_token', redirect_route='login.user_playlists'))
 
-    Sp = SpotifyAnalyzer(redirect_uri=REDIRECT_URI, token=access_token)
-    playlists = Sp.get_user_playlists()
-    user_info = Sp.get_user_info()
-    print(playlists)
+    # /me was already fetched and stored in the session at login
+    user_info = {
+        'user_id': session.get('user_id'),
+        'display_name': session.get('display_name'),
+        'image_url': session.get('user_img')
+    }
+    Sp = SpotifyAnalyzer(username=user_info['user_id'], redirect_uri=REDIRECT_URI, token=access_token)
+    playlists = Sp.get_user_playlists(page_cache=get_playlist_page_cache())
 
     # if request.method == 'POST':
     #     playlist_id = request.form['playlist_id']
@@ -110,6 +132,14 @@ def user_playlists():
 
     return render_template('user_playlists.html', user_info=user_info, playlists=playlists)
 
+UPLOADED_PLAYLISTS_QUERY = text("""
+    SELECT playlist.title, playlist.playlist_id, PlaylistRating.avg_rating
+    FROM HasPlaylist
+    INNER JOIN playlist ON HasPlaylist.user_id = :user_id AND HasPlaylist.playlist_id = playlist.playlist_id
+    LEFT JOIN PlaylistRating ON playlist.playlist_id = PlaylistRating.playlist_id
+""")
+
+
 @login.route('/user_profile')
 def user_profile():
     access_token = session.get('user_access_token')
@@ -127,17 +157,10 @@ def user_profile():
         'image_url': session.get('user_img')
     }
     with my_engine.connect() as conn:
-        select_playlists = text("""
-            SELECT playlist.title, playlist.playlist_id, AVG(rate.rating) AS avg_rating
-            FROM HasPlaylist
-            INNER JOIN playlist ON HasPlaylist.user_id = :user_id AND HasPlaylist.playlist_id = playlist.playlist_id
-            LEFT JOIN rate ON playlist.playlist_id = rate.playlist_id
-            GROUP BY playlist.title, playlist.playlist_id
-        """)
         params = {
             'user_id': user_info['user_id']
         }
-        cursor = conn.execute(select_playlists, params)
+        cursor = conn.execute(UPLOADED_PLAYLISTS_QUERY, params)
         uploaded_playlists = []
         for result in cursor:
             uploaded_playlists.append(result[0:3])
@@ -147,41 +170,43 @@ def user_profile():
     return render_template('user_profile.html', user_info=user_info, uploaded_playlists=uploaded_playlists)
 
 
+PLAYLIST_QUERY = text("""
+    SELECT p.playlist_id, p.title, p.image_url, p.description, u.user_id AS owner_id, u.name AS owner_name
+    FROM playlist AS p
+    INNER JOIN HasPlaylist AS hp ON p.playlist_id = hp.playlist_id
+    INNER JOIN users AS u ON hp.user_id = u.user_id
+    WHERE p.playlist_id = :playlist_id
+""")
+
+PLAYLIST_SONGS_QUERY = text("""
+    SELECT song.song_id, song.title, song.popularity,
+        (song.features).danceability, (song.features).energy, (song.features).music_key, 
+        (song.features).loudness, (song.features).music_mode, (song.features).speechiness, 
+        (song.features).acousticness, (song.features).instrumentalness, 
+        (song.features).liveness, (song.features).valence, (song.features).tempo, 
+        (song.features).duration_ms, (song.features).time_signature, song.genres,
+        song.album_url, array_agg(artist.name) AS artist_names
+    FROM song
+    INNER JOIN SongArtist ON song.song_id = SongArtist.song_id
+    INNER JOIN artist ON SongArtist.artist_id = artist.artist_id
+    WHERE song.song_id IN (
+        SELECT song_id
+        FROM PlaylistSong
+        WHERE playlist_id = :playlist_id
+    )
+    GROUP BY song.song_id
+""")
+
 @login.route('/view_playlist/<playlist_id>')
 def view_playlist(playlist_id):
     with my_engine.connect() as conn:
-        select_playlist = text("""
-            SELECT p.playlist_id, p.title, p.image_url, p.description, u.user_id AS owner_id, u.name AS owner_name
-            FROM playlist AS p
-            INNER JOIN HasPlaylist AS hp ON p.playlist_id = hp.playlist_id
-            INNER JOIN users AS u ON hp.user_id = u.user_id
-            WHERE p.playlist_id = :playlist_id
-        """)
         params = {
             'playlist_id': playlist_id
         }
-        cursor = conn.execute(select_playlist, params)
+        cursor = conn.execute(PLAYLIST_QUERY, params)
         playlist_data = cursor.fetchone()
 
-        select_songs = text("""
-            SELECT song.song_id, song.title, song.popularity,
-                (song.features).danceability, (song.features).energy, (song.features).music_key, 
-                (song.features).loudness, (song.features).music_mode, (song.features).speechiness, 
-                (song.features).acousticness, (song.features).instrumentalness, 
-                (song.features).liveness, (song.features).valence, (song.features).tempo, 
-                (song.features).duration_ms, (song.features).time_signature, song.genres,
-                song.album_url, array_agg(artist.name) AS artist_names
-            FROM song
-            INNER JOIN SongArtist ON song.song_id = SongArtist.song_id
-            INNER JOIN artist ON SongArtist.artist_id = artist.artist_id
-            WHERE song.song_id IN (
-                SELECT song_id
-                FROM PlaylistSong
-                WHERE playlist_id = :playlist_id
-            )
-            GROUP BY song.song_id
-        """)
-        cursor = conn.execute(select_songs, params)
+        cursor = conn.execute(PLAYLIST_SONGS_QUERY, params)
         song_rows = []
         for result in cursor:
             song_rows.append(result[0:19])
@@ -209,19 +234,18 @@ def view_playlist(playlist_id):
         sql_reconstructed_song_panda['artist_names'] = sql_reconstructed_song_panda['artist_names'].apply(unpack_col)
         sql_reconstructed_song_panda['genres'] = sql_reconstructed_song_panda['genres'].apply(unpack_col)
 
-        select_reviews = text("""
-            SELECT users.name, rate.rating, rate.rate_text
-            FROM Rate
-            INNER JOIN users ON Rate.user_id = users.user_id
-            WHERE Rate.playlist_id = :playlist_id
-        """)
-        cursor = conn.execute(select_reviews, params)
-        reviews = []
-        for result in cursor:
-            reviews.append(result)
+        # Precomputed rating aggregates, and one page of reviews
+        rating = ratings.playlist_rating(conn, playlist_id)
+        page = max(request.args.get('reviews_page', 1, type=int), 1)
+        reviews, more_reviews = ratings.playlist_reviews(conn, playlist_id, page)
         review_panda = pd.DataFrame(reviews, columns=['user_name', 'rating', 'rate_text'])
 
-    return render_template('view_playlist.html', playlist_data=playlist_data, song_data=sql_reconstructed_song_panda, reviews=review_panda)
+        # Nearest songs and playlists in audio-feature space, from the in-process similarity index
+        similar_songs, similar_playlists = similar_to_playlist(conn, playlist_id, sql_reconstructed_song_panda['song_id'].tolist())
+
+    return render_template('view_playlist.html', playlist_data=playlist_data, song_data=sql_reconstructed_song_panda, reviews=review_panda,
+                           rating=rating, reviews_page=page, more_reviews=more_reviews,
+                           similar_songs=similar_songs, similar_playlists=similar_playlists)
         
 
 @login.route('/rate_playlist/<playlist_id>', methods=['GET', 'POST'])
@@ -236,34 +260,11 @@ def rate_playlist(playlist_id):
             return redirect(url_for('main.rate_playlist', playlist_id=playlist_id))
 
         with my_engine.connect() as conn:
-            # Check if the user has already rated the playlist
-            select_query = text("""
-                SELECT user_id
-                FROM Rate
-                WHERE user_id = :user_id AND playlist_id = :playlist_id
-            """)
-            params = {
-                'user_id': session['user_id'],
-                'playlist_id': playlist_id
-            }
-            cursor = conn.execute(select_query, params)
-            if cursor.fetchone():
+            # Inserts the rating and counts it in one statement, unless the user has already rated the playlist
+            # ('user_id' is stored in the session when the user logs in)
+            if not ratings.rate_playlist(conn, session['user_id'], playlist_id, int(rating), comment):
                 flash('You have already rated this playlist.')
                 return redirect(url_for('login.view_playlist', playlist_id=playlist_id))
-            
-            # Update the database if else
-            update_query = text("""
-                INSERT INTO Rate (user_id, playlist_id, rating, rate_text)
-                VALUES (:user_id, :playlist_id, :rating, :comment)
-            """)
-            params = {
-                'user_id': session['user_id'],  # 'user_id' is stored in the session when the user logs in
-                'playlist_id': playlist_id,
-                'rating': rating,
-                'comment': comment
-            }
-            conn.execute(update_query, params)
-            conn.commit()
             print(f'{session["user_id"]} submitted rating: {rating}, comment: {comment}')
 
         flash('Your rating has been submitted.')
@@ -0,0 +1,269 @@
+"""
+A read-through cache for Spotify song and artist metadata.
+Lookups go through three layers, and only what misses all of them is fetched from Spotify:
+    1. an in-process LRU with a TTL
+    2. the existing Postgres Song and Artist tables
+    3. the Spotify Web API
+Whatever is fetched from Spotify is written back to the layers above it.
+
+Staleness policy (per entity type):
+    - audio features never change, so they never expire
+    - artists expire after ARTIST_TTL_HOURS because their popularity drifts;
+      Artist rows older than that (by Artist.fetched_at) count as misses
+    - ids Spotify had nothing for are only cached in process, for MISSING_TTL_SECONDS,
+      so a song whose features Spotify adds later is picked up
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from playlistify.db_config import my_engine
+
+
+CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', 50000))
+ARTIST_TTL_HOURS = float(os.getenv('ARTIST_TTL_HOURS', 6))
+MISSING_TTL_SECONDS = float(os.getenv('METADATA_MISSING_TTL', 300))
+
+# Seconds before an entry goes stale (None = never)
+STALENESS = {
+    'audio_features': None,
+    'artist': ARTIST_TTL_HOURS * 60 * 60
+}
+
+# Order of the subattributes in the Song.features composite type, as Spotify names them
+FEATURE_KEYS = [
+    'acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness', 'key',
+    'liveness', 'loudness', 'mode', 'speechiness', 'tempo', 'time_signature', 'valence'
+]
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl=None):
+        """Create a thread-safe LRU cache holding up to maxsize entries for ttl seconds (None = forever)."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached value, or _MISSING if it isn't cached or has gone stale."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() > expires_at:
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache a value, for ttl seconds if given instead of the cache's ttl."""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MetadataCache:
+    def __init__(self, entity, load_rows=None, store_rows=None, maxsize=CACHE_SIZE):
+        """
+        Create a read-through cache for one entity type.
+        @param:
+            - entity: key into STALENESS
+            - load_rows: function(conn, ids, max_age) -> {id: value} reading the database layer
+            - store_rows: function(conn, {id: value}) writing fetched values back to the database
+        """
+        self.entity = entity
+        self.ttl = STALENESS[entity]
+        self.lru = LRUCache(maxsize, self.ttl)
+        self.load_rows = load_rows
+        self.store_rows = store_rows
+        self.counts = {'lru_hits': 0, 'db_hits': 0, 'spotify_fetches': 0}
+        self._counts_lock = threading.Lock()
+
+    def get_many(self, ids, fetch):
+        """
+        Look up many ids through the cache layers.
+        @param:
+            - ids: list of Spotify ids
+            - fetch: function(list of ids) -> {id: value} that asks Spotify for the misses
+        @return:
+            - dictionary mapping id to value, for every id found in some layer
+        """
+        found = {}
+        misses = []
+        for entity_id in ids:
+            value = self.lru.get(entity_id)
+            if value is _MISSING:
+                misses.append(entity_id)
+            else:
+                found[entity_id] = value
+        lru_hits = len(found)
+
+        db_found = self._load(misses) if misses else {}
+        for entity_id, value in db_found.items():
+            self.lru.set(entity_id, value)
+        found.update(db_found)
+
+        misses = [entity_id for entity_id in misses if entity_id not in db_found]
+        fetched = fetch(misses) if misses else {}
+        for entity_id, value in fetched.items():
+            self.lru.set(entity_id, value, ttl=MISSING_TTL_SECONDS if value is None else None)
+        stored = {entity_id: value for entity_id, value in fetched.items() if value is not None}
+        if stored:
+            self._store(stored)
+        found.update(fetched)
+
+        with self._counts_lock:
+            self.counts['lru_hits'] += lru_hits
+            self.counts['db_hits'] += len(db_found)
+            self.counts['spotify_fetches'] += len(misses)
+        return found
+
+    def _load(self, ids):
+        """Read ids from the database layer, treating database errors as misses."""
+        if self.load_rows is None:
+            return {}
+        try:
+            with my_engine.connect() as conn:
+                return self.load_rows(conn, ids, self.ttl)
+        except SQLAlchemyError as e:
+            print(f"Error reading {self.entity} cache from database: {e}")
+            return {}
+
+    def _store(self, values):
+        """Write fetched values back to the database layer."""
+        if self.store_rows is None:
+            return
+        try:
+            with my_engine.connect() as conn:
+                self.store_rows(conn, values)
+                conn.commit()
+        except SQLAlchemyError as e:
+            print(f"Error writing {self.entity} cache to database: {e}")
+
+    def stats(self):
+        with self._counts_lock:
+            counts = dict(self.counts)
+        lookups = sum(counts.values())
+        counts['lru_size'] = len(self.lru)
+        counts['hit_rate'] = round((counts['lru_hits'] + counts['db_hits']) / lookups, 4) if lookups else None
+        return counts
+
+
+def _flatten_genres(genres):
+    """Genres are stored with ARRAY[:genres], so they can come back as a nested list."""
+    if not genres:
+        return []
+    flat = []
+    for genre in genres:
+        if isinstance(genre, list):
+            flat.extend(g for g in genre if g is not None)
+        elif genre is not None:
+            flat.append(genre)
+    return flat
+
+
+def load_audio_features(conn, song_ids, max_age):
+    """Read Spotify-shaped audio features for songs already in the Song table."""
+    select_features = text(f"""
+        SELECT song_id, {', '.join(f'(features).{_feature_column(key)}' for key in FEATURE_KEYS)}
+        FROM Song
+        WHERE song_id = ANY(:song_ids) AND features IS NOT NULL
+    """)
+    audio_features = {}
+    for row in conn.execute(select_features, {'song_ids': song_ids}):
+        features = dict(zip(FEATURE_KEYS, row[1:]))
+        features['id'] = row[0]
+        audio_features[row[0]] = features
+    return audio_features
+
+
+def _feature_column(key):
+    """Song.features names key/mode music_key/music_mode."""
+    return {'key': 'music_key', 'mode': 'music_mode'}.get(key, key)
+
+
+def store_audio_features(conn, audio_features):
+    """
+    Write freshly fetched audio features to Song.features. Songs not in the Song table yet
+    are only cached in process; persistence writes their features along with the rest of the song.
+    """
+    update_features = text("""
+        UPDATE Song SET features = CAST(:features AS song_features)
+        WHERE song_id = :song_id AND features IS NULL
+    """)
+    params = [{
+        'song_id': song_id,
+        'features': f"({', '.join(str(features[key]) for key in FEATURE_KEYS)})"
+    } for song_id, features in sorted(audio_features.items())
+        if all(features.get(key) is not None for key in FEATURE_KEYS)]
+    if params:
+        conn.execute(update_features, params)
+
+
+def load_artists(conn, artist_ids, max_age):
+    """Read Spotify-shaped artist objects for Artist rows fetched within max_age seconds."""
+    select_artists = text("""
+        SELECT artist_id, name, image_url, genres, popularity
+        FROM Artist
+        WHERE artist_id = ANY(:artist_ids)
+        AND fetched_at > NOW() - make_interval(secs => :max_age)
+    """)
+    artists = {}
+    for row in conn.execute(select_artists, {'artist_ids': artist_ids, 'max_age': max_age}):
+        artists[row[0]] = {
+            'id': row[0],
+            'name': row[1],
+            'images': [{'url': row[2]}] if row[2] else [],
+            'genres': _flatten_genres(row[3]),
+            'popularity': row[4]
+        }
+    return artists
+
+
+def store_artists(conn, artists):
+    """Upsert freshly fetched artists into the Artist table."""
+    upsert_artist = text("""
+        INSERT INTO Artist (artist_id, name, image_url, popularity, genres, fetched_at)
+        VALUES (:artist_id, :name, :image_url, :popularity, ARRAY[:genres], NOW())
+        ON CONFLICT (artist_id) DO UPDATE
+        SET name = EXCLUDED.name, image_url = EXCLUDED.image_url, popularity = EXCLUDED.popularity,
+            genres = EXCLUDED.genres, fetched_at = EXCLUDED.fetched_at
+    """)
+    params = [{
+        'artist_id': artist['id'],
+        'name': artist['name'],
+        'image_url': artist['images'][0]['url'] if artist['images'] else None,
+        'popularity': artist['popularity'],
+        'genres': artist['genres'] if artist['genres'] else None
+    } for artist in artists.values() if artist is not None]
+    if params:
+        conn.execute(upsert_artist, params)
+
+
+audio_features = MetadataCache('audio_features', load_rows=load_audio_features, store_rows=store_audio_features)
+artists = MetadataCache('artist', load_rows=load_artists, store_rows=store_artists)
+
+
+def stats():
+    """Hit counts and hit rates for each entity type."""
+    return {
+        'audio_features': audio_features.stats(),
+        'artist': artists.stats()
+    }
@@ -0,0 +1,4 @@
+-- When each Artist row was last fetched from Spotify, so the metadata cache
+-- can tell fresh artists from ones whose popularity has gone stale.
+-- Rows from before this migration have no fetched_at and count as stale.
+ALTER TABLE Artist ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMP;
@@ -0,0 +1,4 @@
+-- The Spotify snapshot_id of the version of each playlist last uploaded, so
+-- re-uploading an unchanged playlist can skip rewriting its songs and artists.
+-- Rows from before this migration have no snapshot_id and are always rewritten.
+ALTER TABLE Playlist ADD COLUMN IF NOT EXISTS snapshot_id TEXT;
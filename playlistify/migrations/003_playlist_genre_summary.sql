@@ -0,0 +1,12 @@
+-- How many times each genre appears across each playlist's songs, and each
+-- playlist's top genres, kept up to date as playlists are uploaded so the
+-- genre pages don't have to unnest every song's genres per request.
+-- Existing playlists are filled in by: flask --app playlistify rebuild-genre-summary
+CREATE TABLE IF NOT EXISTS PlaylistGenreSummary (
+    playlist_id TEXT REFERENCES Playlist ON DELETE CASCADE,
+    genre TEXT,
+    genre_count INT NOT NULL,
+    PRIMARY KEY (playlist_id, genre)
+);
+CREATE INDEX IF NOT EXISTS playlistgenresummary_genre ON PlaylistGenreSummary (genre, playlist_id);
+ALTER TABLE Playlist ADD COLUMN IF NOT EXISTS top_genres TEXT[];
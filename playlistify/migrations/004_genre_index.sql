@@ -0,0 +1,46 @@
+-- Genres interned into their own table, and which songs have which genre,
+-- so genre lookups go through indexes instead of unnesting every Song.genres.
+-- Genre.song_count is how many songs have the genre.
+-- Backfilled here from Song.genres and Artist.genres; kept up to date as songs are written.
+CREATE TABLE IF NOT EXISTS Genre (
+    genre_id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    song_count INT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS SongGenre (
+    song_id TEXT REFERENCES Song ON DELETE CASCADE,
+    genre_id INT REFERENCES Genre,
+    PRIMARY KEY (song_id, genre_id)
+);
+CREATE INDEX IF NOT EXISTS songgenre_genre ON SongGenre (genre_id, song_id);
+CREATE INDEX IF NOT EXISTS genre_name_prefix ON Genre (lower(name) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS genre_song_count ON Genre (song_count DESC);
+
+-- Genre lookups find songs first, then their playlists and uploaders
+CREATE INDEX IF NOT EXISTS playlistsong_song ON PlaylistSong (song_id);
+CREATE INDEX IF NOT EXISTS hasplaylist_playlist ON HasPlaylist (playlist_id);
+
+INSERT INTO Genre (name)
+SELECT DISTINCT genre_name
+FROM (
+    SELECT UNNEST(genres) AS genre_name FROM Song
+    UNION ALL
+    SELECT UNNEST(genres) AS genre_name FROM Artist
+) AS genre_names
+WHERE genre_name IS NOT NULL
+ORDER BY genre_name
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO SongGenre (song_id, genre_id)
+SELECT DISTINCT Song.song_id, Genre.genre_id
+FROM Song
+CROSS JOIN UNNEST(Song.genres) AS song_genre
+INNER JOIN Genre ON Genre.name = song_genre
+ON CONFLICT DO NOTHING;
+
+UPDATE Genre SET song_count = counts.song_count
+FROM (SELECT genre_id, COUNT(*) AS song_count FROM SongGenre GROUP BY genre_id) AS counts
+WHERE Genre.genre_id = counts.genre_id;
+
+ANALYZE Genre;
+ANALYZE SongGenre;
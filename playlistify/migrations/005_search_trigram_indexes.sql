@@ -0,0 +1,12 @@
+-- Trigram indexes for playlistify/search.py, which matches playlist titles, artist names
+-- and song titles with ILIKE substring patterns and pg_trgm's word similarity operator.
+-- pg_trgm ships with PostgreSQL's contrib modules; creating it needs a superuser
+-- or, from PostgreSQL 13, a database owner (it is a trusted extension).
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS playlist_title_trgm ON Playlist USING GIN (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS artist_name_trgm ON Artist USING GIN (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS song_title_trgm ON Song USING GIN (title gin_trgm_ops);
+
+-- Artist searches go from the matching artists to their playlists
+CREATE INDEX IF NOT EXISTS playlistartists_artist ON PlaylistArtists (artist_id);
@@ -0,0 +1,4 @@
+-- Keyset pagination for /filter_genres (see playlistify/browse.py): playlists and their songs
+-- are listed newest upload first, so each page seeks into this index past the last one's key.
+CREATE INDEX IF NOT EXISTS hasplaylist_uploaded
+ON HasPlaylist ((COALESCE(date_uploaded, '-infinity')), playlist_id, user_id);
@@ -0,0 +1,25 @@
+-- Each playlist's rating count, sum, average and histogram (element i + 1 counts the ratings of i),
+-- kept up to date by ratings.rate_playlist so pages don't aggregate every Rate row.
+-- Backfilled here from Rate; flask --app playlistify rebuild-ratings recounts it.
+CREATE TABLE IF NOT EXISTS PlaylistRating (
+    playlist_id TEXT PRIMARY KEY REFERENCES Playlist ON DELETE CASCADE,
+    rating_count INT NOT NULL DEFAULT 0,
+    rating_sum INT NOT NULL DEFAULT 0,
+    histogram INT[] NOT NULL DEFAULT array_fill(0, ARRAY[11]),
+    avg_rating NUMERIC GENERATED ALWAYS AS (rating_sum::NUMERIC / NULLIF(rating_count, 0)) STORED
+);
+
+-- Reviews are listed a page at a time, newest first
+ALTER TABLE Rate ADD COLUMN IF NOT EXISTS rated_at TIMESTAMP DEFAULT NOW();
+CREATE INDEX IF NOT EXISTS rate_playlist_rated_at ON Rate (playlist_id, rated_at DESC, user_id);
+
+INSERT INTO PlaylistRating (playlist_id, rating_count, rating_sum, histogram)
+SELECT playlist_id, COUNT(rating), COALESCE(SUM(rating), 0), ARRAY[
+    COUNT(*) FILTER (WHERE rating = 0), COUNT(*) FILTER (WHERE rating = 1), COUNT(*) FILTER (WHERE rating = 2),
+    COUNT(*) FILTER (WHERE rating = 3), COUNT(*) FILTER (WHERE rating = 4), COUNT(*) FILTER (WHERE rating = 5),
+    COUNT(*) FILTER (WHERE rating = 6), COUNT(*) FILTER (WHERE rating = 7), COUNT(*) FILTER (WHERE rating = 8),
+    COUNT(*) FILTER (WHERE rating = 9), COUNT(*) FILTER (WHERE rating = 10)
+]
+FROM Rate
+GROUP BY playlist_id
+ON CONFLICT (playlist_id) DO NOTHING;
@@ -0,0 +1,10 @@
+-- The mean and standard deviation of each audio feature across each playlist's songs,
+-- in the order of the song_features type's fields, kept up to date as playlists are
+-- uploaded so /filter_features ranks playlists without averaging Song.features per request.
+-- Existing playlists are filled in by: flask --app playlistify rebuild-playlist-features
+CREATE TABLE IF NOT EXISTS PlaylistFeatures (
+    playlist_id TEXT PRIMARY KEY REFERENCES Playlist ON DELETE CASCADE,
+    song_count INT NOT NULL,
+    means REAL[] NOT NULL,
+    stds REAL[] NOT NULL
+);
@@ -0,0 +1,9 @@
+-- How many playlists each song is in, kept up to date as playlists are uploaded so the
+-- top songs page (playlistify/browse.py) seeks into this index instead of counting
+-- every PlaylistSong row per request.
+-- Existing playlists are counted by: flask --app playlistify rebuild-song-playlist-counts
+CREATE TABLE IF NOT EXISTS SongPlaylistCount (
+    song_id TEXT PRIMARY KEY REFERENCES Song ON DELETE CASCADE,
+    playlist_count INT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songplaylistcount_top ON SongPlaylistCount (playlist_count, song_id);
@@ -0,0 +1,255 @@
+"""
+Writes analyzed playlists to the database.
+Shared by the /post_playlist route and the bulk ingestion command.
+"""
+
+import re
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import text
+
+from playlistify.genre_index import link_song_genres
+from playlistify.genre_autocomplete import record_genre_counts
+from playlistify.genre_summary import update_genre_summary
+from playlistify.song_playlist_counts import update_song_playlist_counts
+from playlistify.playlist_features import FEATURE_FIELDS, update_playlist_features
+from playlistify.feature_ranking import record_playlist_features
+from playlistify.similarity import record_playlist_songs
+
+
+INT_FEATURE_FIELDS = {'duration_ms', 'music_key', 'music_mode', 'time_signature'}
+
+INSERT_CHUNK_SIZE = 1000  # rows per multi-row INSERT statement
+
+INSERT_PLAYLIST = text("""INSERT INTO playlist (playlist_id, title, image_url, description, snapshot_id)
+                       VALUES (:playlist_id, :title, :image_url, :description, :snapshot_id)
+                       ON CONFLICT (playlist_id) DO UPDATE SET title = EXCLUDED.title, image_url = EXCLUDED.image_url,
+                       description = EXCLUDED.description, snapshot_id = EXCLUDED.snapshot_id""")
+PLAYLIST_SNAPSHOT = text("SELECT snapshot_id FROM Playlist WHERE playlist_id = :playlist_id FOR UPDATE")
+PLAYLIST_SONG_IDS = text("SELECT song_id FROM PlaylistSong WHERE playlist_id = :playlist_id")
+PLAYLIST_ARTIST_IDS = text("SELECT artist_id FROM PlaylistArtists WHERE playlist_id = :playlist_id")
+DELETE_PLAYLIST_SONGS = text("""DELETE FROM PlaylistSong WHERE playlist_id = :playlist_id AND song_id = ANY(:song_ids)
+                             RETURNING song_id""")
+DELETE_PLAYLIST_ARTISTS = text("DELETE FROM PlaylistArtists WHERE playlist_id = :playlist_id AND artist_id = ANY(:artist_ids)")
+INSERT_USER = text("""INSERT INTO Users (user_id, name, image_url)
+                   VALUES (:user_id, :name, :image_url)
+                   ON CONFLICT (user_id) DO NOTHING""")
+INSERT_HAS_PLAYLIST = text("""INSERT INTO HasPlaylist (user_id, playlist_id, date_uploaded)
+                           VALUES (:user_id, :playlist_id, :date)
+                           ON CONFLICT (user_id, playlist_id) DO NOTHING""")
+
+# Multi-row inserts: (INSERT INTO ..., the VALUES tuple for one row, ON CONFLICT ...)
+# Placeholder rows with only features (which older metadata cache writes left behind) are filled in
+INSERT_SONGS = ("INSERT INTO Song (song_id, title, features, popularity, genres, album_url)",
+                "(:song_id, :title, :features, :popularity, ARRAY[:genres], :album_url)",
+                """ON CONFLICT (song_id) DO UPDATE SET title = EXCLUDED.title,
+                features = COALESCE(Song.features, EXCLUDED.features), popularity = EXCLUDED.popularity,
+                genres = EXCLUDED.genres, album_url = EXCLUDED.album_url
+                WHERE Song.title IS NULL""")
+# Returns only the rows this transaction actually added, so a concurrent upload of the
+# same playlist (which waits on these rows, then skips them) doesn't count them twice
+INSERT_PLAYLIST_SONGS = ("INSERT INTO PlaylistSong (playlist_id, song_id)",
+                         "(:playlist_id, :song_id)",
+                         "ON CONFLICT (playlist_id, song_id) DO NOTHING RETURNING song_id")
+# fetched_at lets the metadata cache serve these artists from the table until they go stale
+INSERT_ARTISTS = ("INSERT INTO Artist (artist_id, name, image_url, popularity, genres, fetched_at)",
+                  "(:artist_id, :name, :image_url, :popularity, ARRAY[:genres], NOW())",
+                  "ON CONFLICT (artist_id) DO NOTHING")
+INSERT_SONG_ARTISTS = ("INSERT INTO SongArtist (song_id, artist_id)",
+                       "(:song_id, :artist_id)",
+                       "ON CONFLICT (song_id, artist_id) DO NOTHING")
+INSERT_PLAYLIST_ARTISTS = ("INSERT INTO PlaylistArtists (playlist_id, artist_id)",
+                           "(:playlist_id, :artist_id)",
+                           "ON CONFLICT (playlist_id, artist_id) DO NOTHING")
+
+BIND_PARAM = re.compile(r':(\w+)')
+
+
+def format_features(row):
+    """Format a song_panda row as a Song.features composite literal (None if it has no features)."""
+    if any(pd.isnull(row[field]) for field in FEATURE_FIELDS):
+        return None
+    # Integer features turn into floats once a column has a null in it, and float features
+    # are float32, so print them back at float32 precision (0.2, not 0.20000000298023224)
+    values = [str(int(row[field])) if field in INT_FEATURE_FIELDS else f"{row[field]:.7g}" for field in FEATURE_FIELDS]
+    return f"({', '.join(values)})"
+
+
+def _song_features(song_data, song_ids):
+    """The ids of those of some songs that have every feature, and a matrix of their features."""
+    if not song_ids or not len(song_data):
+        return [], []
+    rows = song_data[song_data['song_id'].isin(song_ids)].dropna(subset=FEATURE_FIELDS)
+    return rows['song_id'].tolist(), rows[FEATURE_FIELDS].to_numpy(dtype=float)
+
+
+def _column(frame, column):
+    """A column as plain Python values for psycopg2 (an empty playlist's frame has no columns)."""
+    return frame[column].tolist() if column in frame else []
+
+
+def insert_rows(conn, statement, rows, key, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Insert many rows with multi-row INSERT ... VALUES statements, chunk_size rows per round trip.
+    @param:
+        - statement: (INSERT INTO ..., VALUES tuple for one row, ON CONFLICT ...)
+        - rows: list of parameter dictionaries, one per row
+        - key: the columns that identify a row; duplicates are dropped and rows are
+          sorted by key, so concurrent uploads lock shared rows in the same order
+    @return:
+        - the rows the statement returned, if it has a RETURNING clause
+    """
+    insert, values, on_conflict = statement
+    unique_rows = {}
+    for row in rows:
+        unique_rows.setdefault(tuple(row[column] for column in key), row)
+    rows = [unique_rows[row_key] for row_key in sorted(unique_rows)]
+
+    returned = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        params = {}
+        row_values = []
+        for i, row in enumerate(chunk):
+            row_values.append(BIND_PARAM.sub(rf':\1_{i}', values))
+            params.update({f'{column}_{i}': value for column, value in row.items()})
+        result = conn.execute(text(f"{insert} VALUES {', '.join(row_values)} {on_conflict}"), params)
+        if result.returns_rows:
+            returned.extend(result.all())
+    return returned
+
+
+def persist_playlist(conn, playlist_data, song_data, art_data, user, date_uploaded=None):
+    """
+    Insert a playlist, its songs and artists, and who uploaded it, skipping rows that already exist.
+    Everything is written in one transaction with one multi-row INSERT per table,
+    so the number of round trips barely grows with the playlist, and a failed
+    upload rolls back instead of leaving a half-written playlist.
+    A playlist that's already in the database is updated incrementally: nothing but the
+    uploader is written if its snapshot_id hasn't changed, and otherwise only the songs
+    added since are inserted and the PlaylistSong/PlaylistArtists rows of removed ones deleted.
+    The playlist's genre summary and its songs' playlist counts are updated from the same diff
+    and its feature means recomputed, and the new genre song counts, features and songs are passed on to this process's genre
+    autocomplete, feature ranking and similarity indexes once they're committed.
+    @param:
+        - conn: SQLAlchemy connection, with no transaction in progress
+        - playlist_data, song_data, art_data: the output of SpotifyAnalyzer.get_playlist_details
+        - user: dictionary with the uploader's user_id, name and image_url
+        - date_uploaded: defaults to now
+    """
+    playlist_id = playlist_data['playlist_id']
+    snapshot_id = playlist_data.get('snapshot_id')
+    song_ids = _column(song_data, 'song_id')
+    artist_ids = _column(art_data, 'artist_id')
+
+    try:
+        conn.execute(INSERT_USER, {
+            'user_id': user['user_id'],
+            'name': user['name'],
+            'image_url': user['image_url']
+        })
+
+        # Lock the playlist's row, so concurrent uploads of it diff against each other's writes.
+        # On a first upload there's no row to lock yet; the PlaylistSong inserts then only
+        # report the rows this upload added, so the other upload's songs aren't counted twice
+        stored = conn.execute(PLAYLIST_SNAPSHOT, {'playlist_id': playlist_id}).first()
+        unchanged = stored is not None and snapshot_id is not None and stored.snapshot_id == snapshot_id
+        if not unchanged:
+            stored_song_ids = set(conn.execute(PLAYLIST_SONG_IDS, {'playlist_id': playlist_id}).scalars())
+            stored_artist_ids = set(conn.execute(PLAYLIST_ARTIST_IDS, {'playlist_id': playlist_id}).scalars())
+            added, genre_counts = _persist_songs(conn, playlist_data, song_data, art_data, stored_song_ids, stored_artist_ids)
+
+            # Like the inserts, only count the rows this transaction actually deleted
+            removed_song_ids = sorted(stored_song_ids.difference(song_ids))
+            removed_artist_ids = sorted(stored_artist_ids.difference(artist_ids))
+            if removed_song_ids:
+                removed_song_ids = sorted(conn.execute(DELETE_PLAYLIST_SONGS, {
+                    'playlist_id': playlist_id, 'song_ids': removed_song_ids}).scalars())
+            if removed_artist_ids:
+                conn.execute(DELETE_PLAYLIST_ARTISTS, {'playlist_id': playlist_id, 'artist_ids': removed_artist_ids})
+            update_genre_summary(conn, playlist_id, added, removed_song_ids)
+            update_song_playlist_counts(conn, added, removed_song_ids)
+            features = update_playlist_features(conn, playlist_id)
+
+        conn.execute(INSERT_HAS_PLAYLIST, {
+            'user_id': user['user_id'],
+            'playlist_id': playlist_id,
+            'date': date_uploaded or datetime.now()
+        })
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if not unchanged:
+        record_genre_counts(genre_counts)
+        record_playlist_features(playlist_id, features)
+        record_playlist_songs(playlist_id, *_song_features(song_data, added), features)
+
+    if unchanged:
+        print(f'playlist unchanged: {playlist_data["title"]}')
+    elif stored is None:
+        print(f'inserted playlist: {playlist_data["title"]} ({len(song_data)} songs, {len(art_data)} artists)')
+    else:
+        print(f'updated playlist: {playlist_data["title"]} ({len(added)} songs added, {len(removed_song_ids)} removed)')
+
+
+def _persist_songs(conn, playlist_data, song_data, art_data, stored_song_ids, stored_artist_ids):
+    """
+    Upsert the playlist's row and insert the songs and artists it doesn't have yet.
+    @return:
+        - (ids of the songs this transaction added to the playlist,
+           dictionary of genre name -> new song count for genres they changed)
+    """
+    playlist_id = playlist_data['playlist_id']
+
+    songs = [{
+        'song_id': song_id,
+        'title': title,
+        'features': format_features(features),
+        'popularity': popularity,
+        'genres': genres,
+        'album_url': album_url
+    } for song_id, title, features, popularity, genres, album_url in zip(
+        _column(song_data, 'song_id'),
+        _column(song_data, 'song_title'),
+        song_data[FEATURE_FIELDS].to_dict('records') if len(song_data) else [],
+        _column(song_data, 'popularity'),
+        _column(song_data, 'genres'),
+        _column(song_data, 'album_url')
+    ) if song_id not in stored_song_ids]
+
+    artists = []
+    song_artists = []
+    for artist_id, name, image_url, popularity, genres, song_id in zip(
+            _column(art_data, 'artist_id'), _column(art_data, 'name'), _column(art_data, 'image_url'),
+            _column(art_data, 'popularity'), _column(art_data, 'genres'), _column(art_data, 'song_id')):
+        if song_id in stored_song_ids:
+            continue
+        artists.append({
+            'artist_id': artist_id,
+            'name': name,
+            'image_url': image_url,
+            'popularity': popularity,
+            'genres': genres if genres else None
+        })
+        song_artists.append({'song_id': song_id, 'artist_id': artist_id})
+
+    conn.execute(INSERT_PLAYLIST, {
+        'playlist_id': playlist_id,
+        'title': playlist_data['title'],
+        'image_url': playlist_data['image_url'],
+        'description': playlist_data['description'],
+        'snapshot_id': playlist_data.get('snapshot_id')
+    })
+    insert_rows(conn, INSERT_SONGS, songs, key=['song_id'])
+    genre_counts = link_song_genres(conn, sorted({song['song_id'] for song in songs}))
+    added = insert_rows(conn, INSERT_PLAYLIST_SONGS,
+                        [{'playlist_id': playlist_id, 'song_id': song['song_id']} for song in songs], key=['song_id'])
+    insert_rows(conn, INSERT_ARTISTS, artists, key=['artist_id'])
+    insert_rows(conn, INSERT_SONG_ARTISTS, song_artists, key=['song_id', 'artist_id'])
+    insert_rows(conn, INSERT_PLAYLIST_ARTISTS,
+                [{'playlist_id': playlist_id, 'artist_id': artist['artist_id']} for artist in artists
+                 if artist['artist_id'] not in stored_artist_ids],
+                key=['artist_id'])
+    return sorted(row.song_id for row in added), genre_counts
@@ -0,0 +1,73 @@
+"""
+Maintains PlaylistFeatures, the mean and standard deviation of each audio feature
+across a playlist's songs (those with features), in FEATURE_FIELDS order.
+persist_playlist recomputes a playlist's row whenever its songs change, in the same
+transaction, so the feature ranking (feature_ranking.py) loads one row per playlist
+instead of averaging Song.features across every PlaylistSong row.
+
+Run rebuild() (flask --app playlistify rebuild-playlist-features) to backfill
+or repair the table from PlaylistSong.
+"""
+
+from sqlalchemy import text
+
+from playlistify.db_config import NO_STATEMENT_TIMEOUT
+
+
+# Order of the subattributes in the Song.features composite type
+FEATURE_FIELDS = [
+    'acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness', 'music_key',
+    'liveness', 'loudness', 'music_mode', 'speechiness', 'tempo', 'time_signature', 'valence'
+]
+
+FEATURE_MEANS = 'CAST(ARRAY[' + ', '.join(f'AVG((Song.features).{field})' for field in FEATURE_FIELDS) + '] AS REAL[])'
+FEATURE_STDS = 'CAST(ARRAY[' + ', '.join(f'STDDEV_POP((Song.features).{field})' for field in FEATURE_FIELDS) + '] AS REAL[])'
+
+PLAYLIST_FEATURES = f"""
+    SELECT PlaylistSong.playlist_id, COUNT(*), {FEATURE_MEANS}, {FEATURE_STDS}
+    FROM PlaylistSong
+    INNER JOIN Song ON Song.song_id = PlaylistSong.song_id
+    WHERE Song.features IS NOT NULL
+"""
+DELETE_PLAYLIST_FEATURES = text("DELETE FROM PlaylistFeatures WHERE playlist_id = :playlist_id")
+INSERT_PLAYLIST_FEATURES = text(f"""
+    INSERT INTO PlaylistFeatures (playlist_id, song_count, means, stds)
+    {PLAYLIST_FEATURES}
+    AND PlaylistSong.playlist_id = :playlist_id
+    GROUP BY PlaylistSong.playlist_id
+    RETURNING playlist_id, song_count, means, stds
+""")
+
+REBUILD_PLAYLIST_FEATURES = text(f"""
+    INSERT INTO PlaylistFeatures (playlist_id, song_count, means, stds)
+    {PLAYLIST_FEATURES}
+    GROUP BY PlaylistSong.playlist_id
+""")
+
+
+def update_playlist_features(conn, playlist_id):
+    """
+    Recompute a playlist's feature means and deviations from its songs. Runs in the caller's transaction.
+    @return:
+        - the playlist's new (playlist_id, song_count, means, stds) row,
+          or None if none of its songs have features (it has no row)
+    """
+    conn.execute(DELETE_PLAYLIST_FEATURES, {'playlist_id': playlist_id})
+    return conn.execute(INSERT_PLAYLIST_FEATURES, {'playlist_id': playlist_id}).first()
+
+
+def rebuild(conn):
+    """
+    Recompute every playlist's feature means and deviations, in one transaction.
+    @return:
+        - number of playlists with songs with features
+    """
+    try:
+        conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+        conn.execute(text("DELETE FROM PlaylistFeatures"))
+        rows = conn.execute(REBUILD_PLAYLIST_FEATURES).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
@@ -0,0 +1,134 @@
+"""
+Ratings of playlists, and PlaylistRating, each playlist's rating count, sum, average
+and histogram (how many ratings of 0, 1, ... 10 it has).
+rate_playlist records a rating and adds it to the playlist's aggregates in one statement,
+so the profile and playlist pages read the aggregates instead of averaging every Rate row.
+
+Run rebuild() (flask --app playlistify rebuild-ratings) to backfill
+or repair the aggregates from Rate.
+"""
+
+from sqlalchemy import text
+
+from playlistify.db_config import NO_STATEMENT_TIMEOUT
+
+
+MAX_RATING = 10
+REVIEWS_PAGE_SIZE = 20
+
+# Histograms as arrays where element i + 1 counts the ratings of i:
+# of one rating, and of the ratings in a group of Rate rows
+RATING_HISTOGRAM = 'ARRAY[' + ', '.join(f'CASE WHEN rating = {i} THEN 1 ELSE 0 END' for i in range(MAX_RATING + 1)) + ']'
+RATINGS_HISTOGRAM = 'ARRAY[' + ', '.join(f'COUNT(*) FILTER (WHERE rating = {i})' for i in range(MAX_RATING + 1)) + ']'
+
+# A user rates a playlist once. The rating is inserted, and counted, only if they haven't
+# rated it yet; a concurrent rating of the same playlist by the same user waits on Rate's
+# primary key and then inserts nothing, so the two can't both be counted.
+RATE_PLAYLIST = text(f"""
+    WITH rated AS (
+        INSERT INTO Rate (user_id, playlist_id, rating, rate_text)
+        VALUES (:user_id, :playlist_id, :rating, :comment)
+        ON CONFLICT (user_id, playlist_id) DO NOTHING
+        RETURNING playlist_id, rating
+    )
+    INSERT INTO PlaylistRating (playlist_id, rating_count, rating_sum, histogram)
+    SELECT playlist_id, 1, rating, {RATING_HISTOGRAM} FROM rated
+    ON CONFLICT (playlist_id) DO UPDATE SET
+        rating_count = PlaylistRating.rating_count + EXCLUDED.rating_count,
+        rating_sum = PlaylistRating.rating_sum + EXCLUDED.rating_sum,
+        histogram = ARRAY(
+            SELECT counts.stored + counts.added
+            FROM UNNEST(PlaylistRating.histogram, EXCLUDED.histogram) WITH ORDINALITY AS counts(stored, added, bucket)
+            ORDER BY counts.bucket
+        )
+    RETURNING playlist_id
+""")
+
+PLAYLIST_RATING_QUERY = text("""
+    SELECT rating_count, avg_rating, histogram
+    FROM PlaylistRating
+    WHERE playlist_id = :playlist_id
+""")
+
+# Newest first
+PLAYLIST_REVIEWS_QUERY = text("""
+    SELECT users.name, Rate.rating, Rate.rate_text
+    FROM Rate
+    INNER JOIN users ON Rate.user_id = users.user_id
+    WHERE Rate.playlist_id = :playlist_id
+    ORDER BY Rate.rated_at DESC, Rate.user_id
+    LIMIT :limit OFFSET :offset
+""")
+
+REBUILD_RATINGS = text(f"""
+    INSERT INTO PlaylistRating (playlist_id, rating_count, rating_sum, histogram)
+    SELECT playlist_id, COUNT(rating), COALESCE(SUM(rating), 0), {RATINGS_HISTOGRAM}
+    FROM Rate
+    GROUP BY playlist_id
+""")
+
+
+def rate_playlist(conn, user_id, playlist_id, rating, comment):
+    """
+    Record a user's rating of a playlist and count it in the playlist's aggregates, and commit.
+    @return:
+        - True if the rating was recorded, False if the user had already rated the playlist
+    """
+    try:
+        rated = conn.execute(RATE_PLAYLIST, {
+            'user_id': user_id,
+            'playlist_id': playlist_id,
+            'rating': rating,
+            'comment': comment
+        }).first() is not None
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rated
+
+
+def playlist_rating(conn, playlist_id):
+    """
+    A playlist's rating aggregates.
+    @return:
+        - dictionary of rating_count, avg_rating (None if unrated) and histogram
+          (list of how many ratings of 0, 1, ... MAX_RATING there are)
+    """
+    row = conn.execute(PLAYLIST_RATING_QUERY, {'playlist_id': playlist_id}).first()
+    if row is None:
+        return {'rating_count': 0, 'avg_rating': None, 'histogram': [0] * (MAX_RATING + 1)}
+    return {'rating_count': row.rating_count, 'avg_rating': row.avg_rating, 'histogram': row.histogram}
+
+
+def playlist_reviews(conn, playlist_id, page=1, page_size=REVIEWS_PAGE_SIZE):
+    """
+    A page of a playlist's reviews, newest first.
+    @param:
+        - page: 1-based page number
+    @return:
+        - (list of (user name, rating, comment) rows, whether there is a next page)
+    """
+    rows = conn.execute(PLAYLIST_REVIEWS_QUERY, {
+        'playlist_id': playlist_id,
+        'limit': page_size + 1,  # one extra row tells us if there's another page
+        'offset': (page - 1) * page_size
+    }).fetchall()
+    return rows[:page_size], len(rows) > page_size
+
+
+def rebuild(conn):
+    """
+    Recount every playlist's ratings from Rate, in one transaction.
+    @return:
+        - number of playlists with ratings
+    """
+    try:
+        conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+        conn.execute(text("DELETE FROM PlaylistRating"))
+        rows = conn.execute(REBUILD_RATINGS).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
@@ -0,0 +1,97 @@
+"""
+Holder for the in-process indexes the app answers some requests from without going
+to the database (genre autocomplete, feature ranking, similarity search).
+The index is loaded on first use and, once it's older than max_age seconds,
+reloaded on a background thread while the old one keeps answering, so changes
+written by other processes (the upload worker, seed) show up within max_age.
+Changes this process makes go through apply(), which updates the loaded index right
+away and replays the update on the new one if a load is in progress, since the load
+may have read the database before the change was committed. Updates must therefore
+be safe to apply twice (they set values rather than add to them).
+"""
+
+import threading
+import time
+
+
+class ReloadingIndex:
+    def __init__(self, name, load, max_age):
+        """
+        @param:
+            - name: what the index is, for error messages
+            - load: function that reads the index from the database and returns it
+            - max_age: seconds before the index is reloaded
+        """
+        self.name = name
+        self.load = load
+        self.max_age = max_age
+        self._index = None
+        self._loaded_at = 0.0
+        self._reloading = False
+        self._reload_lock = threading.Lock()
+        self._load_lock = threading.Lock()  # one load at a time
+        self._update_lock = threading.Lock()  # held while applying updates and swapping in a new index
+        self._pending = None  # updates to replay on the index being loaded, while one is
+
+    def get(self, wait=True):
+        """
+        Get the index, loading it if it hasn't been, and starting a reload if it's old.
+        @param:
+            - wait: if the index hasn't been loaded, load it (or wait for the load in progress),
+              or start loading it on a background thread and return None
+        """
+        if self._index is None:
+            if not wait:
+                self._start_reload()
+                return None
+            with self._load_lock:
+                if self._index is None:
+                    self._load()
+        elif time.monotonic() - self._loaded_at > self.max_age:
+            self._start_reload()
+        return self._index
+
+    def apply(self, update):
+        """
+        Apply a change this process committed to the index: update(index) is called on the
+        loaded index, if there is one, and on the one being loaded, once it has been.
+        """
+        with self._update_lock:
+            if self._pending is not None:
+                self._pending.append(update)
+            if self._index is not None:
+                update(self._index)
+
+    def _load(self):
+        """Load the index and swap it in, replaying the updates applied while it was loading. Hold _load_lock."""
+        with self._update_lock:
+            self._pending = []
+        try:
+            index = self.load()
+            with self._update_lock:
+                for update in self._pending:
+                    update(index)
+                self._index, self._loaded_at = index, time.monotonic()
+        finally:
+            with self._update_lock:
+                self._pending = None
+
+    def _start_reload(self):
+        with self._reload_lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, name=f'{self.name} reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            with self._load_lock:
+                self._load()
+        except Exception as e:
+            print(f"Error loading the {self.name}: {e}")
+        finally:
+            self._reloading = False
+
+    def preload(self):
+        """Load the index on a background thread, so the first request doesn't wait on it."""
+        self._start_reload()
@@ -0,0 +1,392 @@
+"""
+A shared store for playlist analysis results, so DataFrames stay out of the session.
+Results are content-addressed by (playlist id, Spotify snapshot_id): a playlist's
+snapshot_id changes whenever its tracks do, so a stored result never goes stale,
+and everyone who analyzes the same version of a playlist shares one copy.
+The session only holds the result's key. Each playlist's latest result is also
+remembered, so when its snapshot changes only the tracks added since need analyzing.
+
+Two backends share one interface (get/view/put/latest/stats), both evicting the least
+recently used results once they hold more than RESULTS_MAX_BYTES:
+    - DiskResultStore, one file per result (the default, in the instance folder)
+    - RedisResultStore, for RESULTS_URL=redis://...
+
+Results are stored as MessagePack (msgspec) with the song and artist frames laid out
+column by column: numeric columns are their raw array bytes, categories are codes
+plus the category values, and only object columns (titles, genre lists) are encoded
+value by value. Decoding reads numeric columns with np.frombuffer, so each is copied
+once (into the DataFrame) rather than parsed value by value, a frame that isn't needed
+is skipped without being decoded, and nothing in a result can run code when it's loaded,
+unlike pickle.
+"""
+
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import msgspec
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+
+RESULTS_MAX_BYTES = int(os.getenv('RESULTS_MAX_BYTES', 512 * 1024 * 1024))
+
+# Bumped whenever the stored layout changes, so old results are missed (and age out) instead of misread
+RESULT_FORMAT = 2
+
+
+class Column(msgspec.Struct, array_like=True):
+    name: str
+    kind: str  # array, masked, category, dictionary or object; see encode_frame
+    dtype: str  # numpy dtype of data, or the nullable integer dtype of a masked column
+    data: memoryview | None = None  # array bytes, or codes into values
+    mask: memoryview | None = None  # missing values of a masked column
+    values: list | None = None  # object column values, or the distinct values codes point into
+
+
+class Frame(msgspec.Struct, array_like=True):
+    length: int
+    columns: list[Column]
+
+
+class Result(msgspec.Struct, array_like=True):
+    playlist_data: dict
+    song_panda: msgspec.Raw
+    art_panda: msgspec.Raw
+
+
+_encoder = msgspec.msgpack.Encoder()
+_frame_decoder = msgspec.msgpack.Decoder(Frame)
+_result_decoder = msgspec.msgpack.Decoder(Result)
+
+
+def result_key(playlist_id, snapshot_id):
+    """The key a version of a playlist's analysis is stored under."""
+    return f'{playlist_id}:{snapshot_id}:{RESULT_FORMAT}'
+
+
+def _dictionary_encode(values):
+    """
+    Get each value's code and the distinct values they point into,
+    or (None, None) if the values can't be hashed.
+    """
+    codes = []
+    distinct = []
+    seen = {}
+    try:
+        for value in values:
+            key = tuple(value) if isinstance(value, list) else value
+            code = seen.get(key)
+            if code is None:
+                code = seen[key] = len(distinct)
+                distinct.append(value)
+            codes.append(code)
+    except TypeError:
+        return None, None
+    return codes, distinct
+
+
+def _object_array(values):
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def _codes(count):
+    return np.int8 if count < 2 ** 7 else np.int16 if count < 2 ** 15 else np.int32
+
+
+def encode_frame(frame):
+    """
+    Lay a DataFrame out column by column (its index isn't kept):
+        - array: numeric columns, as their raw bytes
+        - masked: nullable integer columns, as their values plus a missing value mask
+        - category: category columns, as codes into their categories
+        - dictionary: object columns that mostly repeat (artists' genre lists), as codes into their distinct values
+        - object: any other column, value by value
+    """
+    columns = []
+    for name, series in frame.items():
+        name = str(name)
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            codes = series.cat.codes.to_numpy()
+            columns.append(Column(name, 'category', codes.dtype.str, data=memoryview(codes),
+                                  values=series.cat.categories.tolist()))
+        elif isinstance(series.array, pd.arrays.IntegerArray):
+            data = series.to_numpy(dtype=dtype.numpy_dtype, na_value=0)
+            columns.append(Column(name, 'masked', dtype.name, data=memoryview(data),
+                                  mask=memoryview(series.isna().to_numpy())))
+        elif isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+            data = np.ascontiguousarray(series.to_numpy())
+            columns.append(Column(name, 'array', dtype.str, data=memoryview(data)))
+        else:
+            values = series.tolist()
+            codes, distinct = _dictionary_encode(values)
+            if codes is not None and len(distinct) * 2 <= len(values):
+                codes = np.array(codes, dtype=_codes(len(distinct)))
+                columns.append(Column(name, 'dictionary', codes.dtype.str, data=memoryview(codes), values=distinct))
+            else:
+                columns.append(Column(name, 'object', 'object', values=values))
+    return _encoder.encode(Frame(len(frame), columns))
+
+
+def decode_frame(buffer):
+    """Rebuild a DataFrame from encode_frame's bytes. The DataFrame has its own copy of the data, so the buffer can be closed."""
+    frame = _frame_decoder.decode(buffer)
+    columns = {}
+    for column in frame.columns:
+        if column.kind == 'array':
+            columns[column.name] = np.frombuffer(column.data, dtype=column.dtype)
+        elif column.kind == 'masked':
+            dtype = pd.api.types.pandas_dtype(column.dtype)
+            values = np.frombuffer(column.data, dtype=dtype.numpy_dtype)
+            columns[column.name] = pd.arrays.IntegerArray(values, np.frombuffer(column.mask, dtype=bool))
+        elif column.kind == 'category':
+            codes = np.frombuffer(column.data, dtype=column.dtype)
+            columns[column.name] = pd.Categorical.from_codes(codes, column.values)
+        elif column.kind == 'dictionary':
+            # Rows with the same value share one object, as they did before encoding
+            distinct = _object_array(column.values)
+            columns[column.name] = distinct[np.frombuffer(column.data, dtype=column.dtype)]
+        else:
+            columns[column.name] = _object_array(column.values)
+    return pd.DataFrame(columns, index=pd.RangeIndex(frame.length), copy=True)
+
+
+def encode_result(playlist_data, song_panda, art_panda):
+    """Serialize an analysis (get_playlist_details' output) for the store."""
+    return _encoder.encode(Result(playlist_data, msgspec.Raw(encode_frame(song_panda)),
+                                  msgspec.Raw(encode_frame(art_panda))))
+
+
+def decode_result(buffer, artists=True):
+    """
+    Deserialize a stored analysis from bytes or a memory map.
+    @param:
+        - artists: also decode art_panda (otherwise it's skipped and None is returned for it)
+    @return:
+        - (playlist_data, song_panda, art_panda)
+    """
+    result = _result_decoder.decode(buffer)
+    art_panda = decode_frame(result.art_panda) if artists else None
+    return result.playlist_data, decode_frame(result.song_panda), art_panda
+
+
+class DiskResultStore:
+    def __init__(self, directory, max_bytes=RESULTS_MAX_BYTES):
+        """
+        Store results as files in directory. A file's mtime is bumped whenever it's read,
+        so eviction removes the files that were least recently used.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.result')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return value
+
+    @contextmanager
+    def view(self, key):
+        """
+        Like get, but memory-maps the result instead of reading it in.
+        Used as `with store.view(key) as buffer:`; the map is closed when the block ends,
+        so decode it inside the block (buffer is None if there's no such result).
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except FileNotFoundError:
+            self._count('misses')
+            yield None
+            return
+        self._count('hits')
+        try:
+            yield value
+        finally:
+            value.close()
+
+    def put(self, key, value, playlist_id=None):
+        """Store a result, and record it as playlist_id's latest if given."""
+        self._write(self._path(key), value)
+        if playlist_id is not None:
+            self._write(self._latest_path(playlist_id), key.encode())
+        self._evict()
+
+    def latest(self, playlist_id):
+        """The key of the result most recently stored for a playlist (it may have been evicted since), or None."""
+        try:
+            with open(self._latest_path(playlist_id), 'rb') as f:
+                return f.read().decode()
+        except FileNotFoundError:
+            return None
+
+    def _latest_path(self, playlist_id):
+        return os.path.join(self.directory, hashlib.sha256(playlist_id.encode()).hexdigest() + '.latest')
+
+    def _write(self, path, value):
+        # Write to a temp file and rename it into place, so readers never see half a result
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        """Remove the least recently used results until the store fits in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.result'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # evicted by another process
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._count('evictions')
+            if total <= self.max_bytes:
+                break
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats['results'] = 0
+        stats['bytes'] = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.result'):
+                    stats['results'] += 1
+                    stats['bytes'] += entry.stat().st_size
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class RedisResultStore:
+    def __init__(self, url, max_bytes=RESULTS_MAX_BYTES, name='playlistify:results'):
+        """
+        Store results in Redis. A sorted set ranks results by last use and a hash
+        tracks their sizes, so eviction removes the least recently used results.
+        """
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.max_bytes = max_bytes
+        self.name = name
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return f'{self.name}:{key}'
+
+    def get(self, key):
+        value = self.redis.get(self._key(key))
+        if value is None:
+            self._count('misses')
+            return None
+        self.redis.zadd(f'{self.name}:lru', {key: time.time()}, xx=True)
+        self._count('hits')
+        return value
+
+    @contextmanager
+    def view(self, key):
+        # Redis hands back the whole value anyway
+        yield self.get(key)
+
+    def put(self, key, value, playlist_id=None):
+        """Store a result, and record it as playlist_id's latest if given."""
+        pipe = self.redis.pipeline()
+        pipe.set(self._key(key), value)
+        pipe.zadd(f'{self.name}:lru', {key: time.time()})
+        pipe.hset(f'{self.name}:sizes', key, len(value))
+        if playlist_id is not None:
+            pipe.hset(f'{self.name}:latest', playlist_id, key)
+        pipe.execute()
+        self._evict()
+
+    def latest(self, playlist_id):
+        """The key of the result most recently stored for a playlist (it may have been evicted since), or None."""
+        key = self.redis.hget(f'{self.name}:latest', playlist_id)
+        return key.decode() if key is not None else None
+
+    def _evict(self):
+        """Remove the least recently used results until the store fits in max_bytes."""
+        sizes = self.redis.hvals(f'{self.name}:sizes')
+        total = sum(int(size) for size in sizes)
+        while total > self.max_bytes:
+            popped = self.redis.zpopmin(f'{self.name}:lru')
+            if not popped:
+                break
+            key = popped[0][0].decode()
+            size = self.redis.hget(f'{self.name}:sizes', key)
+            pipe = self.redis.pipeline()
+            pipe.delete(self._key(key))
+            pipe.hdel(f'{self.name}:sizes', key)
+            pipe.execute()
+            total -= int(size or 0)
+            self._count('evictions')
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        sizes = self.redis.hvals(f'{self.name}:sizes')
+        stats['results'] = len(sizes)
+        stats['bytes'] = sum(int(size) for size in sizes)
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+def create_store(url, max_bytes=RESULTS_MAX_BYTES):
+    """Create the result store a RESULTS_URL points at (redis://... or a directory)."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisResultStore(url, max_bytes)
+    return DiskResultStore(url, max_bytes)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_result_store():
+    """Get the app's result store (RESULTS_URL, defaulting to the instance folder), creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            url = current_app.config.get('RESULTS_URL') or os.path.join(current_app.instance_path, 'results')
+            _store = create_store(url)
+        return _store
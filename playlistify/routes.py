@@ -1,14 +1,20 @@
-from flask import Blueprint, render_template, g, request, redirect, url_for, session, jsonify, abort
+from flask import Blueprint, render_template, g, request, redirect, url_for, session, jsonify, abort, make_response, current_app
 import pandas as pd
-import os, json, ast
-import pickle, zlib
-import requests
+import os, json, ast, math
 import base64
-from datetime import datetime
+import hmac
 from sqlalchemy import text
 
 from playlistify.SpotifyAnalyzer import SpotifyAnalyzer, extract_playlist_id
-from .db_config import my_engine
+from playlistify import http_client, metadata_cache, jobs
+from playlistify.browse import fetch_page, PAGE_SIZES
+from playlistify.jobs import enqueue_upload
+from playlistify.search import search_playlists, SEARCH_QUERIES, PAGE_SIZE
+from playlistify.genre_autocomplete import get_genre_index
+from playlistify.feature_ranking import get_feature_index, RANKED_PLAYLISTS, MAX_RANKED_PLAYLISTS, STATS
+from playlistify.playlist_features import FEATURE_FIELDS
+from playlistify.result_store import get_result_store, result_key, encode_result, decode_result
+from .db_config import my_engine, pool_stats
 
 # Client info
 CLIENT_ID = os.getenv('CLIENT_ID')
@@ -19,6 +25,9 @@ TOKEN_URL = 'https://accounts.spotify.com/api/token'
 SEARCH_ENDPOINT = 'https://api.spotify.com/v1/search'
 REDIRECT_URI = os.getenv('REDIRECT_URI')
 
+# Where /metrics can be read from when no METRICS_TOKEN is set
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
 # Create main_blueprint as a Blueprint object
 main = Blueprint('main', __name__)
 
@@ -44,7 +53,7 @@ def auth():
     data = {'grant_type': 'client_credentials'}
     
     try: # Try to get access token for Spotify API
-        res = requests.post(TOKEN_URL, headers=headers, data=data)
+        res = http_client.post(TOKEN_URL, headers=headers, data=data)
         # if res.status_code == 200:
         #     access_token = res.json()['access_token']
         #     session['access_token'] = access_token
@@ -73,28 +82,52 @@ def analyze_playlist(playlist_id):
         session['playlist_id'] = playlist_id
         return redirect(url_for('main.auth'))
     
-    # Process the playlist link
+    # Process the playlist link, unless this version of it has been analyzed before
+    store = get_result_store()
     try:
         Sp = SpotifyAnalyzer(redirect_uri=REDIRECT_URI, token=session['access_token'])
-        play_dict, song_pd, art_pd = Sp.get_playlist_details(playlist_id)
+        snapshot_id = Sp.get_playlist_snapshot(playlist_id)
+        key = result_key(playlist_id, snapshot_id) if snapshot_id else None
+        if key is None or store.get(key) is None:
+            # Start from the playlist's last analysis if there is one, so only tracks added since get analyzed
+            latest = store.latest(playlist_id)
+            previous = store.get(latest) if latest else None
+            previous = decode_result(previous) if previous is not None else None
+            play_dict, song_pd, art_pd = Sp.get_playlist_details(playlist_id, previous=previous)
+            # Key by the snapshot the analysis actually saw, in case the playlist changed in between
+            key = result_key(playlist_id, play_dict['snapshot_id'])
+            store.put(key, encode_result(play_dict, song_pd, art_pd), playlist_id=playlist_id)
     except Exception as e:
         session['playlist_id'] = playlist_id
         return redirect(url_for('main.auth'))
-    session['playlist_data'] = play_dict
 
-    # Pickle data to compress and store in session
-    pickled_panda = zlib.compress(pickle.dumps(song_pd))
-    pickled_artsy_panda = zlib.compress(pickle.dumps(art_pd))
-    session['song_panda'] = pickled_panda
-    session['art_panda'] = pickled_artsy_panda
+    # The session only holds the key; the analysis itself is shared in the result store
+    session['playlist_id'] = playlist_id
+    session['result_key'] = key
     return redirect(url_for('main.playlist'))
 
 
+def load_result(artists=True):
+    """
+    Get the analysis the session's result_key points at.
+    @param:
+        - artists: also load art_panda (otherwise it's None)
+    @return:
+        - (playlist_data, song_panda, art_panda), or None if there isn't one or it was evicted
+    """
+    if 'result_key' not in session:
+        return None
+    with get_result_store().view(session['result_key']) as buffer:
+        if buffer is None:
+            return None
+        return decode_result(buffer, artists=artists)
+
+
 @main.route('/playlist', methods=['GET'])
 def playlist():
-    if 'playlist_data' in session:
-        playlist_data = session['playlist_data']
-        song_data = pickle.loads(zlib.decompress(session['song_panda']))
+    result = load_result(artists=False)
+    if result is not None:
+        playlist_data, song_data, _ = result
 
         # Helper function to comma-join
         def join_genres(genres):
@@ -104,143 +137,63 @@ def playlist():
                 return genres
             
         song_data['genres'] = song_data['genres'].apply(join_genres)
+
+        # float32 features would otherwise print as e.g. 0.20000000298023224
+        float_columns = song_data.select_dtypes('float32').columns
+        song_data[float_columns] = song_data[float_columns].map(lambda x: float(f"{x:.7g}"))
         return render_template('playlist.html', playlist_data=playlist_data, song_data=song_data)
+    elif 'result_key' in session:
+        # Evicted from the result store since; analyze the playlist again
+        return redirect(url_for('main.analyze_playlist', playlist_id=session['playlist_id']))
     else:
         return redirect(url_for('main.home'))
 
 @main.route('/post_playlist', methods=['POST', 'GET'])
 def post_playlist():
-    if 'playlist_data' in session:
+    blob = get_result_store().get(session['result_key']) if 'result_key' in session else None
+    if blob is not None:
 
         if 'user_access_token' not in session:
             return redirect(url_for('login.user_login'))
 
-        playlist_data = session['playlist_data']
-        song_data = pickle.loads(zlib.decompress(session['song_panda']))
-        art_data = pickle.loads(zlib.decompress(session['art_panda']))
+        # The job worker does the inserts; the page polls /jobs/<job_id> for the outcome
+        user = {
+            'user_id': session['user_id'],
+            'name': session['display_name'],
+            'image_url': session['user_img']
+        }
+        job_id = enqueue_upload(jobs.get_queue(), blob, user)
+        return jsonify(job_id=job_id, status_url=url_for('main.job_status', job_id=job_id)), 202
 
+    print("Error uploading playlist to database")
+    return jsonify(error='No playlist to upload'), 400
 
-        # Insert data into database if it doesn't already exist
-        with my_engine.connect() as conn:
-            # Insert playlist
-            insert_playlist = text("""INSERT INTO playlist (playlist_id, title, image_url, description) 
-                                   VALUES (:playlist_id, :title, :image_url, :description) 
-                                   ON CONFLICT (playlist_id) DO NOTHING""")
-            params = {
-                'playlist_id': playlist_data['playlist_id'],
-                'title': playlist_data['title'],
-                'image_url': playlist_data['image_url'],
-                'description': playlist_data['description']
-            }
-            conn.execute(insert_playlist, params)
-            conn.commit()
-            print(f'inserted playlist: {playlist_data["title"]}')
-
-            # Insert Users
-            insert_user = text("""INSERT INTO Users (user_id, name, image_url) 
-                                VALUES (:user_id, :name, :image_url) 
-                                ON CONFLICT (user_id) DO NOTHING""")
-            params = {
-                'user_id': session['user_id'],
-                'name': session['display_name'],
-                'image_url': session['user_img']
-            }
-            conn.execute(insert_user, params)
-            conn.commit()
-            print(f"inserted user: {session['display_name']}")
-
-            # Insert HasPlaylist
-            insert_has_playlist = text("""INSERT INTO HasPlaylist (user_id, playlist_id, date_uploaded) 
-                                       VALUES (:user_id, :playlist_id, :date) 
-                                       ON CONFLICT (user_id, playlist_id) DO NOTHING""")
-            params = {
-                'user_id': session['user_id'],
-                'playlist_id': playlist_data['playlist_id'],
-                'date': datetime.now()
-            }
-            conn.execute(insert_has_playlist, params)
-            conn.commit()
-            print(f"inserted HasPlaylist: ({session['display_name']}, {playlist_data['title']})")
-
-            # Insert Song
-            for _, row in song_data.iterrows():
-                insert_song = text("""
-                    INSERT INTO Song (song_id, title, features, popularity, genres, album_url)
-                    VALUES (:song_id, :title, :features, :popularity, ARRAY[:genres], :album_url) 
-                    ON CONFLICT (song_id) DO NOTHING
-                """)
-                params = {
-                    'song_id': row['song_id'],
-                    'title': row['song_title'],
-                    'features': f"({row['acousticness']}, {row['danceability']}, {row['duration_ms']}, {row['energy']}, "
-                                f"{row['instrumentalness']}, {row['music_key']}, {row['liveness']}, {row['loudness']}, "
-                                f"{row['music_mode']}, {row['speechiness']}, {row['tempo']}, {row['time_signature']}, "
-                                f"{row['valence']})",
-                    'popularity': row['popularity'],
-                    'genres': row['genres'],
-                    'album_url': row['album_url']
-                }
-                conn.execute(insert_song, params)
-                conn.commit()
-                print(f'inserted song: {row["song_title"]}')
-
-                # Insert PlaylistSong
-                insert_playlist_song = text("""INSERT INTO PlaylistSong (playlist_id, song_id) 
-                                          VALUES (:playlist_id, :song_id) 
-                                          ON CONFLICT (playlist_id, song_id) DO NOTHING""")
-                params = {
-                    'playlist_id': playlist_data['playlist_id'],
-                    'song_id': row['song_id']
-                }
-                conn.execute(insert_playlist_song, params)
-                conn.commit()
-                print(f'inserted playlist_song: ({playlist_data["title"]}, {row["song_title"]})')
-
-            # Insert Artist
-            for _, row in art_data.iterrows():
-                insert_artist = text("""INSERT INTO Artist (artist_id, name, image_url, popularity, genres) 
-                                   VALUES (:artist_id, :name, :image_url, :popularity, ARRAY[:genres]) 
-                                   ON CONFLICT (artist_id) DO NOTHING""")
-                params = {
-                    'artist_id': row['artist_id'],
-                    'name': row['name'],
-                    'image_url': row['image_url'],
-                    'popularity': row['popularity'],
-                    'genres': row['genres']
-                }
-                conn.execute(insert_artist, params)
-                conn.commit()
-                print(f'inserted artist: {row["name"]}')
-
-                # Insert SongArtists
-                insert_song_artist = text("""INSERT INTO SongArtist (song_id, artist_id) 
-                                      VALUES (:song_id, :artist_id) 
-                                      ON CONFLICT (song_id, artist_id) DO NOTHING""")
-                params = {
-                    'song_id': row['song_id'],
-                    'artist_id': row['artist_id']
-                }
-                conn.execute(insert_song_artist, params)
-                conn.commit()
-                print(f'inserted song_artist: ({row["song_title"]}, {row["name"]})')
-
-                # Insert PlaylistArtists
-                insert_song_artist = text("""INSERT INTO PlaylistArtists (playlist_id, artist_id) 
-                                      VALUES (:playlist_id, :artist_id) 
-                                      ON CONFLICT (playlist_id, artist_id) DO NOTHING""")
-                params = {
-                    'playlist_id': playlist_data['playlist_id'],
-                    'artist_id': row['artist_id']
-                }
-                conn.execute(insert_song_artist, params)
-                conn.commit()
-                print(f'inserted playlist_artist: ({playlist_data["playlist_id"]}, {row["name"]})')
 
+@main.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report an upload job's status: queued, running, done or failed."""
+    status = jobs.get_queue().status(job_id)
+    # Only the user who queued a job can see it
+    if status is None or status['owner'] != session.get('user_id'):
+        abort(404)
+    return jsonify(status)
+
+
+def metrics_allowed():
+    """Whether the request may read /metrics: it has METRICS_TOKEN as its bearer token, or comes from this machine if there's no token."""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return request.remote_addr in LOCAL_ADDRESSES
 
-    else:
-        print("Error uploading playlist to database")
-    
-    return redirect(url_for('main.playlist'))
+
+@main.route('/metrics')
+def metrics():
+    """Report the Spotify call counters, metadata cache hit rates, database pool usage and result store usage as JSON."""
+    if not metrics_allowed():
+        abort(403)
+    return jsonify(spotify_http=http_client.stats(), metadata_cache=metadata_cache.stats(), db_pool=pool_stats(),
+                   result_store=get_result_store().stats())
 
 
 @main.route('/browse')
@@ -252,140 +205,23 @@ def browse():
 def search():
     return render_template('search.html')
 
-# new to part 4
-@main.route('/filter_genres', methods=['GET'])
-def filter_genres():
-    search_results = []
-    song_search_results = []
-    genres = []
-    with my_engine.connect() as conn:
-        if (request.args.get('genre_filter[]') is not None):
-            genres = request.args.getlist('genre_filter[]')
-            search_query = text("""
-                SELECT DISTINCT Users.name, Users.image_url, Playlist.playlist_id, Playlist.image_url, Playlist.title, Playlist.description,
-                (
-                    SELECT ARRAY_AGG(genre)
-                    FROM (
-                        SELECT genre
-                        FROM (
-                            SELECT genre
-                            FROM Song
-                            INNER JOIN PlaylistSong ON Song.song_id = PlaylistSong.song_id
-                            CROSS JOIN UNNEST(Song.genres) as genre
-                            WHERE PlaylistSong.playlist_id = Playlist.playlist_id
-                            AND genre = ANY(:genres)
-                        ) AS matching_genres
-                        UNION
-                        SELECT genre
-                        FROM (
-                            SELECT genre, COUNT(*) as count
-                            FROM Song
-                            INNER JOIN PlaylistSong ON Song.song_id = PlaylistSong.song_id
-                            CROSS JOIN UNNEST(Song.genres) as genre
-                            WHERE PlaylistSong.playlist_id = Playlist.playlist_id
-                            AND genre IS NOT NULL
-                            GROUP BY genre
-                            ORDER BY count DESC
-                            LIMIT 3
-                        ) AS top_genres
-                    ) AS union_subquery
-                ) AS genres
-                FROM HasPlaylist
-                INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-                INNER JOIN Song ON Song.song_id = PlaylistSong.song_id
-                CROSS JOIN UNNEST(Song.genres) as genre
-                WHERE genre = ANY(:genres)
-            """)
-            params = {'genres': genres}
-            cursor = conn.execute(search_query, params)
-            for result in cursor:
-                search_results.append(result)
-            
-            song_search_query = text("""
-                SELECT Song.title, Song.album_url, ARRAY_AGG(Artist.name) as artists, Song.genres, PlaylistSong.playlist_id, Users.name
-                FROM Song
-                INNER JOIN SongArtist ON Song.song_id = SongArtist.song_id
-                INNER JOIN Artist ON SongArtist.artist_id = Artist.artist_id
-                INNER JOIN PlaylistSong ON Song.song_id = PlaylistSong.song_id
-                INNER JOIN HasPlaylist ON HasPlaylist.playlist_id = PlaylistSong.playlist_id
-                INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                CROSS JOIN UNNEST(Song.genres) as genre
-                WHERE genre = ANY(:genres)
-                GROUP BY Song.title, Song.album_url, Song.genres, PlaylistSong.playlist_id, Users.name
-            """)
-            params = {'genres': genres}
-            cursor = conn.execute(song_search_query, params)
-            for result in cursor:
-                song_search_results.append(result[0:6])
-        else:
-            search_query = text("""
-                SELECT DISTINCT Users.name, Users.image_url, Playlist.playlist_id, Playlist.image_url, Playlist.title, Playlist.description,
-                (
-                    SELECT ARRAY_AGG(genre)
-                    FROM (
-                        SELECT UNNEST(genres) as genre, COUNT(*) as count
-                        FROM Song
-                        INNER JOIN PlaylistSong ON Song.song_id = PlaylistSong.song_id
-                        WHERE PlaylistSong.playlist_id = Playlist.playlist_id
-                        GROUP BY genre
-                        ORDER BY count DESC
-                        LIMIT 3
-                    ) AS subquery
-                ) AS genres
-                FROM HasPlaylist
-                INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-                INNER JOIN (
-                    SELECT song_id, UNNEST(genres) as genre
-                    FROM Song
-                ) AS Song ON PlaylistSong.song_id = Song.song_id
-            """)
-            cursor = conn.execute(search_query)
-            for result in cursor:
-                search_results.append(result)
-            
-            song_search_query = text("""
-                WITH song_counts AS (
-                    SELECT song_id, COUNT(*) as playlist_count
-                    FROM PlaylistSong
-                    GROUP BY song_id
-                ),
-                playlist_users AS (
-                    SELECT playlist_id, user_id
-                    FROM HasPlaylist
-                )
-                SELECT Song.title, Song.album_url, ARRAY_AGG(Artist.name) as artists, Song.genres, Users.name, song_counts.playlist_count
-                FROM Song
-                INNER JOIN song_counts ON Song.song_id = song_counts.song_id
-                INNER JOIN SongArtist ON Song.song_id = SongArtist.song_id
-                INNER JOIN Artist ON SongArtist.artist_id = Artist.artist_id
-                INNER JOIN PlaylistSong ON Song.song_id = PlaylistSong.song_id
-                INNER JOIN playlist_users ON PlaylistSong.playlist_id = playlist_users.playlist_id
-                INNER JOIN Users ON playlist_users.user_id = Users.user_id
-                GROUP BY Song.title, Song.album_url, Song.genres, Users.name, song_counts.playlist_count
-                ORDER BY song_counts.playlist_count DESC
-                LIMIT 10
-            """)
-            cursor = conn.execute(song_search_query)
-            for result in cursor:
-                song_search_results.append(result[0:6])
-
-    # Process playlist search results
-    if search_results:
-        search_results = pd.DataFrame(search_results, columns=['user_name', 'user_img', 'playlist_id', 'playlist_img', 'playlist_title', 'playlist_desc', 'genres'])
+
+def playlist_frame(rows, genres):
+    """Playlist rows from browse.fetch_page as a DataFrame, each genre as a tuple (genre, is_selected)."""
+    playlists = pd.DataFrame(rows, columns=['user_name', 'user_img', 'playlist_id', 'playlist_img', 'playlist_title', 'playlist_desc', 'genres'])
 
     # Turn each row into array of tuples (genre, is_selected)
-    search_results["genres"] = search_results["genres"].apply(lambda x: [(genre, genre in genres) for genre in x])
-    search_results["genres"] = search_results["genres"].apply(lambda genres: [genre for genre in genres if genre[0] is not None])
+    playlists["genres"] = playlists["genres"].apply(lambda x: [(genre, genre in genres) for genre in x])
+    playlists["genres"] = playlists["genres"].apply(lambda genres: [genre for genre in genres if genre[0] is not None])
+    return playlists
 
-    # Process song search results
-    song_search_results = pd.DataFrame(song_search_results, columns=['song_title', 'album_url', 'artists', 'genres', 'playlist_id', 'user_name'])
+
+def song_frame(rows, genres):
+    """Song rows from browse.fetch_page as a DataFrame, each genre as a tuple (genre, is_selected)."""
+    songs = pd.DataFrame(rows, columns=['song_title', 'album_url', 'artists', 'genres', 'playlist_id', 'user_name'])
 
     # If genres are stored as strings, convert them back to lists
-    song_search_results["genres"] = song_search_results["genres"].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+    songs["genres"] = songs["genres"].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
 
     # Help unpack genres from nested lists, NoneType errors, and duplicates
     def process_genres(x):
@@ -400,12 +236,60 @@ def filter_genres():
                             result.append(item)
             return list(set(result)) # remove duplicates
 
-    song_search_results["genres"] = song_search_results["genres"].apply(process_genres)
+    songs["genres"] = songs["genres"].apply(process_genres)
 
     # Turn each genre into a tuple (genre, is_selected)
-    song_search_results["genres"] = song_search_results["genres"].apply(lambda x: [(genre, genre in genres) for genre in x])
+    songs["genres"] = songs["genres"].apply(lambda x: [(genre, genre in genres) for genre in x])
+    return songs
+
+
+# new to part 4
+@main.route('/filter_genres', methods=['GET'])
+def filter_genres():
+    # Only the first page of playlists and songs; the rest come from /filter_genres/more
+    genres = request.args.getlist('genre_filter[]')
+    with my_engine.connect() as conn:
+        playlists, playlists_after = fetch_page(conn, 'playlists', genres)
+        songs, songs_after = fetch_page(conn, 'songs', genres)
+
+    return render_template('browse.html', playlists=playlist_frame(playlists, genres), songs=song_frame(songs, genres), query=genres,
+                           playlists_after=playlists_after, songs_after=songs_after)
 
-    return render_template('browse.html', playlists=search_results, songs=song_search_results, query=genres)
+
+@main.route('/filter_genres/more', methods=['GET'])
+def filter_genres_more():
+    """The next page of /filter_genres's playlists or songs, as cards to append to the page."""
+    kind = request.args.get('kind')
+    if kind not in PAGE_SIZES:
+        abort(400, f'Unknown kind: {kind}')
+    genres = request.args.getlist('genre_filter[]')
+    with my_engine.connect() as conn:
+        page = fetch_page(conn, kind, genres, after=request.args.get('after'),
+                          page_size=request.args.get('page_size', type=int))
+    if page is None:
+        abort(400, 'Invalid cursor')
+    rows, after = page
+
+    if kind == 'playlists':
+        response = make_response(render_template('browse_playlists.html', playlists=playlist_frame(rows, genres)))
+    else:
+        response = make_response(render_template('browse_songs.html', songs=song_frame(rows, genres)))
+    if after:
+        response.headers['X-Next-Cursor'] = after  # No header on the last page
+    return response
+
+
+# Playlists with a song of the genre, found through the genre index
+GENRE_SEARCH_QUERY = text("""
+    SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
+    FROM Genre
+    INNER JOIN SongGenre ON SongGenre.genre_id = Genre.genre_id
+    INNER JOIN PlaylistSong ON PlaylistSong.song_id = SongGenre.song_id
+    INNER JOIN Playlist ON Playlist.playlist_id = PlaylistSong.playlist_id
+    INNER JOIN HasPlaylist ON HasPlaylist.playlist_id = Playlist.playlist_id
+    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
+    WHERE Genre.name = :query
+""")
 
 @main.route('/search_results', methods=['GET'])
 def search_results():
@@ -415,114 +299,46 @@ def search_results():
 
         if search_type == 'genre_filter':
             with my_engine.connect() as conn:
-                search_query = text("""
-                    SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
-                    FROM HasPlaylist
-                    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                    INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                    INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-                    INNER JOIN Song ON PlaylistSong.song_id = Song.song_id
-                    WHERE :query = ANY(Song.genres)
-                """)
                 params = {'query': search_term}
-                cursor = conn.execute(search_query, params)
+                cursor = conn.execute(GENRE_SEARCH_QUERY, params)
                 search_results = []
                 for result in cursor:
                     search_results.append(result[0:3])
                 search_results = pd.DataFrame(search_results, columns=['user_name', 'playlist_id', 'title'])
             return render_template('search_results.html', search_results=search_results, query=search_term, search_type='genre')
 
+        if search_type not in SEARCH_QUERIES:
+            abort(400, f'Unknown search type: {search_type}')
+        page = max(request.args.get('page', 1, type=int), 1)
+
         with my_engine.connect() as conn:
-            if search_type == 'playlist':
-                search_query = text("""
-                    SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
-                    FROM HasPlaylist
-                    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                    INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                    WHERE Playlist.title iLIKE :query
-                """)
-            elif search_type == 'artist':
-                search_query = text("""
-                    SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
-                    FROM HasPlaylist
-                    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                    INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                    INNER JOIN PlaylistArtists ON Playlist.playlist_id = PlaylistArtists.playlist_id
-                    INNER JOIN Artist ON PlaylistArtists.artist_id = Artist.artist_id
-                    WHERE Artist.name iLIKE :query
-                """)
-            elif search_type == 'song':
-                search_query = text("""
-                    SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
-                    FROM HasPlaylist
-                    INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-                    INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-                    INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-                    INNER JOIN Song ON PlaylistSong.song_id = Song.song_id
-                    WHERE Song.title iLIKE :query
-                """)
-            
-            params = {'query': f'%{search_term}%'}
-            cursor = conn.execute(search_query, params)
+            rows, has_more = search_playlists(conn, search_type, search_term or '', page)
             search_results = []
-            for result in cursor:
+            for result in rows:
                 search_results.append(result[0:3])
             search_results = pd.DataFrame(search_results, columns=['user_name', 'playlist_id', 'title'])
-            return render_template('search_results.html', search_results=search_results, query=search_term, search_type=search_type)
+            return render_template('search_results.html', search_results=search_results, query=search_term, search_type=search_type,
+                                   page=page, offset=(page - 1) * PAGE_SIZE, has_more=has_more)
 
 
 @main.route('/autocomplete_genres', methods=['GET'])
 def autocomplete_genres():
     query = request.args.get('term')  # Get the query string from the request
+    # Genres are completed from the in-process index, without going to the database
+    genre_index = get_genre_index()
     if query:
-        # Query the database for genres matching the input
-        with my_engine.connect() as conn:
-            genres_query = text("""
-                SELECT DISTINCT genre
-                FROM (
-                    SELECT unnest(genres) AS genre
-                    FROM Song
-                ) AS subquery
-                WHERE genre ILIKE :query_prefix  -- Case-insensitive match for genres starting with the input
-                LIMIT 10  -- Limit the number of results to 10
-            """)
-            cursor = conn.execute(genres_query, {'query_prefix': f'{query}%'})
-            genres = [row[0] for row in cursor.fetchall()]  # Extract genres from query result
-        # print(genres)
-        return jsonify(genres=genres)  # Return genres as JSON response
+        genres = genre_index.complete(query)  # Most common genres starting with the input
     else:
-        # Query the database for the top 10 most frequent genres
-        with my_engine.connect() as conn:
-            genres_query = text("""
-                SELECT genre, COUNT(*) AS count
-                FROM (
-                    SELECT unnest(genres) AS genre
-                    FROM Song
-                ) AS subquery
-                GROUP BY genre
-                ORDER BY count DESC
-                LIMIT 10  -- Limit the number of results to 10
-            """)
-            cursor = conn.execute(genres_query)
-            genres = [row[0] for row in cursor.fetchall()]  # Extract genres from query result
-        return jsonify(genres=genres)  # Return genres as JSON response
+        genres = genre_index.top()  # The top 10 most frequent genres
+    return jsonify(genres=genres)  # Return genres as JSON response
 
 
 # moot
 @main.route('/search_genres/<query>')
 def search_genres(query):
     with my_engine.connect() as conn:
-        search_query = text("""
-            SELECT DISTINCT Users.name, Playlist.playlist_id, Playlist.title
-            FROM HasPlaylist
-            INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-            INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-            INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-            INNER JOIN Song ON PlaylistSong.song_id = Song.song_id
-            WHERE Song.genres @> ARRAY[:query]
-        """)
         params = {'query': query}
-        cursor = conn.execute(search_query, params)
+        cursor = conn.execute(GENRE_SEARCH_QUERY, params)
         search_results = []
         for result in cursor:
             search_results.append(result[0:3])
@@ -533,26 +349,56 @@ def search_genres(query):
 def test():
     return render_template('test.html')
 
-# not yet working... many considerations.........
+# Titles and first uploaders of the ranked playlists
+RANKED_PLAYLISTS_QUERY = text("""
+    SELECT DISTINCT ON (Playlist.playlist_id) Playlist.playlist_id, Playlist.title, Users.name
+    FROM Playlist
+    LEFT JOIN HasPlaylist ON HasPlaylist.playlist_id = Playlist.playlist_id
+    LEFT JOIN Users ON HasPlaylist.user_id = Users.user_id
+    WHERE Playlist.playlist_id = ANY(:playlist_ids)
+    ORDER BY Playlist.playlist_id, HasPlaylist.date_uploaded
+""")
+
 @main.route('/filter_features')
 def search_features():
-    feature_to_search = request.args.get('feature')
-    sort_order = 'DESC' if request.args.get('desc_switch') == 'on' else 'ASC'
-
+    # One or more features, each with an optional weight (feature=energy&weight=2&feature=acousticness&weight=-1)
+    features = request.args.getlist('feature')
+    weights = request.args.getlist('weight', type=float)
+    descending = request.args.get('desc_switch') == 'on'
+    stat = request.args.get('stat', 'mean')
+    limit = max(1, min(request.args.get('limit', RANKED_PLAYLISTS, type=int), MAX_RANKED_PLAYLISTS))
+
+    if not features:
+        abort(400, 'No feature to rank by')
+    unknown = [feature for feature in features if feature not in FEATURE_FIELDS]
+    if unknown:
+        abort(400, f'Unknown features: {", ".join(unknown)}')
+    # Each feature's weight is matched up by position, so a repeated feature would silently lose one
+    repeated = sorted({feature for feature in features if features.count(feature) > 1})
+    if repeated:
+        abort(400, f'Features given more than once: {", ".join(repeated)}')
+    if stat not in STATS:
+        abort(400, f'Unknown statistic: {stat}')
+    # getlist drops weights that aren't numbers, which would shift the rest onto the wrong features
+    if len(weights) != len(request.args.getlist('weight')) or len(weights) > len(features) \
+            or not all(math.isfinite(weight) for weight in weights):
+        abort(400, 'Invalid weights')
+    ranking = dict(zip(features, weights + [1.0] * (len(features) - len(weights))))
+
+    # Ranked in the in-process feature index, without going to Song
+    ranked = get_feature_index().rank(ranking, descending=descending, k=limit, stat=stat)
     with my_engine.connect() as conn:
-        search_query = text(f"""
-            SELECT Users.name, Playlist.playlist_id, Playlist.title, AVG(Song.{feature_to_search}) as avg_feature
-            FROM HasPlaylist
-            INNER JOIN Users ON HasPlaylist.user_id = Users.user_id
-            INNER JOIN Playlist ON HasPlaylist.playlist_id = Playlist.playlist_id
-            INNER JOIN PlaylistSong ON Playlist.playlist_id = PlaylistSong.playlist_id
-            INNER JOIN Song ON PlaylistSong.song_id = Song.song_id
-            GROUP BY Playlist.playlist_id, Users.name, Playlist.title
-            ORDER BY avg_feature {sort_order}
-            LIMIT 10
-        """)
-        cursor = conn.execute(search_query)
-        search_results = []
-        for result in cursor:
-            search_results.append(result)
-        search_results = pd.DataFrame(search_results, columns=['user_name', 'playlist_id', 'title', 'avg_feature'])
\ No newline at end of file
+        playlists = {row.playlist_id: row for row in conn.execute(RANKED_PLAYLISTS_QUERY, {
+            'playlist_ids': [result['playlist_id'] for result in ranked]
+        })}
+    search_results = pd.DataFrame([{
+        'user_name': playlists[result['playlist_id']].name,
+        'playlist_id': result['playlist_id'],
+        'title': playlists[result['playlist_id']].title,
+        'score': result['score'],
+        'song_count': result['song_count'],
+        **result['values']
+    } for result in ranked if result['playlist_id'] in playlists],
+        columns=['user_name', 'playlist_id', 'title', 'score', 'song_count'] + list(ranking))
+    return render_template('feature_results.html', search_results=search_results, ranking=ranking,
+                           descending=descending, stat=stat)
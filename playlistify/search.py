@@ -0,0 +1,105 @@
+"""
+Ranked, paginated search over playlist titles, artist names and song titles.
+
+Titles and names are matched through pg_trgm's trigram GIN indexes (migration 005),
+so a search doesn't scan every row:
+    - a title containing the term (ILIKE '%term%') matches, as it always has
+    - so does one with a word close to the term, for typos (term <% title, word similarity
+      over WORD_SIMILARITY_THRESHOLD, which search_playlists sets for its transaction as
+      pg_trgm.word_similarity_threshold, so a server or role default can't change it)
+Each search scores at most MAX_MATCHES matching playlists, artists or songs: titles containing
+the term first, then ones with a close word, so a very common term stops after MAX_MATCHES rows
+instead of scoring every match or fanning out across the catalog.
+The playlists found are ranked by word similarity to the term, best first, and returned a page at a time.
+"""
+
+from sqlalchemy import text
+
+
+PAGE_SIZE = 25
+MAX_MATCHES = 500
+WORD_SIMILARITY_THRESHOLD = 0.6  # pg_trgm's default
+
+# <% compares against this setting, so it has to be set in the transaction the search runs in
+SET_WORD_SIMILARITY_THRESHOLD = text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)")
+
+# The playlists and their uploaders, best match first; each search_type's matches CTE
+# has one (playlist_id, score) row per matching playlist, song or artist
+PAGED_PLAYLISTS = """
+    SELECT Users.name, Playlist.playlist_id, Playlist.title, MAX(matches.score) AS score
+    FROM matches
+    INNER JOIN Playlist ON Playlist.playlist_id = matches.playlist_id
+    INNER JOIN HasPlaylist ON HasPlaylist.playlist_id = Playlist.playlist_id
+    INNER JOIN Users ON Users.user_id = HasPlaylist.user_id
+    GROUP BY Users.name, Playlist.playlist_id, Playlist.title
+    ORDER BY score DESC, Playlist.playlist_id, Users.name
+    LIMIT :limit OFFSET :offset
+"""
+
+# Up to :max_matches rows of a table whose text column matches the term, as (id, score).
+# Rows containing the term come first and those with a close word only fill the slots left;
+# LIMIT stops the scans there, so word_similarity is only computed for the rows kept.
+MATCHES = """
+    SELECT {key}, word_similarity(:term, {column}) AS score
+    FROM (
+        (SELECT {key}, {column} FROM {table} WHERE {column} ILIKE :pattern ESCAPE '\\')
+        UNION ALL
+        (SELECT {key}, {column} FROM {table} WHERE :term <% {column} AND {column} NOT ILIKE :pattern ESCAPE '\\')
+        LIMIT :max_matches
+    ) AS candidates
+"""
+
+SEARCH_QUERIES = {
+    'playlist': text(f"""
+        WITH matches AS ({MATCHES.format(table='Playlist', key='playlist_id', column='title')})
+        {PAGED_PLAYLISTS}
+    """),
+    'artist': text(f"""
+        WITH matched_artists AS ({MATCHES.format(table='Artist', key='artist_id', column='name')}),
+        matches AS (
+            SELECT PlaylistArtists.playlist_id, matched_artists.score
+            FROM matched_artists
+            INNER JOIN PlaylistArtists ON PlaylistArtists.artist_id = matched_artists.artist_id
+        )
+        {PAGED_PLAYLISTS}
+    """),
+    'song': text(f"""
+        WITH matched_songs AS ({MATCHES.format(table='Song', key='song_id', column='title')}),
+        matches AS (
+            SELECT PlaylistSong.playlist_id, matched_songs.score
+            FROM matched_songs
+            INNER JOIN PlaylistSong ON PlaylistSong.song_id = matched_songs.song_id
+        )
+        {PAGED_PLAYLISTS}
+    """)
+}
+
+
+def like_pattern(term):
+    """An ILIKE pattern matching strings that contain term, with LIKE's wildcards escaped."""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+
+def search_playlists(conn, search_type, term, page=1, page_size=PAGE_SIZE):
+    """
+    Find a page of playlists by title, or by the names of their artists or the titles of their songs.
+    @param:
+        - search_type: 'playlist', 'artist' or 'song'
+        - page: 1-based page number
+    @return:
+        - (list of (user name, playlist id, playlist title, score) rows, whether there is a next page)
+    """
+    term = term.strip()
+    if not term:
+        return [], False
+    params = {
+        'term': term,
+        'pattern': like_pattern(term),
+        'max_matches': MAX_MATCHES,
+        'limit': page_size + 1,  # one extra row tells us if there's another page
+        'offset': (page - 1) * page_size
+    }
+    conn.execute(SET_WORD_SIMILARITY_THRESHOLD, {'threshold': str(WORD_SIMILARITY_THRESHOLD)})
+    rows = conn.execute(SEARCH_QUERIES[search_type], params).fetchall()
+    return rows[:page_size], len(rows) > page_size
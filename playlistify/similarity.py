@@ -0,0 +1,278 @@
+"""
+"More like this" for view_playlist: the songs and playlists nearest a playlist in audio-feature space.
+
+Songs are points in 13 dimensions (Song.features, in FEATURE_FIELDS order), each feature
+scaled to zero mean and unit variance across the catalog so tempo and duration don't drown
+out the 0-1 features, and playlists are the centroids of their songs (their PlaylistFeatures
+means, scaled the same way). Nearness is Euclidean distance.
+
+The nearest neighbours are found exactly, by brute force: the vectors are stored one row
+per feature, so the distances to every song are one matrix-vector product, and the k nearest
+are picked without partitioning all of them by first taking the k-th smallest distance in a
+sample of SAMPLE_ROWS songs (no more than the k-th smallest overall) and only partitioning the
+songs at least that near. KD and ball trees don't prune much in 13 dimensions, and this answers
+in a few milliseconds at a million songs (python -m benchmarks.bench_similarity).
+
+The index is loaded from Song and PlaylistFeatures on a background thread when the app starts,
+updated with a playlist's new songs and centroid whenever this process writes them (persist_playlist),
+and reloaded in the background once it's SIMILARITY_INDEX_REFRESH seconds old, to pick up
+playlists written by other processes. The scaling is fixed when the index is loaded.
+"""
+
+import os
+import threading
+
+import numpy as np
+from sqlalchemy import text
+
+from playlistify.db_config import my_engine
+from playlistify.playlist_features import FEATURE_FIELDS
+from playlistify.reloading_index import ReloadingIndex
+
+
+SIMILARITY_INDEX_REFRESH = int(os.getenv('SIMILARITY_INDEX_REFRESH', 600))
+SIMILAR_SONGS = 10
+SIMILAR_PLAYLISTS = 5
+SAMPLE_ROWS = 20000
+LOAD_CHUNK_ROWS = 100000
+
+SONG_FEATURES_QUERY = text(f"""
+    SELECT song_id, {', '.join(f'(features).{field}' for field in FEATURE_FIELDS)}
+    FROM Song
+    WHERE features IS NOT NULL AND title IS NOT NULL
+""")
+PLAYLIST_MEANS_QUERY = text("SELECT playlist_id, means FROM PlaylistFeatures")
+
+SIMILAR_SONGS_QUERY = text("""
+    SELECT Song.song_id, Song.title, Song.album_url, ARRAY(
+        SELECT Artist.name FROM SongArtist
+        INNER JOIN Artist ON SongArtist.artist_id = Artist.artist_id
+        WHERE SongArtist.song_id = Song.song_id
+    ) AS artists
+    FROM Song
+    WHERE Song.song_id = ANY(:song_ids)
+""")
+SIMILAR_PLAYLISTS_QUERY = text("""
+    SELECT DISTINCT ON (Playlist.playlist_id) Playlist.playlist_id, Playlist.title, Playlist.image_url, Users.name
+    FROM Playlist
+    LEFT JOIN HasPlaylist ON HasPlaylist.playlist_id = Playlist.playlist_id
+    LEFT JOIN Users ON HasPlaylist.user_id = Users.user_id
+    WHERE Playlist.playlist_id = ANY(:playlist_ids)
+    ORDER BY Playlist.playlist_id, HasPlaylist.date_uploaded
+""")
+
+
+class NearestNeighbourIndex:
+    def __init__(self, ids=(), vectors=None, dims=len(FEATURE_FIELDS)):
+        """
+        Create an exact nearest neighbour index.
+        @param:
+            - ids: list of unique ids
+            - vectors: matrix of their vectors, one row per id
+        """
+        self._lock = threading.Lock()
+        self._dims = dims
+        self._ids = list(ids)
+        self._positions = {id_: i for i, id_ in enumerate(self._ids)}
+        vectors = np.asarray(vectors if vectors is not None else [], dtype=np.float32).reshape(len(self._ids), dims)
+        # One row per dimension, so the distances to a vector are one contiguous matrix-vector product
+        self._vectors = np.ascontiguousarray(vectors.T)
+        # Squared lengths; removed and unused columns are infinitely far from everything
+        self._sqnorms = np.einsum('ij,ij->i', vectors, vectors)
+        self._size = len(self._ids)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _grow(self, needed):
+        """Grow the matrix's capacity to at least needed columns (columns past _size are unused)."""
+        capacity = max(2 * self._vectors.shape[1], needed, 16)
+        vectors = np.zeros((self._dims, capacity), dtype=np.float32)
+        vectors[:, :self._size] = self._vectors[:, :self._size]
+        sqnorms = np.full(capacity, np.inf, dtype=np.float32)
+        sqnorms[:self._size] = self._sqnorms[:self._size]
+        self._vectors, self._sqnorms = vectors, sqnorms
+
+    def update(self, ids, vectors):
+        """Set the vectors of some ids, adding any the index doesn't have yet."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self._dims)
+        with self._lock:
+            new_ids = [id_ for id_ in dict.fromkeys(ids) if id_ not in self._positions]
+            if self._size + len(new_ids) > self._vectors.shape[1]:
+                self._grow(self._size + len(new_ids))
+            for id_ in new_ids:
+                self._positions[id_] = self._size
+                self._ids.append(id_)
+                self._size += 1
+            positions = [self._positions[id_] for id_ in ids]
+            self._vectors[:, positions] = vectors.T
+            self._sqnorms[positions] = np.einsum('ij,ij->i', vectors, vectors)
+
+    def remove(self, id_):
+        """Drop an id, so it's never a neighbour."""
+        with self._lock:
+            i = self._positions.pop(id_, None)
+            if i is not None:
+                self._sqnorms[i] = np.inf
+
+    def vector(self, id_):
+        """An id's vector, or None if it isn't in the index."""
+        with self._lock:
+            i = self._positions.get(id_)
+            return None if i is None else self._vectors[:, i].copy()
+
+    def nearest(self, vector, k, exclude=()):
+        """
+        The k ids nearest a vector.
+        @param:
+            - exclude: ids to leave out
+        @return:
+            - list of (id, distance), nearest first
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            n = self._size
+            # |x - v|^2 = |x|^2 - 2 x.v + |v|^2, and |v|^2 is the same for every x
+            distances = (-2 * vector) @ self._vectors[:, :n]
+            distances += self._sqnorms[:n]
+            excluded = [self._positions[id_] for id_ in exclude if id_ in self._positions]
+            distances[excluded] = np.inf
+            k = min(k, n)
+            if k <= 0:
+                return []
+
+            candidates = None
+            if n > SAMPLE_ROWS:
+                # The sample's k-th smallest distance bounds the overall k-th smallest
+                bound = np.partition(distances[:SAMPLE_ROWS], k - 1)[k - 1]
+                if np.isfinite(bound):
+                    candidates = np.flatnonzero(distances <= bound)
+            if candidates is None:
+                candidates = np.arange(n)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+
+            length = float(vector @ vector)
+            return [(self._ids[i], float(np.sqrt(max(distances[i] + length, 0.0))))
+                    for i in candidates if np.isfinite(distances[i])]
+
+
+class SimilarityIndex:
+    def __init__(self, song_ids, song_features, playlist_ids, playlist_means):
+        """
+        Create the song and playlist centroid indexes.
+        @param:
+            - song_ids, song_features: songs and a matrix of their raw features, one row per song
+            - playlist_ids, playlist_means: playlists and a matrix of their mean raw features
+        """
+        song_features = np.asarray(song_features, dtype=np.float32).reshape(len(song_ids), len(FEATURE_FIELDS))
+        if len(song_ids):
+            self.center = song_features.mean(axis=0, dtype=np.float64).astype(np.float32)
+            scale = song_features.std(axis=0, dtype=np.float64).astype(np.float32)
+            self.scale = np.where(scale > 0, scale, 1).astype(np.float32)
+        else:
+            self.center = np.zeros(len(FEATURE_FIELDS), dtype=np.float32)
+            self.scale = np.ones(len(FEATURE_FIELDS), dtype=np.float32)
+        self.songs = NearestNeighbourIndex(song_ids, self.normalize(song_features))
+        self.playlists = NearestNeighbourIndex(playlist_ids, self.normalize(playlist_means))
+
+    def normalize(self, features):
+        """Scale raw feature vectors (one per row) to the catalog's zero mean and unit variance."""
+        features = np.asarray(features, dtype=np.float32).reshape(-1, len(FEATURE_FIELDS))
+        return (features - self.center) / self.scale
+
+    def similar_songs(self, playlist_id, k=SIMILAR_SONGS, exclude=()):
+        """
+        The k songs nearest a playlist's centroid.
+        @param:
+            - exclude: song ids to leave out (the playlist's own songs)
+        @return:
+            - list of (song_id, distance), nearest first; empty if the playlist isn't in the index
+        """
+        centroid = self.playlists.vector(playlist_id)
+        return [] if centroid is None else self.songs.nearest(centroid, k, exclude)
+
+    def similar_playlists(self, playlist_id, k=SIMILAR_PLAYLISTS):
+        """
+        The k other playlists whose centroids are nearest a playlist's.
+        @return:
+            - list of (playlist_id, distance), nearest first; empty if the playlist isn't in the index
+        """
+        centroid = self.playlists.vector(playlist_id)
+        return [] if centroid is None else self.playlists.nearest(centroid, k, exclude=[playlist_id])
+
+    def update(self, playlist_id, song_ids, song_features, means):
+        """
+        Add songs, and set or remove a playlist's centroid.
+        @param:
+            - song_ids, song_features: songs and a matrix of their raw features
+            - means: the playlist's mean raw features, or None if it has no songs with features
+        """
+        if len(song_ids):
+            self.songs.update(song_ids, self.normalize(song_features))
+        if means is None:
+            self.playlists.remove(playlist_id)
+        else:
+            self.playlists.update([playlist_id], self.normalize(means))
+
+
+def load_similarity_index():
+    """Read every song's features and playlist's mean features into a new SimilarityIndex."""
+    song_ids = []
+    chunks = []
+    with my_engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(SONG_FEATURES_QUERY)
+        for rows in result.partitions(LOAD_CHUNK_ROWS):
+            song_ids.extend(row[0] for row in rows)
+            chunks.append(np.array([row[1:] for row in rows], dtype=np.float32))
+        playlists = conn.execute(PLAYLIST_MEANS_QUERY).fetchall()
+    song_features = np.concatenate(chunks) if chunks else np.empty((0, len(FEATURE_FIELDS)), dtype=np.float32)
+    return SimilarityIndex(song_ids, song_features,
+                           [row.playlist_id for row in playlists], [row.means for row in playlists])
+
+
+_similarity_index = ReloadingIndex('similarity index', load_similarity_index, SIMILARITY_INDEX_REFRESH)
+
+
+def get_similarity_index(wait=True):
+    """Get the process's similarity index (see ReloadingIndex.get)."""
+    return _similarity_index.get(wait)
+
+
+def preload_similarity_index():
+    """Load the similarity index on a background thread; it's a read of every song's features."""
+    _similarity_index.preload()
+
+
+def record_playlist_songs(playlist_id, song_ids, song_features, features_row):
+    """
+    Apply songs and a playlist centroid this process just committed, if the index is loaded or loading.
+    @param:
+        - song_ids, song_features: the songs added, and a matrix of their raw features
+        - features_row: the playlist's PlaylistFeatures row, or None if it has none
+    """
+    means = None if features_row is None else features_row.means
+    _similarity_index.apply(lambda index: index.update(playlist_id, song_ids, song_features, means))
+
+
+def similar_to_playlist(conn, playlist_id, exclude_song_ids=()):
+    """
+    The songs and playlists most like a playlist, for its page.
+    Doesn't wait for the similarity index to load, so both are empty until it has.
+    @param:
+        - exclude_song_ids: the playlist's songs, which aren't suggested
+    @return:
+        - (list of song rows of song_id, title, album_url and artists,
+           list of playlist rows of playlist_id, title, image_url and uploader name), most similar first
+    """
+    index = get_similarity_index(wait=False)
+    if index is None:
+        return [], []
+    song_ids = [song_id for song_id, _ in index.similar_songs(playlist_id, exclude=set(exclude_song_ids))]
+    playlist_ids = [other_id for other_id, _ in index.similar_playlists(playlist_id)]
+
+    songs = {row.song_id: row for row in conn.execute(SIMILAR_SONGS_QUERY, {'song_ids': song_ids})} if song_ids else {}
+    playlists = {row.playlist_id: row for row in conn.execute(SIMILAR_PLAYLISTS_QUERY, {'playlist_ids': playlist_ids})} if playlist_ids else {}
+    return ([songs[song_id] for song_id in song_ids if song_id in songs],
+            [playlists[other_id] for other_id in playlist_ids if other_id in playlists])
@@ -0,0 +1,70 @@
+"""
+Maintains SongPlaylistCount, the number of playlists each song is in.
+persist_playlist adds one for each song it adds to a playlist and subtracts one for
+each it removes, in the same transaction, so the top songs page seeks into the
+(playlist_count, song_id) index instead of counting every PlaylistSong row.
+
+Run rebuild() (flask --app playlistify rebuild-song-playlist-counts) to backfill
+or repair the counts from PlaylistSong.
+"""
+
+from sqlalchemy import text
+
+from playlistify.db_config import NO_STATEMENT_TIMEOUT
+
+
+# Rows are locked in song_id order, so concurrent uploads sharing songs don't deadlock
+ADD_SONG_COUNTS = text("""
+    INSERT INTO SongPlaylistCount (song_id, playlist_count)
+    SELECT song_id, 1 FROM UNNEST(CAST(:song_ids AS TEXT[])) AS song_id
+    ORDER BY song_id
+    ON CONFLICT (song_id) DO UPDATE SET playlist_count = SongPlaylistCount.playlist_count + 1
+""")
+SUBTRACT_SONG_COUNTS = text("""
+    UPDATE SongPlaylistCount SET playlist_count = SongPlaylistCount.playlist_count - 1
+    FROM (
+        SELECT song_id FROM SongPlaylistCount WHERE song_id = ANY(:song_ids)
+        ORDER BY song_id
+        FOR UPDATE
+    ) AS removed
+    WHERE SongPlaylistCount.song_id = removed.song_id
+""")
+DELETE_EMPTY_SONG_COUNTS = text("DELETE FROM SongPlaylistCount WHERE song_id = ANY(:song_ids) AND playlist_count <= 0")
+
+REBUILD_SONG_COUNTS = text("""
+    INSERT INTO SongPlaylistCount (song_id, playlist_count)
+    SELECT song_id, COUNT(*) FROM PlaylistSong GROUP BY song_id
+""")
+
+
+def update_song_playlist_counts(conn, added_song_ids, removed_song_ids):
+    """
+    Count a playlist's added songs as being in one more playlist and its removed songs
+    as being in one fewer. Runs in the caller's transaction.
+    @param:
+        - added_song_ids, removed_song_ids: the song ids the transaction's PlaylistSong
+          insert and delete returned (each song once)
+    """
+    if added_song_ids:
+        conn.execute(ADD_SONG_COUNTS, {'song_ids': added_song_ids})
+    if removed_song_ids:
+        conn.execute(SUBTRACT_SONG_COUNTS, {'song_ids': removed_song_ids})
+        conn.execute(DELETE_EMPTY_SONG_COUNTS, {'song_ids': removed_song_ids})
+
+
+def rebuild(conn):
+    """
+    Recount every song's playlists from scratch, in one transaction.
+    @return:
+        - number of songs in at least one playlist
+    """
+    try:
+        conn.exec_driver_sql(NO_STATEMENT_TIMEOUT)
+        conn.execute(text("DELETE FROM SongPlaylistCount"))
+        rows = conn.execute(REBUILD_SONG_COUNTS).rowcount
+        conn.execute(text("ANALYZE SongPlaylistCount"))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
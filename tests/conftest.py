@@ -0,0 +1,65 @@
+"""
+Shared fixtures. Spotify is the offline FakeSpotifyAdapter from benchmarks/fake_spotify.py.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+from flask_session import Session
+from requests.adapters import HTTPAdapter
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+# Before the app is imported, since it creates its session directory at import
+os.environ['INSTANCE_PATH'] = tempfile.mkdtemp(prefix='playlistify-instance-')
+atexit.register(shutil.rmtree, os.environ['INSTANCE_PATH'], True)
+
+from benchmarks.fake_spotify import FakeSpotifyAdapter
+from playlistify import app, http_client, jobs, result_store
+from playlistify.fetch_engine import FetchEngine
+from playlistify.SpotifyAnalyzer import SpotifyAnalyzer
+from playlistify.db_config import my_engine
+
+
+@pytest.fixture
+def fake():
+    """A fresh fake Spotify, answering every call made through http_client for the test."""
+    adapter = FakeSpotifyAdapter(null_feature_rate=0.1)
+    http_client.session.mount('https://api.spotify.com', adapter)
+    http_client.session.mount('https://accounts.spotify.com', adapter)
+    yield adapter
+    real = HTTPAdapter(pool_connections=4, pool_maxsize=http_client.POOL_SIZE)
+    http_client.session.mount('https://api.spotify.com', real)
+    http_client.session.mount('https://accounts.spotify.com', real)
+
+
+@pytest.fixture
+def analyzer(fake):
+    """An analyzer on its own fetch engine, with no metadata cache, so every call reaches the fake."""
+    return SpotifyAnalyzer(username='test_user', token='fake-token', engine=FetchEngine(), use_cache=False)
+
+
+@pytest.fixture(scope='session')
+def database():
+    """The app's database engine, skipping the test if the database isn't reachable or migrated."""
+    try:
+        with my_engine.connect() as conn:
+            conn.execute(text("SELECT 1 FROM PlaylistGenreSummary LIMIT 1"))
+    except SQLAlchemyError as e:
+        pytest.skip(f"no migrated database: {str(e).splitlines()[0]}")
+    return my_engine
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A test client for the app, keeping its instance folder (sessions, jobs, results) under tmp_path."""
+    monkeypatch.setattr(app, 'instance_path', str(tmp_path))
+    monkeypatch.setitem(app.config, 'SESSION_FILE_DIR', str(tmp_path / 'sessions'))
+    monkeypatch.setattr(app, 'session_interface', app.session_interface)  # restored after the test
+    monkeypatch.setattr(jobs, '_queue', None)
+    monkeypatch.setattr(result_store, '_store', None)
+    Session(app)
+    return app.test_client()
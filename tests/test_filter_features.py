@@ -0,0 +1,16 @@
+"""/filter_features rejects rankings it can't run as asked, before touching the feature index."""
+
+import pytest
+
+
+@pytest.mark.parametrize('query, error', [
+    ('feature=energy&weight=2&feature=energy&weight=-1', 'Features given more than once: energy'),
+    ('feature=energy&feature=loudness&weight=abc&weight=2', 'Invalid weights'),
+    ('feature=energy&weight=1&weight=2', 'Invalid weights'),
+    ('feature=happiness', 'Unknown features: happiness'),
+    ('', 'No feature to rank by')
+])
+def test_bad_rankings_are_rejected(client, query, error):
+    response = client.get(f'/filter_features?{query}')
+    assert response.status_code == 400
+    assert error in response.get_data(as_text=True)
@@ -0,0 +1,42 @@
+"""Incremental re-analysis by snapshot_id (get_playlist_details' previous=) against the fake Spotify."""
+
+import pandas as pd
+
+from benchmarks.fake_spotify import make_id
+
+
+def test_unchanged_snapshot_returns_previous(fake, analyzer):
+    playlist_id = make_id('T', 1)
+    fake.add_playlist(playlist_id, 120)
+    previous = analyzer.get_playlist_details(playlist_id)
+
+    before = fake.counts['requests']
+    assert analyzer.get_playlist_details(playlist_id, previous=previous) is previous
+    # Only the playlist itself is fetched, none of its tracks, features or artists
+    assert fake.counts['requests'] - before == 1
+
+
+def test_incremental_reanalysis_matches_fresh(fake, analyzer):
+    playlist_id = make_id('T', 2)
+    fake.add_playlist(playlist_id, 250)
+    previous = analyzer.get_playlist_details(playlist_id)
+
+    fake.edit_playlist(playlist_id, add=30, remove=120)
+    incremental = analyzer.get_playlist_details(playlist_id, previous=previous)
+    fresh = analyzer.get_playlist_details(playlist_id)
+
+    assert incremental[0] == fresh[0]
+    assert incremental[0]['snapshot_id'] != previous[0]['snapshot_id']
+    pd.testing.assert_frame_equal(incremental[1], fresh[1])
+    pd.testing.assert_frame_equal(incremental[2], fresh[2])
+    assert list(incremental[1]['song_id']) == fake.playlists[playlist_id]['track_ids']
+
+
+def test_reanalysis_of_emptied_playlist(fake, analyzer):
+    playlist_id = make_id('T', 3)
+    fake.add_playlist(playlist_id, 40)
+    previous = analyzer.get_playlist_details(playlist_id)
+
+    fake.edit_playlist(playlist_id, remove=40)
+    playlist_info, song_panda, art_panda = analyzer.get_playlist_details(playlist_id, previous=previous)
+    assert len(song_panda) == 0 and len(art_panda) == 0
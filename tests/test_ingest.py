@@ -0,0 +1,70 @@
+"""Bulk ingestion against the fake Spotify, with the database write replaced by a recorder."""
+
+import json
+
+import pytest
+
+from benchmarks.fake_spotify import make_id
+from playlistify import ingest, metadata_cache
+
+
+@pytest.fixture
+def persisted(monkeypatch):
+    """Record persisted playlists instead of writing them, and keep the metadata cache in process."""
+    playlists = {}
+
+    def persist_playlist(conn, playlist_info, song_panda, art_panda, owner):
+        if playlist_info['title'] == 'malformed':
+            raise KeyError('owner')
+        playlists[playlist_info['playlist_id']] = len(song_panda)
+
+    class Connection:
+        def __enter__(self):
+            return None
+
+        def __exit__(self, *exc_info):
+            return False
+
+    class Engine:
+        def connect(self):
+            return Connection()
+
+    monkeypatch.setattr(ingest, 'persist_playlist', persist_playlist)
+    monkeypatch.setattr(ingest, 'my_engine', Engine())
+    for cache in (metadata_cache.audio_features, metadata_cache.artists):
+        monkeypatch.setattr(cache, 'load_rows', None)
+        monkeypatch.setattr(cache, 'store_rows', None)
+    return playlists
+
+
+def read_journal(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_failures_are_journaled_and_the_run_goes_on(fake, persisted, tmp_path):
+    playlist_ids = [make_id('I', i) for i in range(6)]
+    for playlist_id in playlist_ids:
+        fake.add_playlist(playlist_id, 30)
+    fake.playlists[playlist_ids[1]]['playlist']['name'] = 'malformed'  # persisting it raises KeyError
+    missing = make_id('I', 99)  # Spotify answers 404
+    playlist_file = tmp_path / 'playlists.txt'
+    playlist_file.write_text('\n'.join(playlist_ids + [missing]) + '\n')
+    journal_path = tmp_path / 'playlists.journal'
+
+    progress = ingest.ingest_file(str(playlist_file), workers=3, journal_path=str(journal_path), token='fake-token')
+
+    assert progress.playlists == 5 and progress.failed == 2
+    records = {record['playlist_id']: record for record in read_journal(journal_path)}
+    assert set(records) == set(playlist_ids + [missing])
+    assert records[playlist_ids[1]]['status'] == 'failed'
+    assert records[playlist_ids[1]]['error'].startswith('KeyError')
+    assert records[missing]['status'] == 'failed'
+    assert all(records[playlist_id]['status'] == 'done' for playlist_id in playlist_ids if playlist_id != playlist_ids[1])
+
+    # A resume only retries the failures
+    fake.playlists[playlist_ids[1]]['playlist']['name'] = 'fixed'
+    persisted.clear()
+    progress = ingest.ingest_file(str(playlist_file), workers=3, journal_path=str(journal_path), token='fake-token')
+    assert set(persisted) == {playlist_ids[1]}
+    assert progress.playlists == 1 and progress.failed == 1
@@ -0,0 +1,58 @@
+"""The SQLite upload job queue, with the database write replaced by a recorder."""
+
+import time
+
+import pytest
+
+from playlistify import jobs
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return jobs.SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Record uploads instead of writing them."""
+    payloads = []
+    monkeypatch.setattr(jobs, 'run_upload', payloads.append)
+    return payloads
+
+
+def expire_leases(queue):
+    conn = queue._connect()
+    with conn:
+        conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE status = ?", (time.time() - 1, jobs.RUNNING))
+    conn.close()
+
+
+def test_job_from_a_dead_worker_is_requeued(queue, uploads):
+    job_id = queue.enqueue(b'upload', owner='user')
+    assert queue.dequeue(timeout=0)[0] == job_id  # claimed by a worker that then dies
+    assert queue.dequeue(timeout=0) is None  # still leased
+
+    expire_leases(queue)
+    assert jobs.work(queue, burst=True) == 1
+    assert uploads == [b'upload']
+    assert queue.status(job_id)['status'] == jobs.DONE
+
+
+def test_renewed_lease_keeps_the_job(queue):
+    job_id = queue.enqueue(b'upload')
+    queue.dequeue(timeout=0)
+    expire_leases(queue)
+    queue.renew(job_id)
+    assert queue.dequeue(timeout=0) is None
+
+
+def test_job_that_keeps_killing_workers_fails(queue, uploads):
+    job_id = queue.enqueue(b'upload')
+    for _ in range(jobs.MAX_ATTEMPTS):
+        assert queue.dequeue(timeout=0)[0] == job_id
+        expire_leases(queue)
+
+    assert jobs.work(queue, burst=True) == 0
+    assert uploads == []
+    status = queue.status(job_id)
+    assert status['status'] == jobs.FAILED and 'attempts' in status['error']
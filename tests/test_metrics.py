@@ -0,0 +1,19 @@
+"""Who can read /metrics."""
+
+import pytest
+
+from playlistify import app
+
+
+def test_metrics_are_local_only_without_a_token(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', None)
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 403
+
+
+def test_metrics_need_the_token_when_one_is_set(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}, headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200 and 'db_pool' in response.get_json()
@@ -0,0 +1,127 @@
+"""persist_playlist against the database, with playlists analyzed from the fake Spotify."""
+
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from benchmarks.fake_spotify import make_id
+from playlistify import genre_summary, persistence
+from playlistify.persistence import persist_playlist
+from playlistify.song_playlist_counts import update_song_playlist_counts
+
+
+USER = {'user_id': 'test_user', 'name': 'Test User', 'image_url': None}
+
+TOP_GENRES = text("SELECT top_genres FROM Playlist WHERE playlist_id = :playlist_id")
+GENRE_SUMMARY = text("SELECT genre, genre_count FROM PlaylistGenreSummary WHERE playlist_id = :playlist_id")
+# What genre_summary.rebuild would count for one playlist
+GENRE_RECOUNT = text("""
+    SELECT genre, COUNT(*) FROM PlaylistSong
+    INNER JOIN Song ON Song.song_id = PlaylistSong.song_id
+    CROSS JOIN UNNEST(Song.genres) AS genre
+    WHERE PlaylistSong.playlist_id = :playlist_id AND genre IS NOT NULL
+    GROUP BY genre
+""")
+SONG_COUNTS = text("SELECT song_id, playlist_count FROM SongPlaylistCount WHERE song_id = ANY(:song_ids)")
+SONG_RECOUNT = text("SELECT song_id, COUNT(*) FROM PlaylistSong WHERE song_id = ANY(:song_ids) GROUP BY song_id")
+
+
+def delete_playlist(engine, playlist_id):
+    params = {'playlist_id': playlist_id}
+    with engine.begin() as conn:
+        song_ids = conn.execute(text("DELETE FROM PlaylistSong WHERE playlist_id = :playlist_id RETURNING song_id"),
+                                params).scalars().all()
+        update_song_playlist_counts(conn, [], sorted(song_ids))
+        for table in ('HasPlaylist', 'PlaylistArtists', 'Rate', 'Playlist'):
+            conn.execute(text(f"DELETE FROM {table} WHERE playlist_id = :playlist_id"), params)
+
+
+@pytest.fixture
+def playlist_id(database, fake):
+    """A new playlist on the fake Spotify, removed from the database again after the test."""
+    playlist_id = make_id('D', 1)
+    fake._next_song = 9_700_000  # songs no other test has written
+    fake.add_playlist(playlist_id, 40)
+    delete_playlist(database, playlist_id)
+    with database.begin() as conn:
+        conn.execute(persistence.INSERT_USER, USER)  # so concurrent uploads don't wait on each other's new user
+    yield playlist_id
+    delete_playlist(database, playlist_id)
+
+
+def genre_counts(conn, query, playlist_id):
+    return dict(conn.execute(query, {'playlist_id': playlist_id}).all())
+
+
+def assert_song_counts_match(conn, song_data):
+    """The songs' SongPlaylistCount rows say what counting their PlaylistSong rows does."""
+    params = {'song_ids': song_data['song_id'].tolist()}
+    counts = dict(conn.execute(SONG_COUNTS, params).all())
+    assert counts and counts == dict(conn.execute(SONG_RECOUNT, params).all())
+
+
+def test_concurrent_first_uploads_count_songs_once(database, analyzer, playlist_id, monkeypatch):
+    result = analyzer.get_playlist_details(playlist_id)
+
+    # Both uploads read the (missing) playlist before either writes its songs
+    both_read = threading.Barrier(2, timeout=10)
+    persist_songs = persistence._persist_songs
+
+    def persist_songs_together(*args):
+        both_read.wait()
+        return persist_songs(*args)
+
+    monkeypatch.setattr(persistence, '_persist_songs', persist_songs_together)
+    errors = []
+
+    def upload():
+        try:
+            with database.connect() as conn:
+                persist_playlist(conn, *result, USER)
+        except Exception as e:
+            errors.append(e)
+
+    uploads = [threading.Thread(target=upload) for _ in range(2)]
+    for thread in uploads:
+        thread.start()
+    for thread in uploads:
+        thread.join()
+
+    assert errors == []
+    with database.connect() as conn:
+        summary = genre_counts(conn, GENRE_SUMMARY, playlist_id)
+        assert summary and summary == genre_counts(conn, GENRE_RECOUNT, playlist_id)
+        assert_song_counts_match(conn, result[1])
+
+
+def test_incremental_genre_summary_matches_a_rebuild(database, fake, analyzer, playlist_id):
+    result = analyzer.get_playlist_details(playlist_id)
+    with database.connect() as conn:
+        persist_playlist(conn, *result, USER)
+    fake.edit_playlist(playlist_id, add=15, remove=10)
+    result = analyzer.get_playlist_details(playlist_id, previous=result)
+    with database.connect() as conn:
+        persist_playlist(conn, *result, USER)
+
+    with database.connect() as conn:
+        incremental = genre_counts(conn, GENRE_SUMMARY, playlist_id)
+        top_genres = conn.execute(TOP_GENRES, {'playlist_id': playlist_id}).scalar()
+        genre_summary.rebuild(conn)
+        assert incremental and incremental == genre_counts(conn, GENRE_SUMMARY, playlist_id)
+        assert top_genres == conn.execute(TOP_GENRES, {'playlist_id': playlist_id}).scalar()
+
+
+def test_song_playlist_counts_follow_edits(database, fake, analyzer, playlist_id):
+    first = analyzer.get_playlist_details(playlist_id)
+    with database.connect() as conn:
+        persist_playlist(conn, *first, USER)
+    fake.edit_playlist(playlist_id, add=15, remove=10)
+    result = analyzer.get_playlist_details(playlist_id, previous=first)
+    with database.connect() as conn:
+        persist_playlist(conn, *result, USER)
+
+    with database.connect() as conn:
+        assert_song_counts_match(conn, result[1])
+        removed = sorted(set(first[1]['song_id']) - set(result[1]['song_id']))
+        assert len(removed) == 10 and not conn.execute(SONG_COUNTS, {'song_ids': removed}).all()
@@ -0,0 +1,33 @@
+"""The in-process indexes are only loaded by the web server, not by everything that imports the app."""
+
+import os
+import subprocess
+import sys
+
+
+# Run in a fresh interpreter, recording the threads started before and after the first request
+CHECK = """
+import threading
+
+started = []
+thread_start = threading.Thread.start
+
+def start(thread):
+    started.append(thread.name)
+    thread_start(thread)
+
+threading.Thread.start = start
+
+from playlistify import app
+assert not [name for name in started if name.endswith(' reload')], started
+app.test_client().get('/metrics')
+assert len([name for name in started if name.endswith(' reload')]) == 3, started
+"""
+
+
+def test_indexes_load_on_the_first_request_not_at_import(tmp_path):
+    env = {key: value for key, value in os.environ.items() if key != 'PRELOAD_INDEXES'}
+    env['INSTANCE_PATH'] = str(tmp_path)  # keep its sessions and results out of the repo
+    result = subprocess.run([sys.executable, '-c', CHECK], cwd=os.path.dirname(os.path.dirname(__file__)),
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,36 @@
+"""ReloadingIndex keeps changes made while it's loading a new index."""
+
+import threading
+import time
+
+from playlistify.reloading_index import ReloadingIndex
+
+
+def test_updates_during_a_reload_are_replayed_on_the_new_index():
+    loading = threading.Event()
+    finish_loading = threading.Event()
+    loads = []
+
+    def load():
+        # What the database held when this load read it
+        loads.append({'loaded': len(loads)})
+        if len(loads) > 1:
+            loading.set()
+            finish_loading.wait(10)
+        return loads[-1]
+
+    index = ReloadingIndex('test index', load, max_age=3600)
+    old = index.get()
+    index._start_reload()
+    assert loading.wait(10)
+
+    index.apply(lambda index: index.update(playlist='added during the reload'))
+    assert old['playlist'] == 'added during the reload'  # the old index still answers meanwhile
+    finish_loading.set()
+    while index._reloading:
+        time.sleep(0.01)
+
+    new = index.get(wait=False)
+    assert new is not old and new == {'loaded': 1, 'playlist': 'added during the reload'}
+    index.apply(lambda index: index.update(playlist='added after'))
+    assert new['playlist'] == 'added after' and index._pending is None
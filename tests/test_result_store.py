@@ -0,0 +1,68 @@
+"""Round trips of analysis results through the msgspec encoding and the disk store."""
+
+import pandas as pd
+
+from benchmarks.fake_spotify import make_id
+from playlistify.result_store import DiskResultStore, decode_result, encode_result, result_key
+
+
+def assert_same_result(decoded, original):
+    assert decoded[0] == original[0]
+    pd.testing.assert_frame_equal(decoded[1], original[1])
+    pd.testing.assert_frame_equal(decoded[2], original[2])
+
+
+def test_encoding_is_lossless(fake, analyzer):
+    playlist_id = make_id('R', 1)
+    fake.add_playlist(playlist_id, 230)
+    result = analyzer.get_playlist_details(playlist_id)
+    # Songs with no features have nulls in the float and nullable integer columns
+    assert result[1]['danceability'].isna().any()
+
+    assert_same_result(decode_result(encode_result(*result)), result)
+
+
+def test_encoding_empty_playlist(fake, analyzer):
+    playlist_id = make_id('R', 2)
+    fake.add_playlist(playlist_id, 0)
+    result = analyzer.get_playlist_details(playlist_id)
+    assert_same_result(decode_result(encode_result(*result)), result)
+
+
+def test_decode_without_artists(fake, analyzer):
+    playlist_id = make_id('R', 3)
+    fake.add_playlist(playlist_id, 20)
+    result = analyzer.get_playlist_details(playlist_id)
+    playlist_info, song_panda, art_panda = decode_result(encode_result(*result), artists=False)
+    assert art_panda is None
+    pd.testing.assert_frame_equal(song_panda, result[1])
+
+
+def test_disk_store_round_trip(fake, analyzer, tmp_path):
+    playlist_id = make_id('R', 4)
+    fake.add_playlist(playlist_id, 50)
+    result = analyzer.get_playlist_details(playlist_id)
+    store = DiskResultStore(str(tmp_path))
+    key = result_key(playlist_id, result[0]['snapshot_id'])
+
+    store.put(key, encode_result(*result), playlist_id=playlist_id)
+    assert store.latest(playlist_id) == key
+    assert_same_result(decode_result(store.get(key)), result)
+    assert store.get(result_key(playlist_id, 'other')) is None
+
+
+def test_view_outlives_its_memory_map(fake, analyzer, tmp_path):
+    playlist_id = make_id('R', 6)
+    fake.add_playlist(playlist_id, 50)
+    result = analyzer.get_playlist_details(playlist_id)
+    store = DiskResultStore(str(tmp_path))
+    key = result_key(playlist_id, result[0]['snapshot_id'])
+    store.put(key, encode_result(*result))
+
+    # Closing the map fails if anything decoded still points into it
+    with store.view(key) as buffer:
+        decoded = decode_result(buffer)
+    assert buffer.closed
+    assert_same_result(decoded, result)
+    with store.view(result_key(playlist_id, 'other')) as buffer:
+        assert buffer is None